@@ -1,5 +1,7 @@
-from flask import Flask, render_template, jsonify, request
+from flask import Flask, Response, abort, render_template, jsonify, request
 import app_bot
+import overflow_policy
+import serving_metrics
 
 Bot = app_bot.ShakespeareBot()
 
@@ -22,9 +24,20 @@ def server():
     if text == 'quit':
         exit()
     else:
-        response = Bot.respond(text)
+        try:
+            response = Bot.respond(text, request.form.get('sessionId') or None)
+        except overflow_policy.InputTooLongError as e:
+            return jsonify({'status': 'ERROR', 'code': e.code,
+                            'message': str(e)}), 413
 
     return jsonify({'status': 'OK', 'answer': response})
 
+@app.route('/metrics')
+def metrics():
+    if not serving_metrics.ENABLED:
+        abort(404)
+    return Response(serving_metrics.render(),
+                    mimetype='text/plain; version=0.0.4')
+
 if __name__ == '__main__':
     app.run()
@@ -5,14 +5,28 @@ import logging
 logging.basicConfig(format='%(asctime)s %(message)s', level=logging.DEBUG)
 import numpy as np
 
+import bucket_config
+import conversation_memory
 import data_utils
+import overflow_policy
+import quantize_weights
+import reranking
+import sampling
 import seq2seq_model
+import serving_metrics
+import step_profiler
+import vocabulary
 
-_buckets = [(7,8), (16,16), (25,24), (46,50)] # buckets manually identified after examining data
+# same buckets as used in training, see dialogue.py --optimize_buckets
+_buckets = bucket_config.load_buckets(
+    os.path.join(Configuration.TRAIN_DIR, bucket_config.BUCKETS_FILE))
 
 class ShakespeareBot(object):
 
-    def __init__(self):
+    def __init__(self, quantized_dir=None):
+        # directory of an int8 checkpoint written by quantize_weights.py, or ''
+        self.quantized_dir = (Configuration.QUANTIZED_DIR if quantized_dir is None
+                              else quantized_dir)
 
         # attempt at pre-loading the model
         logging.info("Loading the dialogue bot model now...")
@@ -24,16 +38,52 @@ class ShakespeareBot(object):
             self.model.batch_size = 1  # We decode one sentence at a time.
 
             # Load vocabularies.
-            from_vocab_path = os.path.join(Configuration.DATA_DIR,
-                                         "vocab%d.from" % Configuration.VOCAB_SIZE)
-            to_vocab_path = os.path.join(Configuration.DATA_DIR,
-                                         "vocab%d.to" % Configuration.VOCAB_SIZE)
-            self.from_vocab, _ = data_utils.initialize_vocabulary(from_vocab_path)
-            _, self.rev_to_vocab = data_utils.initialize_vocabulary(to_vocab_path)
+            self.from_vocab, self.rev_to_vocab = self.load_vocabularies()
+        # Sample the replies' tokens instead of taking the most likely ones.
+        self.sampler = None
+        if Configuration.SAMPLE_TEMPERATURE > 0:
+            self.sampler = sampling.Sampler(
+                Configuration.SAMPLE_TEMPERATURE, Configuration.SAMPLE_TOP_K,
+                Configuration.SAMPLE_TOP_P,
+                None if Configuration.SAMPLE_SEED is None
+                else int(Configuration.SAMPLE_SEED))
+        # Reply with the best of several sampled candidates.
+        self.reranker = None
+        if self.sampler is not None and Configuration.RERANK_CANDIDATES > 1:
+            self.reranker = reranking.Reranker(
+                self.model, Configuration.RERANK_LENGTH_PENALTY,
+                Configuration.RERANK_REPETITION_PENALTY)
+        # What to do with inputs longer than the largest bucket.
+        self.overflow = overflow_policy.OverflowPolicy(
+            Configuration.OVERFLOW_POLICY, _buckets,
+            on_overflow=serving_metrics.OVERFLOW_INPUTS.inc)
+        # Recent turns of each conversation, if replies use the context.
+        self.memory = None
+        if Configuration.CONTEXT_TURNS > 0:
+            self.memory = conversation_memory.ConversationMemory(
+                Configuration.CONTEXT_TURNS, Configuration.CONTEXT_TTL_SECS,
+                Configuration.CONTEXT_MAX_MB << 20,
+                on_evict=serving_metrics.CONVERSATION_EVICTIONS.inc)
+
+    def load_vocabularies(self):
+        """Load the input and output vocabularies (memory-mapped)."""
+        from_vocab_path = os.path.join(Configuration.DATA_DIR,
+                                     "vocab%d.from" % Configuration.VOCAB_SIZE)
+        to_vocab_path = os.path.join(Configuration.DATA_DIR,
+                                     "vocab%d.to" % Configuration.VOCAB_SIZE)
+        return (vocabulary.load_vocabulary(from_vocab_path),
+                vocabulary.load_vocabulary(to_vocab_path))
 
     def create_model(self, session, forward_only):
         """Create dialogue model and initialize or load parameters in session."""
-        dtype = tf.float32
+        dtype = tf.float16 if Configuration.USE_FP16 else tf.float32
+        # use existing model & checkpoint
+        checkpoint_dir = self.quantized_dir or Configuration.TRAIN_DIR
+        ckpt = tf.train.get_checkpoint_state(checkpoint_dir)
+        custom_getter = None
+        if self.quantized_dir:
+            custom_getter = quantize_weights.DequantizingGetter(
+                quantize_weights.quantized_variables(ckpt.model_checkpoint_path))
         model = seq2seq_model.Seq2SeqModel(
           Configuration.VOCAB_SIZE,
           _buckets,
@@ -44,37 +94,107 @@ class ShakespeareBot(object):
           Configuration.LEARNING_RATE,
           Configuration.LEARNING_RATE_DECAY_FACTOR,
           forward_only=forward_only,
-          dtype=dtype)
-        # use existing model & checkpoint
-        ckpt = tf.train.get_checkpoint_state(Configuration.TRAIN_DIR)
+          dtype=dtype,
+          custom_getter=custom_getter,
+          tie_embeddings=bool(Configuration.TIE_EMBEDDINGS),
+          conversation_context=Configuration.CONTEXT_TURNS > 0,
+          incremental_decoding=Configuration.SAMPLE_TEMPERATURE > 0,
+          rescoring=(Configuration.SAMPLE_TEMPERATURE > 0 and
+                     Configuration.RERANK_CANDIDATES > 1))
         print("Reading model parameters from %s" % ckpt.model_checkpoint_path)
         model.saver.restore(session, ckpt.model_checkpoint_path)
+        if Configuration.PROFILE_FRACTION > 0:
+            model.profiler = step_profiler.StepProfiler(
+                Configuration.PROFILE_DIR, Configuration.PROFILE_FRACTION)
         return model
 
 
-    def respond(self, sentence):
+    def respond(self, sentence, session_id=None):
+        """Return the reply to sentence, greedy or sampled (SAMPLE_TEMPERATURE).
+
+        With a session_id (and CONTEXT_TURNS set), the reply also attends
+        over the recent turns of that conversation.
+
+        Raises:
+            overflow_policy.InputTooLongError: if the sentence is too long and
+                the overflow policy is reject.
+        """
         logging.info("Analyzing input sentence for response...")  
+        timer = serving_metrics.stage_timer()
         # Get token-ids for the input sentence.
         token_ids = data_utils.sentence_to_token_ids(tf.compat.as_str(sentence), self.from_vocab)
-        # Which bucket does it belong to?
-        bucket_id = len(_buckets) - 1
-        for i, bucket in enumerate(_buckets):
-            if bucket[0] >= len(token_ids):
-                bucket_id = i
-                break
-            else:
-                logging.warning("Sentence truncated: %s", sentence)
+        timer.mark('tokenize')
+        # Which bucket does it belong to? Too long sentences are truncated,
+        # split into several pieces or rejected by the overflow policy.
+        pieces = self.overflow.fit(token_ids)
+        bucket_id = max(piece_bucket for piece_bucket, _ in pieces)
+        serving_metrics.BUCKET_REQUESTS.inc(bucket_id)
+        timer.mark('bucket')
 
-        # Get a 1-element batch to feed the sentence to the model.
-        encoder_inputs, decoder_inputs, target_weights = self.model.get_batch(
-          {bucket_id: [(token_ids, [])]}, bucket_id)
-        # Get output logits for the sentence.
-        _, _, output_logits = self.model.step(self.sess, encoder_inputs, decoder_inputs,
-                                       target_weights, bucket_id, True)
-        # This is a greedy decoder - outputs are just argmaxes of output_logits.
-        outputs = [int(np.argmax(logit, axis=1)) for logit in output_logits]
-        # If there is an EOS symbol in outputs, cut them at that point.
-        if data_utils.EOS_ID in outputs:
-            outputs = outputs[:outputs.index(data_utils.EOS_ID)]
+        if session_id is not None and self.memory is not None:
+            outputs = self.respond_in_context(session_id, pieces, bucket_id, timer)
+        elif self.reranker is not None:
+            # Sample several replies to each piece and keep the best.
+            outputs = []
+            for _, piece in pieces:
+                candidates = reranking.sample_candidates(
+                    self.sess, self.model, piece, bucket_id, self.sampler,
+                    Configuration.RERANK_CANDIDATES)
+                outputs += self.reranker.best(self.sess, piece, candidates)
+            timer.mark('session_run')
+        elif self.sampler is not None:
+            # Decode step by step, feeding back the sampled tokens.
+            outputs = sum(self.model.sample_outputs(
+                self.sess, [piece for _, piece in pieces], bucket_id,
+                self.sampler), [])
+            timer.mark('session_run')
+        else:
+            # Get a batch with one row per piece to feed the sentence to the model.
+            encoder_inputs, decoder_inputs, target_weights = self.model.prepare_batch(
+              [(piece, []) for _, piece in pieces], bucket_id)
+            timer.mark('get_batch')
+            # Get output logits for the sentence.
+            _, _, output_logits = self.model.step(self.sess, encoder_inputs, decoder_inputs,
+                                           target_weights, bucket_id, True)
+            timer.mark('session_run')
+            # This is a greedy decoder - outputs are just argmaxes of output_logits,
+            # cut at EOS; the replies to the pieces of a split sentence are joined.
+            outputs = sum(seq2seq_model.greedy_outputs(output_logits), [])
+            timer.mark('argmax')
         # Return model-generated sentence corresponding to outputs.
-        return " ".join([tf.compat.as_str(self.rev_to_vocab[output]) for output in outputs])
+        reply = self.rev_to_vocab.decode(outputs)
+        timer.mark('detokenize')
+        timer.finish()
+        return reply
+
+    def respond_in_context(self, session_id, pieces, bucket_id, timer):
+        """Reply attending over the cached turns of a conversation.
+
+        Only the new pieces (and the reply) are encoded; the states of the
+        earlier turns come from self.memory.
+        """
+        turns = [conversation_memory.Turn(*self.model.encode_turn(
+                     self.sess, piece, piece_bucket))
+                 for piece_bucket, piece in pieces]
+        timer.mark('encode')
+        context = self.memory.turns(session_id) + turns
+        context_states = np.concatenate([turn.states for turn in context])
+        if self.sampler is not None:
+            outputs = self.model.sample_from_states(
+                self.sess, context_states[np.newaxis], turns[-1].final_state,
+                bucket_id, self.sampler)[0]
+            timer.mark('session_run')
+        else:
+            output_logits = self.model.decode_context(
+                self.sess, context_states, turns[-1].final_state, bucket_id)
+            timer.mark('session_run')
+            outputs = seq2seq_model.greedy_outputs(output_logits)[0]
+            timer.mark('argmax')
+        # The reply is a turn of the conversation too.
+        reply_ids = outputs[:_buckets[-1][0]]
+        reply_bucket = overflow_policy.select_bucket(len(reply_ids), _buckets)
+        turns.append(conversation_memory.Turn(*self.model.encode_turn(
+            self.sess, reply_ids, reply_bucket)))
+        self.memory.add(session_id, turns)
+        timer.mark('remember')
+        return outputs
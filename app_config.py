@@ -9,4 +9,21 @@ class Configuration(object):
     BATCH_SIZE = os.getenv('BATCH_SIZE', 64)
     LEARNING_RATE = os.getenv('LEARNING_RATE', .5)
     LEARNING_RATE_DECAY_FACTOR = os.getenv('LEARNING_RATE_DECAY_FACTOR', .99)
-    TRAIN_DIR = os.getenv('TRAIN_DIR', 'training')
\ No newline at end of file
+    TRAIN_DIR = os.getenv('TRAIN_DIR', 'training')
+    TIE_EMBEDDINGS = os.getenv('TIE_EMBEDDINGS', '') # set if the model was trained with --tie_embeddings
+    OVERFLOW_POLICY = os.getenv('OVERFLOW_POLICY', 'truncate_back') # for too long inputs, see overflow_policy.py
+    SAMPLE_TEMPERATURE = float(os.getenv('SAMPLE_TEMPERATURE', 0)) # 0 for greedy replies, else sample at this temperature
+    SAMPLE_TOP_K = int(os.getenv('SAMPLE_TOP_K', 0)) # sample among this many most likely tokens, 0 for all
+    SAMPLE_TOP_P = float(os.getenv('SAMPLE_TOP_P', 1.0)) # sample among the most likely tokens with this total probability
+    SAMPLE_SEED = os.getenv('SAMPLE_SEED') # seed for reproducible sampled replies
+    RERANK_CANDIDATES = int(os.getenv('RERANK_CANDIDATES', 0)) # with sampling, reply with the best of this many samples
+    RERANK_LENGTH_PENALTY = float(os.getenv('RERANK_LENGTH_PENALTY', 0.6)) # length normalization exponent, see reranking.py
+    RERANK_REPETITION_PENALTY = float(os.getenv('RERANK_REPETITION_PENALTY', 1.0)) # weight of repeated word pairs, see reranking.py
+    CONTEXT_TURNS = int(os.getenv('CONTEXT_TURNS', 0)) # turns remembered per conversation, 0 for stateless replies
+    CONTEXT_TTL_SECS = float(os.getenv('CONTEXT_TTL_SECS', 1800)) # forget conversations idle this long
+    CONTEXT_MAX_MB = int(os.getenv('CONTEXT_MAX_MB', 256)) # memory for all remembered turns
+    METRICS = os.getenv('METRICS', '') # set to expose per-stage latencies on /metrics
+    PROFILE_FRACTION = float(os.getenv('PROFILE_FRACTION', 0)) # fraction of steps to trace op by op
+    PROFILE_DIR = os.getenv('PROFILE_DIR', os.path.join(TRAIN_DIR, 'profile'))
+    USE_FP16 = os.getenv('USE_FP16', '') # set to run the model in fp16 (checkpoints are the same)
+    QUANTIZED_DIR = os.getenv('QUANTIZED_DIR', '') # int8 checkpoint from quantize_weights.py to serve instead
@@ -0,0 +1,127 @@
+# Early Modern English dialogue generation, by Erika Varis Doggett
+
+# Python 3
+# ==============================================================================
+
+"""Length-grouped batch sampling for bucketed training data.
+
+Model.get_batch draws each batch uniformly from a bucket, so short and long
+pairs end up in the same batch. LengthGroupedSampler instead sorts each
+bucket by source and target length, cuts it into batches of similar-length
+pairs and serves those batches in shuffled order, one pass over the bucket
+per epoch.
+
+Every batch is still padded to its bucket size by the model graph, so the
+padding reported by padding_report() is given both to the bucket size (what
+is computed today) and to the longest pair of each batch (what a batch of
+that shape would need), for random and for length-grouped batches.
+"""
+
+import random
+
+from six.moves import xrange  # pylint: disable=redefined-builtin
+
+import pair_store
+
+
+class LengthGroupedSampler(object):
+  """Serves batches of similar-length pairs from each bucket."""
+
+  def __init__(self, data_set, batch_size, rng=None):
+    """Group every bucket of data_set into batches.
+
+    Args:
+      data_set: a list with one PairStore or list of (source, target) pairs
+        per bucket, as returned by dialogue.read_data.
+      batch_size: number of pairs per batch; the last batch of a bucket
+        may be smaller.
+      rng: random.Random used to shuffle; defaults to a new unseeded one.
+    """
+    self.data_set = data_set
+    self.batch_size = batch_size
+    self.rng = rng or random.Random()
+    self.epochs = [0] * len(data_set)
+    self._batches = [[] for _ in data_set]
+
+  def group(self, bucket_id):
+    """Sort a bucket by length and cut it into batches of pair indices."""
+    pairs = self.data_set[bucket_id]
+    indices = list(xrange(len(pairs)))
+    # Shuffle first so that pairs of equal length are grouped differently
+    # in each epoch; the sort below is stable.
+    self.rng.shuffle(indices)
+    source_lengths, target_lengths = pair_store.pair_lengths(pairs)
+    indices.sort(key=lambda i: (source_lengths[i], target_lengths[i]))
+    return [indices[i:i + self.batch_size]
+            for i in xrange(0, len(indices), self.batch_size)]
+
+  def next_indices(self, bucket_id):
+    """Return the indices of the pairs of the next batch from a bucket."""
+    if not self._batches[bucket_id]:
+      batches = self.group(bucket_id)
+      self.rng.shuffle(batches)
+      self._batches[bucket_id] = batches
+      self.epochs[bucket_id] += 1
+    return self._batches[bucket_id].pop()
+
+  def next_batch(self, bucket_id):
+    """Return the next list of (source, target) pairs from a bucket."""
+    pairs = self.data_set[bucket_id]
+    return [pairs[i] for i in self.next_indices(bucket_id)]
+
+
+def _padding(lengths, batches, bucket):
+  """Count real, bucket-padded and batch-padded tokens of some batches."""
+  encoder_size, decoder_size = bucket
+  real, to_bucket, to_batch = 0, 0, 0
+  for batch in batches:
+    # Decoder inputs are the target with a GO symbol prepended.
+    source_lengths = [lengths[0][i] for i in batch]
+    target_lengths = [lengths[1][i] + 1 for i in batch]
+    real += sum(source_lengths) + sum(target_lengths)
+    to_bucket += len(batch) * (encoder_size + decoder_size)
+    to_batch += len(batch) * (max(source_lengths) + max(target_lengths))
+  return real, to_bucket, to_batch
+
+
+def padding_report(data_set, buckets, batch_size, rng=None):
+  """Print the padding ratio of random and length-grouped batches per bucket.
+
+  Args:
+    data_set: a list with one PairStore or list of (source, target) pairs
+      per bucket.
+    buckets: the (encoder size, decoder size) of each bucket.
+    batch_size: batch size to form batches with.
+    rng: random.Random used to form the random batches.
+
+  Returns:
+    A list with one tuple (bucket_ratio, random_ratio, grouped_ratio) per
+    non-empty bucket (None for empty ones): the fraction of fed tokens that
+    are padding when padding to the bucket size, and when padding random
+    or length-grouped batches to their longest pair.
+  """
+  rng = rng or random.Random()
+  sampler = LengthGroupedSampler(data_set, batch_size, rng)
+  ratios = []
+  for bucket_id, bucket in enumerate(buckets):
+    pairs = data_set[bucket_id]
+    if not pairs:
+      ratios.append(None)
+      continue
+    indices = list(xrange(len(pairs)))
+    rng.shuffle(indices)
+    random_batches = [indices[i:i + batch_size]
+                      for i in xrange(0, len(indices), batch_size)]
+    lengths = pair_store.pair_lengths(pairs)
+    real, to_bucket, random_to_batch = _padding(lengths, random_batches,
+                                                bucket)
+    _, _, grouped_to_batch = _padding(lengths, sampler.group(bucket_id),
+                                      bucket)
+    ratio = (1.0 - float(real) / to_bucket,
+             1.0 - float(real) / random_to_batch,
+             1.0 - float(real) / grouped_to_batch)
+    print("  bucket %d: padding %.1f%% to bucket size; to batch max %.1f%% "
+          "random, %.1f%% length-grouped" % ((bucket_id,) +
+                                              tuple(100 * r for r in ratio)))
+    ratios.append(ratio)
+  return ratios
@@ -0,0 +1,271 @@
+"""End-to-end latency and throughput benchmark for the serving path.
+
+Drives ShakespeareBot.respond either in-process or over HTTP against the
+Flask app's /ask endpoint with a replayable prompt set that covers every
+bucket, at a configurable concurrency, and reports p50/p95/p99 latency,
+replies per second, CPU time and RSS. Failed requests (e.g. a 413 when the
+app rejects overlong prompts) are counted per bucket and left out of the
+latencies. Results are written as JSON so runs can be compared.
+
+In-process against a tiny randomly initialized model (no checkpoint needed):
+python3 benchmark_serving.py --tiny --output=bench.json
+
+Over HTTP against a running app (pass its pid to also measure its CPU/RSS):
+python3 benchmark_serving.py --url=http://127.0.0.1:5000 --server_pid=1234
+"""
+import argparse
+import collections
+import json
+import math
+import os
+import random
+import resource
+import string
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from urllib.parse import urlencode
+    from urllib.request import urlopen
+except ImportError:
+    from urllib import urlencode
+    from urllib2 import urlopen
+
+import bucket_config
+from app_config import Configuration
+
+
+def synthetic_words(count):
+    """Return count distinct lowercase words ('ba', 'bb', ..., 'ca', ...)."""
+    words = []
+    n = 0
+    while len(words) < count:
+        word, i = '', n
+        while True:
+            word = string.ascii_lowercase[i % 26] + word
+            i //= 26
+            if not i:
+                break
+        # Skip single letters, which the tokenizer may treat specially.
+        if len(word) > 1:
+            words.append(word)
+        n += 1
+    return words
+
+
+def make_prompts(words, buckets, per_bucket, seed=0):
+    """Build per_bucket prompts for each bucket, with lengths that fall in it.
+
+    Returns:
+        a list of dicts with 'bucket' and 'text' keys.
+    """
+    rng = random.Random(seed)
+    prompts = []
+    previous = 0
+    for bucket_id, (encoder_size, _) in enumerate(buckets):
+        for _ in range(per_bucket):
+            length = rng.randint(previous + 1, encoder_size)
+            text = ' '.join(rng.choice(words) for _ in range(length))
+            prompts.append({'bucket': bucket_id, 'text': text})
+        previous = encoder_size
+    return prompts
+
+
+def percentile(values, q):
+    """Nearest-rank percentile of a non-empty list."""
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(math.ceil(q / 100.0 * len(ordered))) - 1))
+    return ordered[rank]
+
+
+def process_usage(pid=None):
+    """Return (cpu seconds, rss bytes) of this process, or of pid via /proc."""
+    if pid is None:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        cpu = usage.ru_utime + usage.ru_stime
+        pid = os.getpid()
+    else:
+        with open('/proc/%d/stat' % pid) as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        ticks = os.sysconf('SC_CLK_TCK')
+        cpu = (int(fields[11]) + int(fields[12])) / float(ticks)
+    rss = None
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    rss = int(line.split()[1]) * 1024
+    except IOError:
+        # no /proc (e.g. macOS): peak RSS of this process, in bytes or KB
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return cpu, rss
+
+
+def make_tiny_bot(vocab_size=1000, size=32, num_layers=1):
+    """Return a ShakespeareBot with a tiny random model and vocabulary."""
+    import tensorflow as tf
+    import app_bot
+    import data_utils
+    import seq2seq_model
+    import vocabulary
+
+    class TinyBot(app_bot.ShakespeareBot):
+
+        def create_model(self, session, forward_only):
+            model = seq2seq_model.Seq2SeqModel(
+                vocab_size, app_bot._buckets, size, num_layers, 5.0, 1,
+                0.5, 0.99, forward_only=forward_only)
+            session.run(tf.global_variables_initializer())
+            return model
+
+        def load_vocabularies(self):
+            vocab = vocabulary.CompactVocabulary.from_words(
+                data_utils._START_VOCAB +
+                [w.encode('utf-8') for w in synthetic_words(vocab_size - 4)])
+            return vocab, vocab
+
+    return TinyBot()
+
+
+def make_client(args):
+    """Return a function that sends one prompt and returns the reply."""
+    if args.url:
+        ask_url = args.url.rstrip('/') + '/ask'
+
+        def ask(text):
+            data = urlencode({'messageText': text}).encode('utf-8')
+            return json.loads(urlopen(ask_url, data).read().decode('utf-8'))['answer']
+        return ask
+    if args.tiny:
+        bot = make_tiny_bot(args.tiny_vocab_size, args.tiny_size, args.tiny_layers)
+    else:
+        import app_bot
+        bot = app_bot.ShakespeareBot()
+    return bot.respond
+
+
+def run(args):
+    if args.prompts:
+        with open(args.prompts) as f:
+            prompts = [json.loads(line) for line in f]
+    else:
+        buckets = bucket_config.load_buckets(args.buckets_file)
+        prompts = make_prompts(synthetic_words(args.num_words), buckets,
+                               args.per_bucket, args.seed)
+        if args.save_prompts:
+            with open(args.save_prompts, 'w') as f:
+                for prompt in prompts:
+                    f.write(json.dumps(prompt) + '\n')
+
+    ask = make_client(args)
+    for prompt in prompts[:args.warmup]:
+        try:
+            ask(prompt['text'])
+        except Exception:
+            pass  # counted when the prompt is sent again while timing
+
+    requests = prompts * args.repeat
+    latencies = [None] * len(requests)
+    errors = collections.Counter()
+    lock = threading.Lock()
+
+    def timed(i):
+        start = time.time()
+        try:
+            ask(requests[i]['text'])
+        except Exception as e:
+            with lock:
+                errors['%s: %s' % (type(e).__name__, e)] += 1
+            return
+        with lock:
+            latencies[i] = time.time() - start
+
+    # CPU and RSS are those of the process serving the replies.
+    pid = args.server_pid if args.url else None
+    measure = pid is not None or not args.url
+    cpu, rss = None, None
+    if measure:
+        cpu_start, _ = process_usage(pid)
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(timed, range(len(requests))))
+    elapsed = time.time() - start
+    if measure:
+        cpu_end, rss = process_usage(pid)
+        cpu = cpu_end - cpu_start
+
+    def summary(values, failed=0):
+        if not values:
+            return {'count': 0, 'errors': failed}
+        return {'count': len(values),
+                'errors': failed,
+                'mean_ms': 1000 * sum(values) / len(values),
+                'p50_ms': 1000 * percentile(values, 50),
+                'p95_ms': 1000 * percentile(values, 95),
+                'p99_ms': 1000 * percentile(values, 99)}
+
+    per_bucket = {}
+    failed_per_bucket = collections.Counter()
+    for request, latency in zip(requests, latencies):
+        bucket = str(request['bucket'])
+        per_bucket.setdefault(bucket, [])
+        if latency is None:
+            failed_per_bucket[bucket] += 1
+        else:
+            per_bucket[bucket].append(latency)
+    succeeded = [latency for latency in latencies if latency is not None]
+    results = {
+        'mode': 'http' if args.url else ('tiny' if args.tiny else 'in-process'),
+        'concurrency': args.concurrency,
+        'requests': len(requests),
+        'elapsed_s': elapsed,
+        'replies_per_s': len(succeeded) / elapsed,
+        'latency': summary(succeeded, len(requests) - len(succeeded)),
+        'latency_per_bucket': dict((b, summary(v, failed_per_bucket[b]))
+                                   for b, v in per_bucket.items()),
+        'errors': dict(errors),
+        'cpu_s': cpu,
+        'rss_bytes': rss,
+    }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--url', help='base URL of a running app; in-process if unset')
+    parser.add_argument('--server_pid', type=int,
+                        help='pid of the app, to report its CPU and RSS in --url mode')
+    parser.add_argument('--tiny', action='store_true',
+                        help='use a tiny randomly initialized model')
+    parser.add_argument('--tiny_vocab_size', type=int, default=1000)
+    parser.add_argument('--tiny_size', type=int, default=32)
+    parser.add_argument('--tiny_layers', type=int, default=1)
+    parser.add_argument('--prompts', help='JSONL prompt file to replay')
+    parser.add_argument('--save_prompts', help='write the generated prompts here')
+    parser.add_argument('--buckets_file',
+                        default=os.path.join(Configuration.TRAIN_DIR,
+                                             bucket_config.BUCKETS_FILE),
+                        help='buckets to spread generated prompts over')
+    parser.add_argument('--per_bucket', type=int, default=25,
+                        help='generated prompts per bucket')
+    parser.add_argument('--num_words', type=int, default=500,
+                        help='distinct words in generated prompts')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=4,
+                        help='times to send the prompt set')
+    parser.add_argument('--warmup', type=int, default=10,
+                        help='prompts to send before timing')
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--output', help='write the results as JSON here')
+    args = parser.parse_args()
+
+    results = run(args)
+    print(json.dumps(results, indent=2, sort_keys=True))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
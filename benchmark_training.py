@@ -0,0 +1,235 @@
+"""Training throughput benchmark for Seq2SeqModel.get_batch and step.
+
+Builds a Seq2SeqModel of the given size on synthetic token data and, for
+each bucket, times get_batch, a forward-only step and a step with backprop
+separately, reporting examples and tokens per second. The defaults are small
+enough to finish on CPU in a few minutes; use them to catch regressions when
+changing cells, attention or batching.
+
+With --dtype=both the benchmark runs once in float32 and once with mixed
+precision (float16 compute, float32 master weights), each in its own
+process so that peak memory is measured separately, and prints the
+throughput and memory of the two side by side. On CPU, float16 mostly
+shows the cost of the casts; the speedup needs a GPU with fast float16.
+--tie_embeddings=both compares separate and tied embeddings the same way,
+including the number of parameters.
+
+python3 benchmark_training.py --size=128 --num_layers=2 --output=train.json
+python3 benchmark_training.py --dtype=both --output=precision.json
+python3 benchmark_training.py --tie_embeddings=both --output=tied.json
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import tensorflow as tf
+
+import bucket_config
+import data_utils
+import seq2seq_model
+
+
+def parse_buckets(text):
+    """Parse '7,8;16,16' into [(7, 8), (16, 16)]."""
+    return [tuple(int(n) for n in bucket.split(','))
+            for bucket in text.split(';')]
+
+
+def synthetic_data(buckets, vocab_size, pairs_per_bucket, seed=0):
+    """Random (source, target) token-id pairs that fit each bucket.
+
+    Lengths are uniform between the previous bucket's sizes and this one's,
+    and targets end in EOS, as produced by dialogue.read_data.
+    """
+    rng = random.Random(seed)
+    data_set = []
+    previous = (0, 1)
+    for encoder_size, decoder_size in buckets:
+        pairs = []
+        for _ in range(pairs_per_bucket):
+            source_length = rng.randint(min(previous[0] + 1, encoder_size - 1),
+                                        encoder_size - 1)
+            target_length = rng.randint(min(previous[1], decoder_size - 2),
+                                        decoder_size - 2)
+            source = [rng.randint(4, vocab_size - 1) for _ in range(source_length)]
+            target = [rng.randint(4, vocab_size - 1) for _ in range(target_length)]
+            pairs.append([source, target + [data_utils.EOS_ID]])
+        data_set.append(pairs)
+        previous = (encoder_size, decoder_size)
+    return data_set
+
+
+def timed(fn, steps, warmup):
+    """Run fn warmup + steps times and return the mean time of the last steps."""
+    for _ in range(warmup):
+        fn()
+    start = time.time()
+    for _ in range(steps):
+        fn()
+    return (time.time() - start) / steps
+
+
+def peak_rss():
+    """Peak resident memory of this process in bytes."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def run(args):
+    buckets = (parse_buckets(args.buckets) if args.buckets
+               else bucket_config.DEFAULT_BUCKETS)
+    data_set = synthetic_data(buckets, args.vocab_size, 4 * args.batch_size,
+                              args.seed)
+    results = {'config': vars(args), 'buckets': []}
+    # The same seed gives every compared run the same weights and batches.
+    rng = random.Random(args.seed)
+    with tf.Session() as sess:
+        tf.set_random_seed(args.seed)
+        start = time.time()
+        model = seq2seq_model.Seq2SeqModel(
+            args.vocab_size, buckets, args.size, args.num_layers, 5.0,
+            args.batch_size, 0.5, 0.99, num_samples=args.num_samples,
+            dtype=tf.float16 if args.dtype == 'fp16' else tf.float32,
+            accumulation_steps=args.accumulation_steps,
+            tie_embeddings=args.tie_embeddings == 'yes')
+        sess.run(tf.global_variables_initializer())
+        sess.run(tf.local_variables_initializer())
+        results['build_s'] = time.time() - start
+        results['parameters'] = int(sum(
+            np.prod(v.get_shape().as_list()) for v in tf.trainable_variables()))
+        print('Built model with %d parameters in %.1fs.'
+              % (results['parameters'], results['build_s']))
+
+        for bucket_id, (encoder_size, decoder_size) in enumerate(buckets):
+            batch = model.get_batch(data_set, bucket_id, rng)
+            real_tokens = int(sum(w.sum() for w in batch[2])) + int(
+                sum((e != data_utils.PAD_ID).sum() for e in batch[0]))
+            fed_tokens = args.batch_size * (encoder_size + decoder_size)
+
+            get_batch_s = timed(lambda: model.get_batch(data_set, bucket_id,
+                                                        rng),
+                                args.steps, args.warmup)
+            forward_s = timed(lambda: model.step(sess, batch[0], batch[1], batch[2],
+                                                 bucket_id, True),
+                              args.steps, args.warmup)
+            backward_s = timed(lambda: model.step(sess, batch[0], batch[1], batch[2],
+                                                  bucket_id, False),
+                               args.steps, args.warmup)
+
+            stats = {'bucket': [encoder_size, decoder_size],
+                     'fed_tokens_per_batch': fed_tokens,
+                     'real_tokens_per_batch': real_tokens}
+            for name, seconds in (('get_batch', get_batch_s),
+                                  ('forward', forward_s),
+                                  ('train', backward_s)):
+                stats[name] = {
+                    'ms': 1000 * seconds,
+                    'examples_per_s': args.batch_size / seconds,
+                    'fed_tokens_per_s': fed_tokens / seconds,
+                    'real_tokens_per_s': real_tokens / seconds,
+                }
+                print('bucket %d %-9s %8.2f ms %10.1f examples/s %12.1f tokens/s'
+                      % (bucket_id, name, 1000 * seconds,
+                         args.batch_size / seconds, fed_tokens / seconds))
+            results['buckets'].append(stats)
+    results['peak_rss_bytes'] = peak_rss()
+    print('Peak RSS %.1f MB.' % (results['peak_rss_bytes'] / float(1 << 20)))
+    return results
+
+
+def compare_runs(argv, option, values):
+    """Run the benchmark in a subprocess per option value and compare them.
+
+    Args:
+        argv: the command line arguments, without option and --output.
+        option: the option to vary, e.g. 'dtype'.
+        values: the two values to compare, the baseline first.
+    """
+    results = {}
+    for value in values:
+        with tempfile.NamedTemporaryFile(suffix='.json') as f:
+            subprocess.check_call([sys.executable, os.path.abspath(__file__),
+                                   '--%s=%s' % (option, value),
+                                   '--output=' + f.name] + argv)
+            with open(f.name) as results_file:
+                results[value] = json.load(results_file)
+
+    base, other = results[values[0]], results[values[1]]
+    print('%-8s %-9s %12s %12s %8s' % ('bucket', 'operation',
+                                        values[0] + ' ex/s',
+                                        values[1] + ' ex/s', 'speedup'))
+    for bucket_id, (a, b) in enumerate(zip(base['buckets'], other['buckets'])):
+        for name in ('forward', 'train'):
+            print('%-8d %-9s %12.1f %12.1f %7.2fx'
+                  % (bucket_id, name, a[name]['examples_per_s'],
+                     b[name]['examples_per_s'],
+                     b[name]['examples_per_s'] / a[name]['examples_per_s']))
+    for key, unit, scale in (('parameters', '', 1),
+                             ('peak_rss_bytes', ' MB', float(1 << 20))):
+        print('%s: %s %.1f%s, %s %.1f%s' % (key, values[0], base[key] / scale,
+                                           unit, values[1],
+                                           other[key] / scale, unit))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--vocab_size', type=int, default=5000)
+    parser.add_argument('--size', type=int, default=128)
+    parser.add_argument('--num_layers', type=int, default=2)
+    parser.add_argument('--num_samples', type=int, default=512,
+                        help='samples for the sampled softmax loss')
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--accumulation_steps', type=int, default=1)
+    parser.add_argument('--dtype', choices=('fp32', 'fp16', 'both'),
+                        default='fp32',
+                        help='fp16 is mixed precision; both compares the two')
+    parser.add_argument('--tie_embeddings', choices=('no', 'yes', 'both'),
+                        default='no',
+                        help='share the embeddings and output projection; '
+                             'both compares the two')
+    parser.add_argument('--buckets',
+                        help="bucket sizes as '7,8;16,16'; default: the "
+                             "original buckets")
+    parser.add_argument('--steps', type=int, default=10,
+                        help='timed repetitions of each operation')
+    parser.add_argument('--warmup', type=int, default=2,
+                        help='untimed repetitions before timing')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed of the data, the batches and the weights')
+    parser.add_argument('--output', help='write the results as JSON here')
+    args = parser.parse_args()
+
+    compare = [(option, values) for option, values in
+               (('dtype', ('fp32', 'fp16')), ('tie_embeddings', ('no', 'yes')))
+               if getattr(args, option) == 'both']
+    if len(compare) > 1:
+        parser.error('only one option can be "both"')
+    if compare:
+        option, values = compare[0]
+        argv, skip = [], False
+        for arg in sys.argv[1:]:
+            if skip:
+                skip = False
+            elif arg in ('--' + option, '--output'):
+                skip = True
+            elif not arg.startswith(('--%s=' % option, '--output=')):
+                argv.append(arg)
+        results = compare_runs(argv, option, values)
+    else:
+        results = run(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
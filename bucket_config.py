@@ -0,0 +1,160 @@
+# Early Modern English dialogue generation, by Erika Varis Doggett
+
+# Python 3
+# ==============================================================================
+
+"""Bucket boundaries shared by training and serving, and their optimizer.
+
+The buckets are stored as a JSON list of [encoder size, decoder size] pairs
+in BUCKETS_FILE inside the training directory, where dialogue.py and app_bot
+both look for them; without the file, DEFAULT_BUCKETS are used.
+
+optimize_buckets() picks boundaries from the length statistics of the
+tokenized .ids files: for each number of buckets up to a maximum it searches
+for the boundaries that minimize the number of padded tokens fed to the
+model, and each bucket beyond the first is charged a fixed cost (one more
+graph to build and hold) so that extra buckets must pay for themselves.
+"""
+
+import collections
+import json
+import os
+
+from six.moves import xrange  # pylint: disable=redefined-builtin
+
+
+BUCKETS_FILE = "buckets.json"
+
+# Buckets manually identified after examining data.
+DEFAULT_BUCKETS = [(7, 8), (16, 16), (25, 24), (46, 50)]
+
+
+def load_buckets(path):
+  """Read the bucket list from path, or return DEFAULT_BUCKETS if absent."""
+  if not os.path.exists(path):
+    return list(DEFAULT_BUCKETS)
+  with open(path, "r") as f:
+    return [tuple(bucket) for bucket in json.load(f)]
+
+
+def save_buckets(path, buckets):
+  """Write the bucket list to path."""
+  with open(path, "w") as f:
+    json.dump([list(bucket) for bucket in buckets], f)
+    f.write("\n")
+
+
+def read_lengths(source_path, target_path):
+  """Count the (source length, target length) pairs of two .ids files.
+
+  Target lengths include the EOS symbol that dialogue.read_data appends.
+
+  Returns:
+    a collections.Counter mapping (source length, target length) to the
+    number of pairs with those lengths.
+  """
+  lengths = collections.Counter()
+  with open(source_path, "r") as source_file:
+    with open(target_path, "r") as target_file:
+      for source, target in zip(source_file, target_file):
+        lengths[(len(source.split()), len(target.split()) + 1)] += 1
+  return lengths
+
+
+def padding_cost(lengths, buckets):
+  """Fed, real and dropped token counts of the pairs under given buckets.
+
+  Each pair goes to the first bucket with source < encoder size and
+  target < decoder size, as in dialogue.read_data, and is fed padded to
+  the full bucket size; pairs that fit no bucket are dropped.
+
+  Returns:
+    a tuple (fed_tokens, real_tokens, dropped_pairs) where the token counts
+    cover the pairs that fit a bucket.
+  """
+  fed, real, dropped = 0, 0, 0
+  for (source_length, target_length), count in lengths.items():
+    for encoder_size, decoder_size in buckets:
+      if source_length < encoder_size and target_length < decoder_size:
+        fed += count * (encoder_size + decoder_size)
+        real += count * (source_length + target_length)
+        break
+    else:
+      dropped += count
+  return fed, real, dropped
+
+
+def _search(lengths, num_buckets, largest):
+  """Coordinate descent over the boundaries of num_buckets buckets.
+
+  The last bucket is fixed to largest; the others are kept sorted in both
+  dimensions and each boundary in turn is moved to the value between its
+  neighbours that feeds the fewest tokens, until nothing improves.
+  """
+  source_sizes = sorted(set(s + 1 for s, _ in lengths if s < largest[0]))
+  target_sizes = sorted(set(t + 1 for _, t in lengths if t < largest[1]))
+
+  def quantile(sizes, q):
+    return sizes[min(len(sizes) - 1, int(q * len(sizes)))] if sizes else 1
+  buckets = [[quantile(source_sizes, float(i + 1) / num_buckets),
+              quantile(target_sizes, float(i + 1) / num_buckets)]
+             for i in xrange(num_buckets - 1)]
+  buckets.append(list(largest))
+  best = padding_cost(lengths, buckets)[0]
+
+  improved = True
+  while improved:
+    improved = False
+    for i in xrange(num_buckets - 1):
+      for dim, sizes in ((0, source_sizes), (1, target_sizes)):
+        low = buckets[i - 1][dim] if i > 0 else 1
+        high = buckets[i + 1][dim]
+        for size in sizes:
+          if size < low or size > high or size == buckets[i][dim]:
+            continue
+          old_size = buckets[i][dim]
+          buckets[i][dim] = size
+          fed = padding_cost(lengths, buckets)[0]
+          if fed < best:
+            best = fed
+            improved = True
+          else:
+            buckets[i][dim] = old_size
+  # Boundaries that converged onto their neighbour add nothing but a graph.
+  unique = [tuple(b) for i, b in enumerate(buckets)
+            if i == len(buckets) - 1 or b != buckets[i + 1]]
+  return unique, best
+
+
+def optimize_buckets(lengths, max_buckets, largest, graph_cost=0.02):
+  """Choose bucket boundaries that minimize padding plus a per-graph cost.
+
+  Args:
+    lengths: Counter of (source length, target length), see read_lengths.
+    max_buckets: largest number of buckets to consider.
+    largest: (encoder size, decoder size) of the last bucket; longer pairs
+      are dropped, as they are with the current buckets.
+    graph_cost: cost of each bucket beyond the first, as a fraction of the
+      real tokens in the corpus.
+
+  Returns:
+    the list of buckets with the lowest padded tokens plus graph cost.
+  """
+  _, real, _ = padding_cost(lengths, [largest])
+  best_buckets, best_cost = None, None
+  for num_buckets in xrange(1, max_buckets + 1):
+    buckets, fed = _search(lengths, num_buckets, largest)
+    cost = fed - real + graph_cost * real * (len(buckets) - 1)
+    if best_cost is None or cost < best_cost:
+      best_buckets, best_cost = buckets, cost
+  return best_buckets
+
+
+def print_report(name, lengths, buckets):
+  """Print padding waste and dropped pairs of lengths under given buckets."""
+  fed, real, dropped = padding_cost(lengths, buckets)
+  total = sum(lengths.values())
+  print("%s buckets %s:" % (name, buckets))
+  print("  padding %d of %d fed tokens (%.1f%%), dropped %d of %d pairs "
+        "(%.2f%%)" % (fed - real, fed, 100.0 * (fed - real) / max(fed, 1),
+                      dropped, total, 100.0 * dropped / max(total, 1)))
@@ -0,0 +1,191 @@
+# Early Modern English dialogue generation, by Erika Varis Doggett
+
+# Python 3
+# ==============================================================================
+
+"""Offline decoding of large prompt files, used by dialogue.py --decode_file.
+
+Prompts are read in chunks from a JSONL file (one object with a "text" field
+per line) or a plain text file (one prompt per line). Each chunk is
+tokenized by a pool of worker processes, grouped by bucket and decoded in
+large batches; the replies are then written in the original order, one JSON
+object per line with the prompt's fields and a "reply" field (or, for
+prompts rejected by the overflow policy, an "error" field). A chunk is
+only written once it is complete, so an interrupted run resumes after the
+last complete line of the output file.
+"""
+
+import itertools
+import json
+import multiprocessing
+import os
+import time
+
+import tensorflow as tf
+
+import data_utils
+import overflow_policy
+import seq2seq_model
+import vocabulary
+
+
+def read_prompts(path, skip=0):
+  """Yield prompt records (dicts with a "text" field) from a file.
+
+  Args:
+    path: JSONL file with a "text" field per line, or a text file with one
+      prompt per line.
+    skip: number of prompts to skip, e.g. those already decoded.
+  """
+  with open(path) as f:
+    lines = (line.strip() for line in f)
+    records = ((json.loads(line) if line.startswith("{") else {"text": line})
+               for line in lines if line)
+    for record in itertools.islice(records, skip, None):
+      yield record
+
+
+def completed_count(output_path):
+  """Return the number of complete lines in output_path.
+
+  A partial last line, left by an interrupted run, is removed.
+  """
+  if not os.path.exists(output_path):
+    return 0
+  count = 0
+  complete_bytes = 0
+  with open(output_path, "rb") as f:
+    for line in f:
+      if not line.endswith(b"\n"):
+        break
+      count += 1
+      complete_bytes += len(line)
+  if complete_bytes != os.path.getsize(output_path):
+    with open(output_path, "r+b") as f:
+      f.truncate(complete_bytes)
+  return count
+
+
+_worker_vocab = None
+
+
+def _init_worker(vocab_path):
+  global _worker_vocab
+  _worker_vocab = vocabulary.load_vocabulary(vocab_path)
+
+
+def _tokenize(text):
+  return data_utils.sentence_to_token_ids(tf.compat.as_str(text),
+                                          _worker_vocab)
+
+
+def tokenizer_pool(from_vocab_path, workers=None):
+  """Start the tokenizer processes.
+
+  Create the pool before any tf.Session, so that the workers are not forked
+  from a process with TensorFlow's threads running.
+
+  Args:
+    from_vocab_path: path of the input vocabulary, loaded by each worker.
+    workers: number of processes; defaults to the number of CPUs.
+  """
+  # Write the binary vocabulary here if it is missing or stale, so that the
+  # workers only map it rather than all writing it at once.
+  vocabulary.load_vocabulary(from_vocab_path)
+  return multiprocessing.Pool(workers, initializer=_init_worker,
+                              initargs=(from_vocab_path,))
+
+
+def decode_token_ids(session, model, token_ids, batch_size, overflow,
+                     sampler=None):
+  """Decode a list of token-id lists in batches by bucket.
+
+  Args:
+    session: session holding the forward-only model.
+    model: a forward-only Seq2SeqModel.
+    token_ids: list of token-id lists to decode.
+    batch_size: maximum number of inputs (or pieces of inputs) per batch.
+    overflow: overflow_policy.OverflowPolicy for inputs that are too long.
+    sampler: sampling.Sampler to sample the outputs with (the model must
+      have incremental_decoding), or None to decode greedily.
+
+  Returns:
+    For each input, in input order, the output token ids cut at EOS (those
+    of all pieces of a split input joined), or the InputTooLongError with
+    which the overflow policy rejected it.
+  """
+  outputs = [None] * len(token_ids)
+  by_bucket = {}
+  for index, ids in enumerate(token_ids):
+    try:
+      pieces = overflow.fit(ids)
+    except overflow_policy.InputTooLongError as e:
+      outputs[index] = e
+      continue
+    outputs[index] = [None] * len(pieces)
+    for piece_index, (bucket_id, piece) in enumerate(pieces):
+      by_bucket.setdefault(bucket_id, []).append((index, piece_index, piece))
+  for bucket_id, items in sorted(by_bucket.items()):
+    for start in range(0, len(items), batch_size):
+      batch = items[start:start + batch_size]
+      if sampler is not None:
+        batch_outputs = model.sample_outputs(
+            session, [piece for _, _, piece in batch], bucket_id, sampler)
+      else:
+        encoder_inputs, decoder_inputs, target_weights = model.prepare_batch(
+            [(piece, []) for _, _, piece in batch], bucket_id)
+        _, _, output_logits = model.step(session, encoder_inputs,
+                                         decoder_inputs, target_weights,
+                                         bucket_id, True)
+        batch_outputs = seq2seq_model.greedy_outputs(output_logits)
+      for (index, piece_index, _), output in zip(batch, batch_outputs):
+        outputs[index][piece_index] = output
+  return [output if isinstance(output, Exception) else sum(output, [])
+          for output in outputs]
+
+
+def decode_file(session, model, pool, input_path, output_path, rev_to_vocab,
+                overflow, batch_size=256, chunk_size=10000, sampler=None):
+  """Decode every prompt in input_path and append the replies to output_path.
+
+  Args:
+    session: session holding the forward-only model.
+    model: a forward-only Seq2SeqModel.
+    pool: tokenizer processes from tokenizer_pool; terminated when done.
+    input_path: JSONL or text prompt file, see read_prompts.
+    output_path: JSONL file to write; prompts already in it are skipped.
+    rev_to_vocab: output vocabulary (vocabulary.CompactVocabulary).
+    overflow: overflow_policy.OverflowPolicy for prompts that are too long.
+    batch_size: prompts per batch fed to the model.
+    chunk_size: prompts tokenized, decoded and written at a time.
+    sampler: sampling.Sampler for sampled replies, or None for greedy ones.
+  """
+  done = completed_count(output_path)
+  if done:
+    print("Resuming after %d decoded prompts in %s" % (done, output_path))
+  prompts = read_prompts(input_path, skip=done)
+  start_time = time.time()
+  decoded = 0
+  try:
+    with open(output_path, "a") as output:
+      while True:
+        chunk = list(itertools.islice(prompts, chunk_size))
+        if not chunk:
+          break
+        token_ids = pool.map(_tokenize, [record["text"] for record in chunk],
+                             chunksize=64)
+        outputs = decode_token_ids(session, model, token_ids, batch_size,
+                                   overflow, sampler)
+        for record, output_ids in zip(chunk, outputs):
+          if isinstance(output_ids, overflow_policy.InputTooLongError):
+            record["error"] = output_ids.code
+          else:
+            record["reply"] = rev_to_vocab.decode(output_ids)
+          output.write(json.dumps(record) + "\n")
+        output.flush()
+        os.fsync(output.fileno())
+        decoded += len(chunk)
+        print("  decoded %d prompts (%.1f prompts/sec)"
+              % (done + decoded, decoded / (time.time() - start_time)))
+  finally:
+    pool.terminate()
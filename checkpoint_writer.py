@@ -0,0 +1,131 @@
+# Early Modern English dialogue generation, by Erika Varis Doggett
+
+# Python 3
+# ==============================================================================
+
+"""Asynchronous checkpoint writer that keeps saving off the training loop.
+
+The training thread only pays for copying the model variables into host
+memory (one session.run over the variable list). The copies are handed to a
+background thread that owns a small CPU-only "shadow" graph holding one
+variable per model variable; it loads the snapshot into the shadow variables
+and writes them with a tf.train.Saver keyed by the original variable names, so
+the resulting checkpoints restore directly with model.saver.restore.
+"""
+
+import threading
+import time
+
+from six.moves import queue
+import tensorflow as tf
+
+
+_STOP = object()
+# How often a put to a full queue checks that the writer thread still runs.
+_PUT_POLL_SECONDS = 1.0
+
+
+class AsyncCheckpointWriter(object):
+  """Writes checkpoints of a set of variables on a background thread."""
+
+  def __init__(self, variables, max_to_keep=5, max_pending=1):
+    """Create the writer and start its background thread.
+
+    Args:
+      variables: list of tf.Variables to checkpoint, e.g. tf.global_variables().
+      max_to_keep: only the most recent max_to_keep checkpoints are kept on
+        disk; older ones are deleted by the saver.
+      max_pending: number of snapshots that may wait for the writer; save()
+        blocks when this many are queued, which bounds host memory use to
+        (max_pending + 2) copies of the model: the queued snapshots, the one
+        being written, and the shadow variables it is loaded into.
+    """
+    self._variables = list(variables)
+    self._graph = tf.Graph()
+    with self._graph.as_default(), tf.device("/cpu:0"):
+      self._placeholders = []
+      shadow_vars = {}
+      for v in self._variables:
+        placeholder = tf.placeholder(v.dtype.base_dtype, shape=v.get_shape())
+        shadow = tf.Variable(placeholder, trainable=False, collections=[])
+        self._placeholders.append(placeholder)
+        shadow_vars[v.op.name] = shadow
+      self._load_op = tf.group(*[v.initializer for v in shadow_vars.values()])
+      self._saver = tf.train.Saver(shadow_vars, max_to_keep=max_to_keep)
+    self._sess = tf.Session(graph=self._graph)
+    self._queue = queue.Queue(maxsize=max_pending)
+    self._error = None
+    self._thread = threading.Thread(target=self._run,
+                                    name="checkpoint-writer")
+    self._thread.daemon = True
+    self._thread.start()
+
+  def save(self, session, save_path, global_step):
+    """Snapshot the variables and queue them to be written.
+
+    Args:
+      session: the training session holding the current variable values.
+      save_path: checkpoint prefix, as for tf.train.Saver.save.
+      global_step: integer or scalar tf.Variable appended to save_path.
+
+    Returns:
+      The time in seconds spent on the training thread taking the snapshot.
+
+    Raises:
+      RuntimeError: if a background write failed or the writer is closed.
+    """
+    self._raise_if_failed()
+    start_time = time.time()
+    values, step = session.run([self._variables, global_step])
+    if not self._put((values, save_path, int(step))):
+      self._raise_if_failed()
+      raise RuntimeError("The checkpoint writer is closed.")
+    return time.time() - start_time
+
+  def close(self):
+    """Wait for all queued checkpoints to be written and stop the thread."""
+    self._put(_STOP)
+    self._thread.join()
+    self._sess.close()
+    self._raise_if_failed()
+
+  def _put(self, item):
+    """Queue item for the writer thread; False if the thread has stopped.
+
+    A thread stopped by a failed write no longer drains the queue, so a
+    plain blocking put could wait forever.
+    """
+    while self._thread.is_alive():
+      try:
+        self._queue.put(item, timeout=_PUT_POLL_SECONDS)
+        return True
+      except queue.Full:
+        pass
+    return False
+
+  def _raise_if_failed(self):
+    if self._error is not None:
+      raise RuntimeError("Background checkpoint write failed: %s"
+                         % self._error)
+
+  def _run(self):
+    while True:
+      item = self._queue.get()
+      if item is _STOP:
+        return
+      values, save_path, step = item
+      try:
+        self._write(values, save_path, step)
+      except Exception as e:  # pylint: disable=broad-except
+        self._error = e
+        return
+
+  def _write(self, values, save_path, step):
+    start_time = time.time()
+    self._sess.run(self._load_op, dict(zip(self._placeholders, values)))
+    path = self._saver.save(self._sess, save_path, global_step=step,
+                            write_meta_graph=False)
+    write_time = time.time() - start_time
+    size = sum(tf.gfile.Stat(f).length for f in tf.gfile.Glob(path + ".*"))
+    print("  checkpoint %s written in %.2fs (%.1f MB)"
+          % (path, write_time, size / float(1 << 20)))
@@ -0,0 +1,97 @@
+"""Per-session conversation memory with cached encoder states.
+
+ShakespeareBot keeps the last few turns of each conversation (the user's
+lines and its own replies) together with their encoder outputs, so a new
+line is the only thing encoded on each request: the decoder then attends
+over the cached states of the earlier turns and the new one, see
+Seq2SeqModel.encode_turn and decode_context.
+
+Conversations not used for ttl_secs are dropped, and when the cached states
+take more than max_bytes the least recently used conversations are dropped
+until they fit.
+"""
+import collections
+import threading
+import time
+
+Turn = collections.namedtuple('Turn', ['states', 'final_state'])
+
+
+def turn_bytes(turn):
+    return turn.states.nbytes + sum(s.nbytes for s in turn.final_state)
+
+
+class _Conversation(object):
+
+    def __init__(self, max_turns):
+        self.turns = collections.deque(maxlen=max_turns)
+        self.nbytes = 0
+        self.last_used = 0.0
+
+
+class ConversationMemory(object):
+    """A ring buffer of recent turns per session, with TTL and memory cap."""
+
+    def __init__(self, max_turns=4, ttl_secs=1800, max_bytes=256 << 20,
+                 on_evict=None, clock=time.time):
+        """Create the memory.
+
+        Args:
+            max_turns: turns kept per conversation; older ones are dropped.
+            ttl_secs: conversations unused for this long are dropped.
+            max_bytes: limit on the size of all cached states.
+            on_evict: optional function called with 'ttl' or 'memory' for
+                each dropped conversation, e.g. to count evictions.
+            clock: function returning the current time in seconds.
+        """
+        self.max_turns = max_turns
+        self.ttl_secs = ttl_secs
+        self.max_bytes = max_bytes
+        self.on_evict = on_evict
+        self.clock = clock
+        self.nbytes = 0
+        # session id -> _Conversation, least recently used first
+        self._conversations = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._conversations)
+
+    def turns(self, session_id):
+        """Return the cached turns of a conversation, oldest first."""
+        with self._lock:
+            self._evict_expired()
+            conversation = self._conversations.get(session_id)
+            return list(conversation.turns) if conversation else []
+
+    def add(self, session_id, turns):
+        """Append turns to a conversation, dropping the oldest beyond max_turns."""
+        with self._lock:
+            conversation = self._conversations.pop(session_id, None)
+            if conversation is None:
+                conversation = _Conversation(self.max_turns)
+            for turn in turns:
+                if len(conversation.turns) == conversation.turns.maxlen:
+                    dropped = turn_bytes(conversation.turns[0])
+                    conversation.nbytes -= dropped
+                    self.nbytes -= dropped
+                conversation.turns.append(turn)
+                conversation.nbytes += turn_bytes(turn)
+                self.nbytes += turn_bytes(turn)
+            conversation.last_used = self.clock()
+            self._conversations[session_id] = conversation
+            self._evict_expired()
+            while self.nbytes > self.max_bytes and self._conversations:
+                self._drop_oldest('memory')
+
+    def _evict_expired(self):
+        deadline = self.clock() - self.ttl_secs
+        while (self._conversations and
+               next(iter(self._conversations.values())).last_used < deadline):
+            self._drop_oldest('ttl')
+
+    def _drop_oldest(self, reason):
+        _, conversation = self._conversations.popitem(last=False)
+        self.nbytes -= conversation.nbytes
+        if self.on_evict is not None:
+            self.on_evict(reason)
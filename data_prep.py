@@ -7,7 +7,8 @@ from nltk.tokenize import word_tokenize
 import matplotlib.pyplot as plt
 import pandas as pd
 import seaborn
-import json
+
+import pair_io
 
 NOT_LOWERCASE = re.compile(r'^[^a-z]+$')
 
@@ -226,15 +227,8 @@ def read_ced(data_dir):
     return dialogue_pairs
 
 def write_datafiles(dialogue_pairs):
-    with open('data/input_data.json', 'w') as wi:
-        with open('data/output_data.json', 'w') as wo:
-            for pair in dialogue_pairs:
-                itext = {'text': pair[0]}
-                otext = {'text': pair[1]}
-                json.dump(itext, wi)
-                wi.write('\n')
-                json.dump(otext, wo)
-                wo.write('\n')
+    pair_io.write_pairs('data/input_data.json', 'data/output_data.json',
+                        dialogue_pairs)
 
 #quick wordcount
 def wordcount(dialogue_pairs):
@@ -0,0 +1,84 @@
+# Early Modern English dialogue generation, by Erika Varis Doggett
+
+# Python 3
+# ==============================================================================
+
+"""The seeded stream of training batches.
+
+Each training step picks a bucket at random in proportion to its number of
+pairs, then a batch from that bucket: uniformly at random, or the next
+length-grouped batch (see batch_sampler). A DataStream makes all of these
+choices with one random.Random, so with a seed the stream is the same in
+every run, and position counts the batches drawn so far; a run stopped
+after n batches is continued exactly by a stream with the same seed that
+skips n batches, which only replays the random choices. Without a seed,
+the stream draws one, so that state() can always be resumed.
+"""
+
+import random
+
+from six.moves import xrange  # pylint: disable=redefined-builtin
+
+import batch_sampler
+
+
+class DataStream(object):
+  """Chooses the bucket and the pairs of each training batch."""
+
+  def __init__(self, data_set, batch_size, seed=None, length_grouped=False):
+    """Create the stream.
+
+    Args:
+      data_set: a list with one PairStore or list of (source, target) pairs
+        per bucket, as returned by dialogue.read_data.
+      batch_size: number of pairs per batch.
+      seed: seed of the choices; None draws a new one.
+      length_grouped: serve length-grouped batches instead of random ones.
+    """
+    self.data_set = data_set
+    self.batch_size = batch_size
+    if seed is None:
+      seed = random.SystemRandom().randrange(1 << 32)
+    self.seed = seed
+    self.rng = random.Random(seed)
+    self.position = 0
+    # A bucket scale is a list of increasing numbers from 0 to 1 that we'll
+    # use to select a bucket. Length of [scale[i], scale[i+1]] is
+    # proportional to the size if i-th bucket.
+    sizes = [len(pairs) for pairs in data_set]
+    total = float(sum(sizes))
+    self.buckets_scale = [sum(sizes[:i + 1]) / total
+                          for i in xrange(len(sizes))]
+    self.sampler = None
+    if length_grouped:
+      self.sampler = batch_sampler.LengthGroupedSampler(
+          data_set, batch_size, random.Random(self.rng.getrandbits(64)))
+
+  def _next_indices(self):
+    """Choose the next bucket and the indices of the batch's pairs in it."""
+    random_number_01 = self.rng.random()
+    bucket_id = min(i for i in xrange(len(self.buckets_scale))
+                    if self.buckets_scale[i] > random_number_01)
+    if self.sampler is not None:
+      indices = self.sampler.next_indices(bucket_id)
+    else:
+      size = len(self.data_set[bucket_id])
+      indices = [int(self.rng.random() * size)
+                 for _ in xrange(self.batch_size)]
+    self.position += 1
+    return bucket_id, indices
+
+  def next_batch(self):
+    """Return the bucket id and the (source, target) pairs of the next batch."""
+    bucket_id, indices = self._next_indices()
+    pairs = self.data_set[bucket_id]
+    return bucket_id, [pairs[i] for i in indices]
+
+  def skip(self, count):
+    """Advance the stream by count batches without reading their pairs."""
+    for _ in xrange(count):
+      self._next_indices()
+
+  def state(self):
+    """Return the seed and position, to resume the stream with skip()."""
+    return {"seed": self.seed, "position": self.position}
@@ -6,9 +6,12 @@
 
 """Utilities for parsing Early Modern Dialogue data, tokenizing, vocabularies."""
 
+import itertools
+import multiprocessing
 import os
 import re
 import tarfile
+import time
 
 from six.moves import urllib
 
@@ -16,8 +19,9 @@ from tensorflow.python.platform import gfile
 import tensorflow as tf
 
 from nltk.tokenize import word_tokenize
-import json
 import data_prep
+import dedup
+import pair_io
 import random
 
 # Special vocabulary symbols - we always put them at the start.
@@ -57,7 +61,8 @@ def create_vocabulary(vocabulary_path, data_path, max_vocabulary_size,
 
   Args:
     vocabulary_path: path where the vocabulary will be created.
-    data_path: data file that will be used to create vocabulary.
+    data_path: data file that will be used to create vocabulary, or a list
+      of data files to build one vocabulary from.
     max_vocabulary_size: limit on the size of the created vocabulary.
     tokenizer: a function to use to tokenize each data sentence;
       if None, basic_tokenizer will be used.
@@ -66,15 +71,13 @@ def create_vocabulary(vocabulary_path, data_path, max_vocabulary_size,
   if not gfile.Exists(vocabulary_path):
     print("Creating vocabulary %s from data %s" % (vocabulary_path, data_path))
     vocab = {}
-    with gfile.GFile(data_path, mode="rb") as f:
-      counter = 0
-      for line in f:
+    data_paths = [data_path] if isinstance(data_path, str) else data_path
+    counter = 0
+    for data_path in data_paths:
+      for text in pair_io.read_texts(data_path):
         counter += 1
         if counter % 100000 == 0:
           print("  processing line %d" % counter)
-        line = tf.compat.as_str(line)
-        line_d = json.loads(line)
-        text = line_d['text']
         tokens = word_tokenize(text)
         for w in tokens:
           w = w.encode('utf-8') #I guess I'm using bytes :-P
@@ -83,12 +86,12 @@ def create_vocabulary(vocabulary_path, data_path, max_vocabulary_size,
             vocab[word] += 1
           else:
             vocab[word] = 1
-      vocab_list = _START_VOCAB + sorted(vocab, key=vocab.get, reverse=True)
-      if len(vocab_list) > max_vocabulary_size:
-        vocab_list = vocab_list[:max_vocabulary_size]
-      with gfile.GFile(vocabulary_path, mode="wb") as vocab_file:
-        for w in vocab_list:
-          vocab_file.write(w + b"\n")
+    vocab_list = _START_VOCAB + sorted(vocab, key=vocab.get, reverse=True)
+    if len(vocab_list) > max_vocabulary_size:
+      vocab_list = vocab_list[:max_vocabulary_size]
+    with gfile.GFile(vocabulary_path, mode="wb") as vocab_file:
+      for w in vocab_list:
+        vocab_file.write(w + b"\n")
 
 
 def initialize_vocabulary(vocabulary_path):
@@ -165,24 +168,116 @@ def data_to_token_ids(data_path, target_path, vocabulary_path,
       if None, basic_tokenizer will be used.
     normalize_digits: Boolean; if true, all digits are replaced by 0s.
   """
-  if not gfile.Exists(target_path):
-    print("Tokenizing data in %s" % data_path)
-    vocab, _ = initialize_vocabulary(vocabulary_path)
-    with gfile.GFile(data_path, mode="r") as data_file:
-      with gfile.GFile(target_path, mode="w") as tokens_file:
-        counter = 0
-        for line in data_file:
-          counter += 1
-          if counter % 100000 == 0:
-            print("  tokenizing line %d" % counter)
-          line = tf.compat.as_str(line)
-          sentence = json.loads(line)['text']
-          token_ids = sentence_to_token_ids(sentence, vocab,
-                                            normalize_digits)
-          tokens_file.write(" ".join([str(tok) for tok in token_ids]) + "\n")
-
-
-def prepare_emd_data(data_dir, train_dir, vocabulary_size=55000):
+  data_files_to_token_ids([(data_path, target_path, vocabulary_path)],
+                          normalize_digits)
+
+
+_tokenizer_vocabularies = None
+_tokenizer_normalize_digits = True
+
+
+def _init_tokenizer(vocabularies, normalize_digits):
+  global _tokenizer_vocabularies, _tokenizer_normalize_digits
+  _tokenizer_vocabularies = vocabularies
+  _tokenizer_normalize_digits = normalize_digits
+
+
+def _tokenize_lines(task):
+  """Token-ids of a chunk of data file lines, as the lines of an ids file."""
+  index, vocabulary_path, lines = task
+  vocab = _tokenizer_vocabularies[vocabulary_path]
+  ids_lines = []
+  for line in lines:
+    sentence = pair_io.parse_text(line)
+    token_ids = sentence_to_token_ids(sentence, vocab,
+                                      _tokenizer_normalize_digits)
+    ids_lines.append(" ".join([str(tok) for tok in token_ids]) + "\n")
+  return index, len(lines), "".join(ids_lines)
+
+
+def _tokenize_tasks(files, chunk_lines):
+  """Yield (file index, vocabulary path, lines) chunks of all files."""
+  for index, (data_path, _, vocabulary_path) in enumerate(files):
+    with pair_io.open_file(data_path) as data_file:
+      while True:
+        lines = list(itertools.islice(data_file, chunk_lines))
+        if not lines:
+          break
+        yield index, vocabulary_path, lines
+
+
+def data_files_to_token_ids(files, normalize_digits=True, workers=None,
+                            chunk_lines=2000):
+  """Tokenize several data files in parallel, see data_to_token_ids.
+
+  Each vocabulary is loaded once and handed to a pool of worker processes,
+  which tokenize chunks of chunk_lines lines; the chunks of all files go
+  through the pool in one stream, a few per worker at a time, and are
+  written back in order. An ids file is written under a temporary name and
+  renamed when complete, so an interrupted run does not leave a partial one
+  behind.
+
+  Args:
+    files: list of (data_path, target_path, vocabulary_path) triples; those
+      whose target_path exists are skipped.
+    normalize_digits: Boolean; if true, all digits are replaced by 0s.
+    workers: number of processes; defaults to the number of CPUs.
+    chunk_lines: lines per task sent to a worker.
+  """
+  files = [f for f in files if not gfile.Exists(f[1])]
+  if not files:
+    return
+  vocabularies = {}
+  for _, _, vocabulary_path in files:
+    if vocabulary_path not in vocabularies:
+      vocabularies[vocabulary_path], _ = initialize_vocabulary(vocabulary_path)
+
+  workers = workers or multiprocessing.cpu_count()
+  tasks = _tokenize_tasks(files, chunk_lines)
+  pool = multiprocessing.Pool(workers, initializer=_init_tokenizer,
+                              initargs=(vocabularies, normalize_digits))
+  current, tokens_file = None, None
+  try:
+    while True:
+      # A bounded window of chunks, so files are not read ahead into memory.
+      window = list(itertools.islice(tasks, 4 * workers))
+      if not window:
+        break
+      for index, count, ids_lines in pool.imap(_tokenize_lines, window):
+        if index != current:
+          if tokens_file is not None:
+            _finish_ids_file(tokens_file, files[current][1], counter, start)
+          current = index
+          print("Tokenizing data in %s" % files[index][0])
+          tokens_file = pair_io.open_file(files[index][1] + ".tmp", "w")
+          counter, start = 0, time.time()
+          last_report = start
+        tokens_file.write(ids_lines)
+        counter += count
+        if time.time() - last_report >= 10:
+          last_report = time.time()
+          print("  tokenized %d lines (%.0f lines/sec)"
+                % (counter, counter / (last_report - start)))
+    if tokens_file is not None:
+      _finish_ids_file(tokens_file, files[current][1], counter, start)
+  finally:
+    pool.terminate()
+  # Empty data files have no chunks; give them empty ids files.
+  for _, target_path, _ in files:
+    if not gfile.Exists(target_path):
+      pair_io.open_file(target_path, "w").close()
+
+
+def _finish_ids_file(tokens_file, target_path, counter, start):
+  tokens_file.close()
+  os.rename(target_path + ".tmp", target_path)
+  print("  tokenized %d lines (%.0f lines/sec)"
+        % (counter, counter / max(time.time() - start, 1e-6)))
+
+
+def prepare_emd_data(data_dir, train_dir, vocabulary_size=55000,
+                     shared_vocabulary=False, dedup_threshold=0.8,
+                     seed=None):
   """Get Early Modern Dialogue data into data_dir, create vocabularies and tokenize data.
 
   Args:
@@ -191,6 +286,13 @@ def prepare_emd_data(data_dir, train_dir, vocabulary_size=55000):
     fr_vocabulary_size: size of the French vocabulary to create and use.
     tokenizer: a function to use to tokenize each data sentence;
       if None, basic_tokenizer will be used.
+    shared_vocabulary: see prepare_data.
+    dedup_threshold: when the pairs are read from the CED and Shakespeare
+      texts, exact duplicates and pairs at least this similar to an earlier
+      one are dropped before the data files are written (see dedup.py);
+      1.0 only drops exact duplicates, None keeps every pair.
+    seed: seed of the random choice of the development pairs; None for a
+      different split in every run.
 
   Returns:
     A tuple of 6 elements:
@@ -201,52 +303,46 @@ def prepare_emd_data(data_dir, train_dir, vocabulary_size=55000):
       (5) path to the input vocabulary file,
       (6) path to the output vocabulary file.
   """
-  # read and prepare emd data from txt files
-  if not gfile.Exists(data_dir+'/input_data.json') and not gfile.Exists(data_dir+'/output_data.json'):
+  # read and prepare emd data from txt files (the data files may also have
+  # been written compressed, e.g. by dedup.py --compress)
+  input_data_path = pair_io.existing_path(data_dir+'/input_data.json')
+  output_data_path = pair_io.existing_path(data_dir+'/output_data.json')
+  if not gfile.Exists(input_data_path) and not gfile.Exists(output_data_path):
       dialogue_pairs = data_prep.read_ced(data_dir)
       dialogue_pairs.extend(data_prep.read_shakespeare(data_dir))
+      if dedup_threshold is not None:
+        dialogue_pairs = dedup.deduplicate(dialogue_pairs,
+                                           threshold=dedup_threshold)
       data_prep.write_datafiles(dialogue_pairs)
       input_data = [pair[0] for pair in dialogue_pairs]
       output_data = [pair[1] for pair in dialogue_pairs]
   else:
     #read data files
-    with open(data_dir+'/input_data.json', 'r') as f:
-        input_data = [json.loads(line) for line in f]
-    with open(data_dir+'/output_data.json', 'r') as f:
-        output_data = [json.loads(line) for line in f]
+    input_data = list(pair_io.read_texts(input_data_path))
+    output_data = list(pair_io.read_texts(output_data_path))
 
   indices = range(0, len(input_data))
-  dev = random.sample(indices, round(len(input_data)*.1))
+  dev = set(random.Random(seed).sample(indices, round(len(input_data)*.1)))
   # writing new data files into train_dir, not data_dir, to allow for 
   # permissions issues when reading from external drive
   if not gfile.Exists(train_dir):
     os.mkdir(train_dir)
-  with open(train_dir+'/input_data_training.json', 'w') as from_train:
-    with open(train_dir+'/output_data_training.json', 'w') as to_train:
-        with open(train_dir+'/input_data_dev.json', 'w') as from_dev:
-            with open(train_dir+'/output_data_dev.json', 'w') as to_dev:
-                for i in indices:
-                    if i not in dev:
-                        json.dump(input_data[i], from_train)
-                        from_train.write('\n')
-                        json.dump(output_data[i], to_train)
-                        to_train.write('\n')
-                    else:
-                        json.dump(input_data[i], from_dev)
-                        from_dev.write('\n')
-                        json.dump(output_data[i], to_dev)
-                        to_dev.write('\n')
-
-  # Get emd data to the specified directory.
   from_train_path = train_dir+'/input_data_training.json'
   to_train_path = train_dir+'/output_data_training.json'
   from_dev_path = train_dir+'/input_data_dev.json'
   to_dev_path = train_dir+'/output_data_dev.json'
+  with pair_io.PairWriter(from_train_path, to_train_path) as train_writer:
+    with pair_io.PairWriter(from_dev_path, to_dev_path) as dev_writer:
+      for i in indices:
+        writer = dev_writer if i in dev else train_writer
+        writer.write(input_data[i], output_data[i])
 
-  return prepare_data(train_dir, from_train_path, to_train_path, from_dev_path, to_dev_path, vocabulary_size=vocabulary_size)
+  return prepare_data(train_dir, from_train_path, to_train_path, from_dev_path, to_dev_path, vocabulary_size=vocabulary_size,
+                      shared_vocabulary=shared_vocabulary)
 
 
-def prepare_data(data_dir, from_train_path, to_train_path, from_dev_path, to_dev_path, vocabulary_size=55000):
+def prepare_data(data_dir, from_train_path, to_train_path, from_dev_path, to_dev_path, vocabulary_size=55000,
+                 shared_vocabulary=False, workers=None):
   """Preapre all necessary files that are required for the training.
 
     Args:
@@ -259,6 +355,12 @@ def prepare_data(data_dir, from_train_path, to_train_path, from_dev_path, to_dev
       to_vocabulary_size: size of the "to language" vocabulary to create and use.
       tokenizer: a function to use to tokenize each data sentence;
         if None, basic_tokenizer will be used.
+      shared_vocabulary: if set, build one vocabulary from both sides of the
+        training data and write it as both the "from" and "to" vocabulary,
+        as needed for a model with tied embeddings. Vocabulary files that
+        already exist are kept.
+      workers: number of tokenizer processes; defaults to the number of
+        CPUs.
 
     Returns:
       A tuple of 6 elements:
@@ -276,20 +378,26 @@ def prepare_data(data_dir, from_train_path, to_train_path, from_dev_path, to_dev
 
   to_vocab_path = os.path.join(data_dir, "vocab%d.to" % to_vocabulary_size)
   from_vocab_path = os.path.join(data_dir, "vocab%d.from" % from_vocabulary_size)
-  create_vocabulary(to_vocab_path, to_train_path , to_vocabulary_size)
-  create_vocabulary(from_vocab_path, from_train_path , from_vocabulary_size)
+  if shared_vocabulary:
+    create_vocabulary(from_vocab_path, [from_train_path, to_train_path],
+                      from_vocabulary_size)
+    if not gfile.Exists(to_vocab_path):
+      gfile.Copy(from_vocab_path, to_vocab_path)
+  else:
+    create_vocabulary(to_vocab_path, to_train_path , to_vocabulary_size)
+    create_vocabulary(from_vocab_path, from_train_path , from_vocabulary_size)
 
-  # Create token ids for the training data.
+  # Create token ids for the training and development data, in parallel.
   to_train_ids_path = to_train_path + (".ids%d" % to_vocabulary_size)
   from_train_ids_path = from_train_path + (".ids%d" % from_vocabulary_size)
-  data_to_token_ids(to_train_path, to_train_ids_path, to_vocab_path)
-  data_to_token_ids(from_train_path, from_train_ids_path, from_vocab_path)
-
-  # Create token ids for the development data.
   to_dev_ids_path = to_dev_path + (".ids%d" % to_vocabulary_size)
   from_dev_ids_path = from_dev_path + (".ids%d" % from_vocabulary_size)
-  data_to_token_ids(to_dev_path, to_dev_ids_path, to_vocab_path)
-  data_to_token_ids(from_dev_path, from_dev_ids_path, from_vocab_path)
+  data_files_to_token_ids([
+      (to_train_path, to_train_ids_path, to_vocab_path),
+      (from_train_path, from_train_ids_path, from_vocab_path),
+      (to_dev_path, to_dev_ids_path, to_vocab_path),
+      (from_dev_path, from_dev_ids_path, from_vocab_path)],
+      workers=workers)
 
   return (from_train_ids_path, to_train_ids_path,
           from_dev_ids_path, to_dev_ids_path,
@@ -0,0 +1,263 @@
+# Early Modern English dialogue generation, by Erika Varis Doggett
+
+# Python 3
+# ==============================================================================
+
+"""Removal of duplicate and near-duplicate dialogue pairs.
+
+The CED and Shakespeare readers produce many pairs that are the same or
+nearly the same (refrains, repeated speaker cues, boilerplate), and each of
+them costs training time. A Deduplicator drops, in one pass over the pairs:
+
+  empty: pairs with no word on either side.
+  exact: pairs whose normalized words (lower case, digits as 0) are the
+    same as those of an earlier pair.
+  near: pairs whose MinHash signature, over the word n-grams of both
+    sides, shares an LSH band with an earlier pair; these are pairs whose
+    n-gram sets have a Jaccard similarity of roughly threshold or more.
+
+Only 64-bit hashes are kept, in fixed-size open-addressing tables (about
+16 bytes per pair for the exact rule and 16 per band for the near rule), so
+memory is bounded by capacity however many pairs are read; once capacity
+pairs have been kept, further pairs are still checked but no longer added.
+
+prepare_emd_data deduplicates newly read pairs before writing the data
+files; for data files written before, run
+python3 dedup.py --data_dir=data --output_dir=data/dedup
+"""
+
+import argparse
+import collections
+import hashlib
+import os
+import re
+import zlib
+
+import numpy as np
+
+import pair_io
+
+
+_WORD_RE = re.compile(r"\w+|[^\w\s]", re.UNICODE)
+_DIGIT_RE = re.compile(r"\d")
+# Prime modulus of the MinHash permutations.
+_PRIME = (1 << 61) - 1
+
+RULES = ("empty", "exact", "near")
+
+
+def normalize(text):
+  """Return the lower-cased words of text, with digits replaced by 0."""
+  return _WORD_RE.findall(_DIGIT_RE.sub("0", text.lower()))
+
+
+def _hash64(data):
+  """A 64-bit hash of bytes, never 0 (the empty slot marker)."""
+  key = int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(),
+                       "little")
+  return key or 1
+
+
+def _table_size(count):
+  """Smallest power of two with a load factor of at most one half."""
+  size = 1
+  while size < 2 * count:
+    size *= 2
+  return size
+
+
+class HashSet(object):
+  """Fixed-size set of 64-bit hashes with linear probing."""
+
+  def __init__(self, capacity):
+    self.capacity = capacity
+    self._table = np.zeros(_table_size(capacity), dtype=np.uint64)
+    self._mask = len(self._table) - 1
+    self.size = 0
+
+  def _slot(self, key):
+    slot = key & self._mask
+    while True:
+      stored = int(self._table[slot])
+      if stored == 0 or stored == key:
+        return slot
+      slot = (slot + 1) & self._mask
+
+  def __contains__(self, key):
+    return int(self._table[self._slot(key)]) == key
+
+  def add(self, key):
+    """Add key unless the set is full; return whether key is in the set."""
+    slot = self._slot(key)
+    if int(self._table[slot]) == key:
+      return True
+    if self.size >= self.capacity:
+      return False
+    self._table[slot] = key
+    self.size += 1
+    return True
+
+  @property
+  def nbytes(self):
+    return self._table.nbytes
+
+
+def lsh_bands(num_perm, threshold):
+  """Return the number of bands whose LSH threshold is closest to threshold.
+
+  With b bands of r = num_perm / b rows, pairs with Jaccard similarity s
+  share a band with probability 1 - (1 - s^r)^b, which rises steeply around
+  s = (1 / b)^(1 / r).
+  """
+  divisors = [b for b in range(1, num_perm + 1) if num_perm % b == 0]
+  return min(divisors, key=lambda b: abs((1.0 / b) ** (b / float(num_perm))
+                                         - threshold))
+
+
+class Deduplicator(object):
+  """Streaming filter of duplicate and near-duplicate pairs."""
+
+  def __init__(self, threshold=0.8, num_perm=64, ngram=2, capacity=1 << 20,
+               seed=1):
+    """Create the filter.
+
+    Args:
+      threshold: approximate Jaccard similarity of the word n-grams above
+        which pairs count as near duplicates; 1.0 disables the near rule.
+      num_perm: number of MinHash permutations (signature length).
+      ngram: length of the word n-grams compared by the near rule.
+      capacity: maximum number of pairs remembered.
+      seed: seed of the MinHash permutations.
+    """
+    self.threshold = threshold
+    self.ngram = ngram
+    self.num_perm = num_perm
+    self.bands = lsh_bands(num_perm, threshold)
+    self.rows = num_perm // self.bands
+    random = np.random.RandomState(seed)
+    self._a = random.randint(1, _PRIME, size=num_perm, dtype=np.uint64)
+    self._b = random.randint(0, _PRIME, size=num_perm, dtype=np.uint64)
+    self._exact = HashSet(capacity)
+    self._near = HashSet(capacity * self.bands) if threshold < 1 else None
+    # rule name -> number of pairs it removed, and "kept"
+    self.counts = collections.Counter()
+
+  def _signature(self, sides):
+    """MinHash signature of the word n-grams of both sides of a pair."""
+    shingles = set()
+    for side, words in enumerate(sides):
+      if len(words) <= self.ngram:
+        shingles.add((side,) + tuple(words))
+      else:
+        shingles.update((side,) + tuple(words[i:i + self.ngram])
+                        for i in range(len(words) - self.ngram + 1))
+    hashes = np.array([zlib.crc32("\x00".join(map(str, s)).encode("utf-8"))
+                       for s in shingles], dtype=np.uint64)
+    # Permutations (a * h + b) mod p, computed modulo 2^64 first as usual
+    # for MinHash, and kept to 32 bits.
+    with np.errstate(over="ignore"):
+      permuted = (np.outer(hashes, self._a) + self._b) % np.uint64(_PRIME)
+    return (permuted & np.uint64(0xffffffff)).astype(np.uint32).min(axis=0)
+
+  def _band_keys(self, signature):
+    return [_hash64(bytes([band]) +
+                    signature[band * self.rows:(band + 1) * self.rows]
+                    .tobytes())
+            for band in range(self.bands)]
+
+  def keep(self, pair):
+    """Return whether to keep an (input text, output text) pair."""
+    sides = [normalize(text) for text in pair]
+    if not sides[0] and not sides[1]:
+      self.counts["empty"] += 1
+      return False
+    exact_key = _hash64("\n".join(" ".join(words) for words in sides)
+                        .encode("utf-8"))
+    if exact_key in self._exact:
+      self.counts["exact"] += 1
+      return False
+    if self._near is not None:
+      band_keys = self._band_keys(self._signature(sides))
+      if any(key in self._near for key in band_keys):
+        self.counts["near"] += 1
+        return False
+    if not self._exact.add(exact_key):
+      self.counts["unindexed"] += 1
+    elif self._near is not None:
+      for key in band_keys:
+        self._near.add(key)
+    self.counts["kept"] += 1
+    return True
+
+  def filter(self, pairs):
+    """Yield the pairs to keep, in order."""
+    for pair in pairs:
+      if self.keep(pair):
+        yield pair
+
+  @property
+  def nbytes(self):
+    """Memory held by the hash tables."""
+    return self._exact.nbytes + (self._near.nbytes if self._near else 0)
+
+  def report(self):
+    """Return a one-line summary of the pairs kept and removed per rule."""
+    total = sum(self.counts[rule] for rule in RULES) + self.counts["kept"]
+    parts = ["%d of %d pairs kept" % (self.counts["kept"], total)]
+    parts.extend("%d %s" % (self.counts[rule], rule) for rule in RULES)
+    if self.counts["unindexed"]:
+      parts.append("%d kept but not remembered (capacity %d)"
+                   % (self.counts["unindexed"], self._exact.capacity))
+    parts.append("%.1f MB of hashes" % (self.nbytes / float(1 << 20)))
+    return ", ".join(parts)
+
+
+def deduplicate(pairs, **kwargs):
+  """Return the pairs (a list) without duplicates, printing the counts.
+
+  Keyword arguments are passed to Deduplicator; capacity defaults to the
+  number of pairs.
+  """
+  kwargs.setdefault("capacity", max(len(pairs), 1))
+  deduplicator = Deduplicator(**kwargs)
+  kept = list(deduplicator.filter(pairs))
+  print("Deduplication: " + deduplicator.report())
+  return kept
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+  parser.add_argument("--data_dir", default="data",
+                      help="directory with input_data.json and "
+                           "output_data.json")
+  parser.add_argument("--output_dir", required=True,
+                      help="directory to write the deduplicated files to")
+  parser.add_argument("--threshold", type=float, default=0.8,
+                      help="Jaccard similarity for near duplicates; 1.0 "
+                           "only removes exact duplicates")
+  parser.add_argument("--capacity", type=int, default=1 << 22,
+                      help="maximum number of pairs remembered")
+  parser.add_argument("--compress", action="store_true",
+                      help="write gzip-compressed files (.json.gz)")
+  args = parser.parse_args()
+
+  deduplicator = Deduplicator(threshold=args.threshold,
+                              capacity=args.capacity)
+  if not os.path.exists(args.output_dir):
+    os.makedirs(args.output_dir)
+  suffix = pair_io.COMPRESSED_SUFFIX if args.compress else ""
+  pairs = pair_io.read_pairs(
+      os.path.join(args.data_dir, "input_data.json"),
+      os.path.join(args.data_dir, "output_data.json"))
+  with pair_io.PairWriter(
+      os.path.join(args.output_dir, "input_data.json" + suffix),
+      os.path.join(args.output_dir, "output_data.json" + suffix)) as writer:
+    for input_text, output_text in deduplicator.filter(pairs):
+      writer.write(input_text, output_text)
+      if writer.count % 100000 == 0:
+        print("  kept %d pairs" % writer.count)
+  print(deduplicator.report())
+
+
+if __name__ == "__main__":
+  main()
@@ -22,6 +22,7 @@ See the following papers for more information on neural translation models.
 import math
 import os
 import random
+import subprocess
 import sys
 import time
 import logging
@@ -30,8 +31,22 @@ import numpy as np
 from six.moves import xrange  # pylint: disable=redefined-builtin
 import tensorflow as tf
 
+import batch_sampler
+import bulk_decode
+import bucket_config
+import checkpoint_writer
+import data_stream
 import data_utils
+import evaluation
+import overflow_policy
+import pair_store
+import reranking
+import sampling
 import seq2seq_model
+import step_profiler
+import training_state
+import training_telemetry
+import vocabulary
 
 
 tf.app.flags.DEFINE_float("learning_rate", 0.5, "Learning rate.")
@@ -41,9 +56,30 @@ tf.app.flags.DEFINE_float("max_gradient_norm", 5.0,
                           "Clip gradients to this norm.")
 tf.app.flags.DEFINE_integer("batch_size", 64,
                             "Batch size to use during training.")
+tf.app.flags.DEFINE_integer("accumulation_steps", 1,
+                            "Accumulate gradients over this many batches "
+                            "before each update.")
+tf.app.flags.DEFINE_boolean("per_bucket_accumulators", False,
+                            "Keep separate gradient accumulators per bucket.")
+tf.app.flags.DEFINE_boolean("length_grouped_batches", False,
+                            "Form batches of similar-length pairs instead of "
+                            "sampling them at random within a bucket.")
+tf.app.flags.DEFINE_integer("seed", None,
+                            "Seed of the dev split, the TF graph and the "
+                            "order of the training batches, for reproducible "
+                            "runs.")
+tf.app.flags.DEFINE_integer("data_position", 0,
+                            "Skip this many batches of the training data "
+                            "stream, to continue a run with the same --seed "
+                            "where it stopped (default: the position saved "
+                            "with the restored checkpoint).")
 tf.app.flags.DEFINE_integer("size", 1024, "Size of each model layer.")
 tf.app.flags.DEFINE_integer("num_layers", 3, "Number of layers in the model.")
 tf.app.flags.DEFINE_integer("vocab_size", 55000, "Dialogue vocabulary size.")
+tf.app.flags.DEFINE_boolean("tie_embeddings", False,
+                            "Share one matrix between the encoder embedding, "
+                            "decoder embedding and output projection; the "
+                            "data is prepared with a single shared vocabulary.")
 tf.app.flags.DEFINE_integer("steps", 100000, "Number of steps to train.")
 tf.app.flags.DEFINE_string("data_dir", "/tmp", "Data directory")
 tf.app.flags.DEFINE_string("train_dir", "/tmp", "Training directory.")
@@ -51,23 +87,111 @@ tf.app.flags.DEFINE_string("from_train_data", None, "Training data.")
 tf.app.flags.DEFINE_string("to_train_data", None, "Training data.")
 tf.app.flags.DEFINE_string("from_dev_data", None, "Training data.")
 tf.app.flags.DEFINE_string("to_dev_data", None, "Training data.")
+tf.app.flags.DEFINE_string("from_dev_ids", None,
+                           "Token-ids of the dev inputs, for --evaluate.")
+tf.app.flags.DEFINE_string("to_dev_ids", None,
+                           "Token-ids of the dev outputs, for --evaluate.")
+tf.app.flags.DEFINE_float("dedup_threshold", 0.8,
+                          "When reading the EMD texts, drop exact duplicate "
+                          "pairs and pairs this similar to an earlier one "
+                          "(1.0: exact duplicates only, 0: keep all).")
 tf.app.flags.DEFINE_integer("max_train_data_size", 0,
                             "Limit on the size of training data (0: no limit).")
 tf.app.flags.DEFINE_integer("steps_per_checkpoint", 200,
                             "How many training steps to do per checkpoint.")
+tf.app.flags.DEFINE_integer("checkpoints_to_keep", 5,
+                            "How many recent checkpoints (and their training "
+                            "state files) to keep.")
+tf.app.flags.DEFINE_boolean("async_checkpoint", True,
+                            "Write checkpoints on a background thread.")
+tf.app.flags.DEFINE_string("dev_eval", "sample",
+                           "Dev set evaluation at each checkpoint: 'sample' "
+                           "(one random batch per bucket), 'full' (the whole "
+                           "dev set), 'process' (the whole dev set, in a "
+                           "separate --evaluate process) or 'none'.")
+tf.app.flags.DEFINE_integer("eval_batch_size", 256,
+                            "Batch size to use for full dev set evaluation.")
+tf.app.flags.DEFINE_integer("eval_interval_secs", 60,
+                            "How often --evaluate looks for a new checkpoint.")
+tf.app.flags.DEFINE_boolean("evaluate", False,
+                            "Set to True to evaluate each new checkpoint in "
+                            "train_dir on the full dev set.")
+tf.app.flags.DEFINE_string("buckets_file", None,
+                           "JSON file with the bucket sizes (default: "
+                           "buckets.json in train_dir, if present).")
+tf.app.flags.DEFINE_boolean("optimize_buckets", False,
+                            "Set to True to choose bucket sizes from the "
+                            "training token-ids and write them to "
+                            "buckets_file.")
+tf.app.flags.DEFINE_integer("max_buckets", 6,
+                            "Most buckets --optimize_buckets may choose.")
+tf.app.flags.DEFINE_float("bucket_graph_cost", 0.02,
+                          "Cost of each extra bucket for --optimize_buckets, "
+                          "as a fraction of the corpus tokens.")
+tf.app.flags.DEFINE_float("profile_fraction", 0.0,
+                          "Fraction of steps to trace op by op (0: none).")
+tf.app.flags.DEFINE_string("profile_dir", None,
+                           "Where to write step traces (default: "
+                           "train_dir/profile).")
+tf.app.flags.DEFINE_string("telemetry_dir", None,
+                           "Where to write per-step TensorBoard summaries and "
+                           "telemetry.jsonl (default: train_dir/telemetry).")
+tf.app.flags.DEFINE_boolean("telemetry", True,
+                            "Log per-step training metrics.")
 tf.app.flags.DEFINE_boolean("decode", False,
                             "Set to True for interactive decoding.")
+tf.app.flags.DEFINE_string("overflow_policy", "truncate_back",
+                           "What to do with inputs longer than the largest "
+                           "bucket when decoding: truncate_front, "
+                           "truncate_back, split or reject.")
+tf.app.flags.DEFINE_float("temperature", 0.0,
+                          "Sample replies at this temperature when decoding; "
+                          "0 for greedy replies.")
+tf.app.flags.DEFINE_integer("top_k", 0,
+                            "Sample among this many most likely tokens "
+                            "(0 for all).")
+tf.app.flags.DEFINE_float("top_p", 1.0,
+                          "Sample among the most likely tokens with this "
+                          "total probability.")
+tf.app.flags.DEFINE_integer("sample_seed", None,
+                            "Seed for reproducible sampled replies.")
+tf.app.flags.DEFINE_integer("rerank_candidates", 0,
+                            "With --temperature, sample this many replies "
+                            "and keep the best one, see reranking.py.")
+tf.app.flags.DEFINE_float("length_penalty", 0.6,
+                          "Length normalization exponent for reranking.")
+tf.app.flags.DEFINE_float("repetition_penalty", 1.0,
+                          "Weight of repeated word pairs for reranking.")
+tf.app.flags.DEFINE_string("decode_file", None,
+                           "Decode every prompt in this JSONL (\"text\" "
+                           "field) or text file, writing --decode_output.")
+tf.app.flags.DEFINE_string("decode_output", None,
+                           "JSONL file for --decode_file replies; an existing "
+                           "file is resumed (default: decode_file.replies).")
+tf.app.flags.DEFINE_integer("decode_batch_size", 256,
+                            "Prompts per batch with --decode_file.")
+tf.app.flags.DEFINE_integer("decode_chunk_size", 10000,
+                            "Prompts decoded and written at a time with "
+                            "--decode_file.")
+tf.app.flags.DEFINE_integer("decode_workers", 0,
+                            "Tokenizer processes for --decode_file "
+                            "(default: one per CPU).")
 tf.app.flags.DEFINE_boolean("self_test", False,
                             "Run a self-test if this is set to True.")
 tf.app.flags.DEFINE_boolean("use_fp16", False,
-                            "Train using fp16 instead of fp32.")
+                            "Train with mixed precision: fp16 compute, fp32 "
+                            "master weights and dynamic loss scaling.")
 tf.app.flags.DEFINE_boolean("existing_model", False, "Set to True for continued training or interactive decoding.")
 
 FLAGS = tf.app.flags.FLAGS
 
 # We use a number of buckets and pad to the closest one for efficiency.
-# See seq2seq_model.Seq2SeqModel for details of how they work.
-_buckets = [(7,8), (16,16), (25,24), (46,50)] # buckets manually identified after examining data
+# See seq2seq_model.Seq2SeqModel for details of how they work. They are
+# replaced in main() by those in buckets_file, if there is one.
+_buckets = list(bucket_config.DEFAULT_BUCKETS)
+
+# Values of --dev_eval.
+_DEV_EVAL_MODES = ("sample", "full", "process", "none")
 
 
 def read_data(source_path, target_path, max_size=None):
@@ -82,12 +206,13 @@ def read_data(source_path, target_path, max_size=None):
       if 0 or None, data files will be read completely (no limit).
 
   Returns:
-    data_set: a list of length len(_buckets); data_set[n] contains a list of
-      (source, target) pairs read from the provided data files that fit
-      into the n-th bucket, i.e., such that len(source) < _buckets[n][0] and
-      len(target) < _buckets[n][1]; source and target are lists of token-ids.
+    data_set: a list of length len(_buckets); data_set[n] is a
+      pair_store.PairStore of the (source, target) pairs read from the
+      provided data files that fit into the n-th bucket, i.e., such that
+      len(source) < _buckets[n][0] and len(target) < _buckets[n][1]; source
+      and target are lists of token-ids.
   """
-  data_set = [[] for _ in _buckets]
+  data_set = [pair_store.PairStore() for _ in _buckets]
   with tf.gfile.GFile(source_path, mode="r") as source_file:
     with tf.gfile.GFile(target_path, mode="r") as target_file:
       source, target = source_file.readline(), target_file.readline()
@@ -102,9 +227,10 @@ def read_data(source_path, target_path, max_size=None):
         target_ids.append(data_utils.EOS_ID)
         for bucket_id, (source_size, target_size) in enumerate(_buckets):
           if len(source_ids) < source_size and len(target_ids) < target_size:
-            data_set[bucket_id].append([source_ids, target_ids])
+            data_set[bucket_id].append(source_ids, target_ids)
             break
         source, target = source_file.readline(), target_file.readline()
+  print("  read " + pair_store.memory_report(data_set))
   return data_set
 
 
@@ -121,7 +247,20 @@ def create_model(session, forward_only):
       FLAGS.learning_rate,
       FLAGS.learning_rate_decay_factor,
       forward_only=forward_only,
-      dtype=dtype)
+      dtype=dtype,
+      accumulation_steps=FLAGS.accumulation_steps,
+      per_bucket_accumulators=FLAGS.per_bucket_accumulators,
+      tie_embeddings=FLAGS.tie_embeddings,
+      incremental_decoding=forward_only and FLAGS.temperature > 0,
+      rescoring=(forward_only and FLAGS.temperature > 0 and
+                 FLAGS.rerank_candidates > 1),
+      checkpoints_to_keep=FLAGS.checkpoints_to_keep)
+  if FLAGS.profile_fraction > 0:
+    model.profiler = step_profiler.StepProfiler(
+        FLAGS.profile_dir or os.path.join(FLAGS.train_dir, "profile"),
+        FLAGS.profile_fraction)
+  # Gradient accumulators are local variables and never checkpointed.
+  session.run(tf.local_variables_initializer())
   if FLAGS.existing_model:
     ckpt = tf.train.get_checkpoint_state(FLAGS.train_dir)
     print("Reading model parameters from %s" % ckpt.model_checkpoint_path)
@@ -133,6 +272,9 @@ def create_model(session, forward_only):
 
 def train():
   """Train a dialogue generation model using Early Modern Dialgoue data."""
+  if FLAGS.dev_eval not in _DEV_EVAL_MODES:
+    raise ValueError("--dev_eval must be one of %s, got %r."
+                     % (", ".join(_DEV_EVAL_MODES), FLAGS.dev_eval))
   from_train = None
   to_train = None
   from_dev = None
@@ -145,89 +287,276 @@ def train():
     if FLAGS.from_dev_data and FLAGS.to_dev_data:
       from_dev_data = FLAGS.from_dev_data
       to_dev_data = FLAGS.to_dev_data
-    from_train, to_train, from_dev, to_dev, _, _ = data_utils.prepare_data(
+    (from_train, to_train, from_dev, to_dev,
+     from_vocab, to_vocab) = data_utils.prepare_data(
         FLAGS.data_dir,
         from_train_data,
         to_train_data,
         from_dev_data,
         to_dev_data,
-        FLAGS.vocab_size)
+        FLAGS.vocab_size,
+        shared_vocabulary=FLAGS.tie_embeddings)
   else:
       # Prepare EMD data.
       print("Preparing EMD data from %s to %s" % (FLAGS.data_dir, FLAGS.train_dir))
-      from_train, to_train, from_dev, to_dev, _, _ = data_utils.prepare_emd_data(
-          FLAGS.data_dir, FLAGS.train_dir, FLAGS.vocab_size)
+      (from_train, to_train, from_dev, to_dev,
+       from_vocab, to_vocab) = data_utils.prepare_emd_data(
+          FLAGS.data_dir, FLAGS.train_dir, FLAGS.vocab_size,
+          shared_vocabulary=FLAGS.tie_embeddings,
+          dedup_threshold=FLAGS.dedup_threshold or None,
+          seed=FLAGS.seed)
+  # Memory-mapped vocabularies for decoding and the app.
+  vocabulary.write_binary_vocabulary(from_vocab)
+  vocabulary.write_binary_vocabulary(to_vocab)
+  if FLAGS.tie_embeddings and (data_utils.initialize_vocabulary(from_vocab)[1] !=
+                               data_utils.initialize_vocabulary(to_vocab)[1]):
+    raise ValueError("--tie_embeddings needs the same vocabulary on both "
+                     "sides, but %s and %s differ; remove them to build a "
+                     "shared one." % (from_vocab, to_vocab))
 
   with tf.Session() as sess:
+    if FLAGS.seed is not None:
+      tf.set_random_seed(FLAGS.seed)
     # Create model.
     print("Creating %d layers of %d units." % (FLAGS.num_layers, FLAGS.size))
+    if FLAGS.accumulation_steps > 1:
+      print("Accumulating gradients over %d batches (effective batch size %d)."
+            % (FLAGS.accumulation_steps,
+               FLAGS.accumulation_steps * FLAGS.batch_size))
     model = create_model(sess, False)
+    parameters = sum(np.prod(v.get_shape().as_list())
+                     for v in tf.trainable_variables())
+    print("Model has %d parameters (%.1f MB as float32)."
+          % (parameters, parameters * 4 / float(1 << 20)))
 
     # Read data into buckets and compute their sizes.
     print ("Reading development and training data (limit: %d)."
            % FLAGS.max_train_data_size)
     dev_set = read_data(from_dev, to_dev)
     train_set = read_data(from_train, to_train, FLAGS.max_train_data_size)
-    train_bucket_sizes = [len(train_set[b]) for b in xrange(len(_buckets))]
-    train_total_size = float(sum(train_bucket_sizes))
-
-    # A bucket scale is a list of increasing numbers from 0 to 1 that we'll use
-    # to select a bucket. Length of [scale[i], scale[i+1]] is proportional to
-    # the size if i-th training bucket, as used later.
-    train_buckets_scale = [sum(train_bucket_sizes[:i + 1]) / train_total_size
-                           for i in xrange(len(train_bucket_sizes))]
-
-    # This is the training loop.
-    step_time, loss = 0.0, 0.0
-    current_step = 0
-    previous_losses = []
-    
-    for e in range(FLAGS.steps):
-
-      # Choose a bucket according to data distribution. We pick a random number
-      # in [0, 1] and use the corresponding interval in train_buckets_scale.
-      random_number_01 = np.random.random_sample()
-      bucket_id = min([i for i in xrange(len(train_buckets_scale))
-                       if train_buckets_scale[i] > random_number_01])
-
-      # Get a batch and make a step.
-      start_time = time.time()
-      encoder_inputs, decoder_inputs, target_weights = model.get_batch(
-          train_set, bucket_id)
-      _, step_loss, _ = model.step(sess, encoder_inputs, decoder_inputs,
-                                   target_weights, bucket_id, False)
-      step_time += (time.time() - start_time) / FLAGS.steps_per_checkpoint
-      loss += step_loss / FLAGS.steps_per_checkpoint
-      current_step += 1
-
-      # Once in a while, we save checkpoint, print statistics, and run evals.
-      if current_step % FLAGS.steps_per_checkpoint == 0:
-        # Print statistics for the previous epoch.
-        perplexity = math.exp(float(loss)) if loss < 300 else float("inf")
-        print ("global step %d learning rate %.4f step-time %.2f perplexity "
-               "%.2f" % (model.global_step.eval(), model.learning_rate.eval(),
-                         step_time, perplexity))
-        # Decrease learning rate if no improvement was seen over last 3 times.
-        if len(previous_losses) > 2 and loss > max(previous_losses[-3:]):
-          sess.run(model.learning_rate_decay_op)
-        previous_losses.append(loss)
-        # Save checkpoint and zero timer and loss.
-        checkpoint_path = os.path.join(FLAGS.train_dir, "translate.ckpt")
-        model.saver.save(sess, checkpoint_path, global_step=model.global_step)
-        step_time, loss = 0.0, 0.0
-        # Run evals on development set and print their perplexity.
-        for bucket_id in xrange(len(_buckets)):
-          if len(dev_set[bucket_id]) == 0:
-            print("  eval: empty bucket %d" % (bucket_id))
-            continue
-          encoder_inputs, decoder_inputs, target_weights = model.get_batch(
-              dev_set, bucket_id)
-          _, eval_loss, _ = model.step(sess, encoder_inputs, decoder_inputs,
-                                       target_weights, bucket_id, True)
-          eval_ppx = math.exp(float(eval_loss)) if eval_loss < 300 else float(
-              "inf")
-          print("  eval: bucket %d perplexity %.2f" % (bucket_id, eval_ppx))
-        sys.stdout.flush()
+
+    if FLAGS.length_grouped_batches:
+      print("Padding of training batches:")
+      batch_sampler.padding_report(train_set, _buckets, FLAGS.batch_size,
+                                   random.Random(FLAGS.seed))
+    # The training loop state saved with the restored checkpoint, if any.
+    state = None
+    if FLAGS.existing_model:
+      state = training_state.load(
+          tf.train.get_checkpoint_state(FLAGS.train_dir).model_checkpoint_path)
+    seed, position = FLAGS.seed, FLAGS.data_position
+    if state is not None:
+      print("Resuming the training loop at step %d." % state["current_step"])
+      seed = state["data_stream"]["seed"]
+      position = position or state["data_stream"]["position"]
+
+    # The buckets and pairs of the training batches, and of the dev batches.
+    stream = data_stream.DataStream(train_set, FLAGS.batch_size, seed,
+                                    FLAGS.length_grouped_batches)
+    if position:
+      print("Skipping the first %d batches of the data stream." % position)
+      stream.skip(position)
+    dev_rng = random.Random(FLAGS.seed)
+
+    # Checkpoints are snapshotted into host memory and written in the
+    # background so that saving does not stall the training loop.
+    writer = None
+    if FLAGS.async_checkpoint:
+      writer = checkpoint_writer.AsyncCheckpointWriter(
+          tf.global_variables(), max_to_keep=FLAGS.checkpoints_to_keep)
+
+    # Evaluate on the full dev set in a separate process, which picks up each
+    # checkpoint as it is written.
+    evaluator = None
+    if FLAGS.dev_eval == "process":
+      evaluator = subprocess.Popen(
+          [sys.executable, os.path.abspath(__file__), "--evaluate=True",
+           "--from_dev_ids=%s" % from_dev, "--to_dev_ids=%s" % to_dev] +
+          [arg for arg in sys.argv[1:] if not arg.startswith("--dev_eval")])
+
+    try:
+      telemetry = None
+      if FLAGS.telemetry:
+        telemetry = training_telemetry.TelemetryWriter(
+            FLAGS.telemetry_dir or os.path.join(FLAGS.train_dir, "telemetry"))
+
+      # This is the training loop.
+      step_time, loss = 0.0, 0.0
+      current_step = 0
+      previous_losses = []
+      train_seconds = 0.0
+      if state is not None:
+        current_step = state["current_step"]
+        previous_losses = state["previous_losses"]
+        train_seconds = state["train_seconds"]
+
+      for e in range(FLAGS.steps):
+
+        # Get a batch, from a bucket chosen according to data distribution, and
+        # make a step.
+        start_time = time.time()
+        bucket_id, pairs = stream.next_batch()
+        encoder_inputs, decoder_inputs, target_weights = model.prepare_batch(
+            pairs, bucket_id)
+        batch_done_time = time.time()
+        gradient_norm, step_loss, _ = model.step(sess, encoder_inputs,
+                                                 decoder_inputs, target_weights,
+                                                 bucket_id, False)
+        end_time = time.time()
+        step_time += (end_time - start_time) / FLAGS.steps_per_checkpoint
+        train_seconds += end_time - start_time
+        loss += step_loss / FLAGS.steps_per_checkpoint
+        current_step += 1
+        if telemetry is not None:
+          telemetry.log_step(current_step, bucket_id, step_loss, gradient_norm,
+                             batch_done_time - start_time,
+                             end_time - batch_done_time,
+                             len(encoder_inputs[0]))
+
+        # Once in a while, we save checkpoint, print statistics, and run evals.
+        if current_step % FLAGS.steps_per_checkpoint == 0:
+          # Print statistics for the previous epoch.
+          perplexity = math.exp(float(loss)) if loss < 300 else float("inf")
+          print ("global step %d learning rate %.4f step-time %.2f perplexity "
+                 "%.2f data position %d"
+                 % (model.global_step.eval(), model.learning_rate.eval(),
+                    step_time, perplexity, stream.position))
+          # Decrease learning rate if no improvement was seen over last 3 times.
+          if len(previous_losses) > 2 and loss > max(previous_losses[-3:]):
+            sess.run(model.learning_rate_decay_op)
+          previous_losses.append(float(loss))
+          # Save checkpoint and zero timer and loss. The loop state is written
+          # first, under the name the checkpoint will have, so that whichever
+          # checkpoint is restored finds its own state.
+          checkpoint_path = os.path.join(FLAGS.train_dir, "translate.ckpt")
+          training_state.save(
+              "%s-%d" % (checkpoint_path, model.global_step.eval()),
+              {"current_step": current_step,
+               "previous_losses": previous_losses,
+               "train_seconds": train_seconds,
+               "data_stream": stream.state()})
+          training_state.prune(checkpoint_path, FLAGS.checkpoints_to_keep)
+          if writer is not None:
+            snapshot_time = writer.save(sess, checkpoint_path,
+                                        model.global_step)
+            print("  checkpoint snapshot took %.2fs" % snapshot_time)
+          else:
+            start_time = time.time()
+            model.saver.save(sess, checkpoint_path,
+                             global_step=model.global_step)
+            print("  checkpoint written in %.2fs" % (time.time() - start_time))
+          step_time, loss = 0.0, 0.0
+          if model.profiler is not None and model.profiler.traced:
+            print(model.profiler.summary())
+            model.profiler.write_summary()
+          # Run evals on development set and print their perplexity.
+          if FLAGS.dev_eval == "full":
+            bucket_stats, total = evaluation.evaluate(sess, model, dev_set,
+                                                      FLAGS.eval_batch_size)
+            evaluation.print_report(bucket_stats, total)
+          elif FLAGS.dev_eval == "sample":
+            for bucket_id in xrange(len(_buckets)):
+              if len(dev_set[bucket_id]) == 0:
+                print("  eval: empty bucket %d" % (bucket_id))
+                continue
+              encoder_inputs, decoder_inputs, target_weights = model.get_batch(
+                  dev_set, bucket_id, dev_rng)
+              _, eval_loss, _ = model.step(sess, encoder_inputs, decoder_inputs,
+                                           target_weights, bucket_id, True)
+              eval_ppx = (math.exp(float(eval_loss)) if eval_loss < 300
+                          else float("inf"))
+              print("  eval: bucket %d perplexity %.2f" % (bucket_id, eval_ppx))
+          sys.stdout.flush()
+
+      if telemetry is not None:
+        telemetry.close()
+        if telemetry.dropped:
+          print("Telemetry dropped %d step records." % telemetry.dropped)
+    finally:
+      # Stop the evaluator however training ends, so that it does not
+      # keep polling train_dir.
+      if evaluator is not None:
+        evaluator.terminate()
+        evaluator.wait()
+      # Wait for any checkpoint still queued in the background writer, which
+      # a daemon thread would otherwise drop when training fails.
+      if writer is not None:
+        writer.close()
+
+
+def evaluate():
+  """Evaluate each new checkpoint in train_dir on the full dev set."""
+  if FLAGS.from_dev_ids and FLAGS.to_dev_ids:
+    from_dev, to_dev = FLAGS.from_dev_ids, FLAGS.to_dev_ids
+  else:
+    # Where prepare_emd_data writes the dev token-ids.
+    from_dev = os.path.join(FLAGS.train_dir, "input_data_dev.json.ids%d"
+                            % FLAGS.vocab_size)
+    to_dev = os.path.join(FLAGS.train_dir, "output_data_dev.json.ids%d"
+                          % FLAGS.vocab_size)
+  print("Reading development data from %s." % from_dev)
+  dev_set = read_data(from_dev, to_dev)
+
+  while not tf.train.get_checkpoint_state(FLAGS.train_dir):
+    time.sleep(FLAGS.eval_interval_secs)
+
+  with tf.Session() as sess:
+    # The training graph (forward_only=False) feeds the reference outputs to
+    # the decoder; the forward-only graph would feed back its own argmaxes.
+    model = create_model(sess, False)
+    last_path = None
+    while True:
+      ckpt = tf.train.get_checkpoint_state(FLAGS.train_dir)
+      if ckpt.model_checkpoint_path != last_path:
+        last_path = ckpt.model_checkpoint_path
+        try:
+          model.saver.restore(sess, last_path)
+        except tf.errors.NotFoundError:
+          # Deleted by the trainer in the meantime; wait for the next one.
+          continue
+        print("Evaluating %s" % last_path)
+        start_time = time.time()
+        bucket_stats, total = evaluation.evaluate(sess, model, dev_set,
+                                                  FLAGS.eval_batch_size)
+        evaluation.print_report(bucket_stats, total)
+        print("  eval: took %.2fs" % (time.time() - start_time))
+      time.sleep(FLAGS.eval_interval_secs)
+
+
+def optimize_buckets():
+  """Choose bucket sizes for the training data and write them to a file."""
+  if FLAGS.from_train_data and FLAGS.to_train_data:
+    from_train = FLAGS.from_train_data + (".ids%d" % FLAGS.vocab_size)
+    to_train = FLAGS.to_train_data + (".ids%d" % FLAGS.vocab_size)
+  else:
+    # Where prepare_emd_data writes the training token-ids.
+    from_train = os.path.join(FLAGS.train_dir,
+                              "input_data_training.json.ids%d"
+                              % FLAGS.vocab_size)
+    to_train = os.path.join(FLAGS.train_dir,
+                            "output_data_training.json.ids%d"
+                            % FLAGS.vocab_size)
+  print("Reading lengths from %s and %s." % (from_train, to_train))
+  lengths = bucket_config.read_lengths(from_train, to_train)
+  buckets = bucket_config.optimize_buckets(
+      lengths, FLAGS.max_buckets, _buckets[-1], FLAGS.bucket_graph_cost)
+  bucket_config.print_report("Current", lengths, _buckets)
+  bucket_config.print_report("Optimized", lengths, buckets)
+  bucket_config.save_buckets(_buckets_file(), buckets)
+  print("Wrote buckets to %s" % _buckets_file())
+
+
+def _buckets_file():
+  return FLAGS.buckets_file or os.path.join(FLAGS.train_dir,
+                                            bucket_config.BUCKETS_FILE)
+
+
+def _sampler():
+  """The sampling.Sampler given by the flags, or None for greedy decoding."""
+  if FLAGS.temperature <= 0:
+    return None
+  return sampling.Sampler(FLAGS.temperature, FLAGS.top_k, FLAGS.top_p,
+                          FLAGS.sample_seed)
 
 
 def decode():
@@ -241,8 +570,14 @@ def decode():
                                  "vocab%d.from" % FLAGS.vocab_size)
     to_vocab_path = os.path.join(FLAGS.data_dir,
                                  "vocab%d.to" % FLAGS.vocab_size)
-    from_vocab, _ = data_utils.initialize_vocabulary(from_vocab_path)
-    _, rev_to_vocab = data_utils.initialize_vocabulary(to_vocab_path)
+    from_vocab = vocabulary.load_vocabulary(from_vocab_path)
+    rev_to_vocab = vocabulary.load_vocabulary(to_vocab_path)
+    overflow = overflow_policy.OverflowPolicy(FLAGS.overflow_policy, _buckets)
+    sampler = _sampler()
+    reranker = None
+    if sampler is not None and FLAGS.rerank_candidates > 1:
+      reranker = reranking.Reranker(model, FLAGS.length_penalty,
+                                    FLAGS.repetition_penalty)
 
     # Decode from standard input.
     sys.stdout.write("> ")
@@ -251,33 +586,68 @@ def decode():
     while sentence:
       # Get token-ids for the input sentence.
       token_ids = data_utils.sentence_to_token_ids(tf.compat.as_str(sentence), from_vocab)
-      # Which bucket does it belong to?
-      bucket_id = len(_buckets) - 1
-      for i, bucket in enumerate(_buckets):
-        if bucket[0] >= len(token_ids):
-          bucket_id = i
-          break
-      else:
-        logging.warning("Sentence truncated: %s", sentence)
-
-      # Get a 1-element batch to feed the sentence to the model.
-      encoder_inputs, decoder_inputs, target_weights = model.get_batch(
-          {bucket_id: [(token_ids, [])]}, bucket_id)
-      # Get output logits for the sentence.
-      _, _, output_logits = model.step(sess, encoder_inputs, decoder_inputs,
-                                       target_weights, bucket_id, True)
-      # This is a greedy decoder - outputs are just argmaxes of output_logits.
-      outputs = [int(np.argmax(logit, axis=1)) for logit in output_logits]
-      # If there is an EOS symbol in outputs, cut them at that point.
-      if data_utils.EOS_ID in outputs:
-        outputs = outputs[:outputs.index(data_utils.EOS_ID)]
-      # Print out French sentence corresponding to outputs.
-      print(" ".join([tf.compat.as_str(rev_to_vocab[output]) for output in outputs]))
+      # Which bucket does it belong to? Too long sentences are handled by
+      # the overflow policy.
+      try:
+        pieces = overflow.fit(token_ids)
+      except overflow_policy.InputTooLongError as e:
+        print("%s (%s)" % (e, e.code))
+        pieces = []
+      if pieces and reranker is not None:
+        bucket_id = max(piece_bucket for piece_bucket, _ in pieces)
+        # Sample several replies to each piece and keep the best.
+        outputs = []
+        for _, piece in pieces:
+          candidates = reranking.sample_candidates(
+              sess, model, piece, bucket_id, sampler, FLAGS.rerank_candidates)
+          outputs += reranker.best(sess, piece, candidates)
+        print(rev_to_vocab.decode(outputs))
+      elif pieces and sampler is not None:
+        bucket_id = max(piece_bucket for piece_bucket, _ in pieces)
+        # Decode step by step, feeding back the sampled tokens.
+        outputs = sum(model.sample_outputs(
+            sess, [piece for _, piece in pieces], bucket_id, sampler), [])
+        print(rev_to_vocab.decode(outputs))
+      elif pieces:
+        bucket_id = max(piece_bucket for piece_bucket, _ in pieces)
+
+        # Get a batch with one row per piece to feed the sentence to the model.
+        encoder_inputs, decoder_inputs, target_weights = model.prepare_batch(
+            [(piece, []) for _, piece in pieces], bucket_id)
+        # Get output logits for the sentence.
+        _, _, output_logits = model.step(sess, encoder_inputs, decoder_inputs,
+                                         target_weights, bucket_id, True)
+        # This is a greedy decoder - outputs are just argmaxes of
+        # output_logits, cut at EOS.
+        outputs = sum(seq2seq_model.greedy_outputs(output_logits), [])
+        # Print out the reply corresponding to outputs.
+        print(rev_to_vocab.decode(outputs))
       print("> ",end='')
       sys.stdout.flush()
       sentence = sys.stdin.readline()
 
 
+def decode_file():
+  """Decode a whole prompt file in large batches, see bulk_decode."""
+  from_vocab_path = os.path.join(FLAGS.data_dir,
+                                 "vocab%d.from" % FLAGS.vocab_size)
+  to_vocab_path = os.path.join(FLAGS.data_dir,
+                               "vocab%d.to" % FLAGS.vocab_size)
+  output_path = FLAGS.decode_output or FLAGS.decode_file + ".replies"
+  pool = bulk_decode.tokenizer_pool(from_vocab_path,
+                                    FLAGS.decode_workers or None)
+  with tf.Session() as sess:
+    model = create_model(sess, True)
+    overflow = overflow_policy.OverflowPolicy(FLAGS.overflow_policy, _buckets)
+    bulk_decode.decode_file(sess, model, pool, FLAGS.decode_file, output_path,
+                            vocabulary.load_vocabulary(to_vocab_path),
+                            overflow, FLAGS.decode_batch_size,
+                            FLAGS.decode_chunk_size, _sampler())
+  print("Replies written to %s" % output_path)
+  for policy, count in sorted(overflow.counts.items()):
+    print("  %d inputs too long for the largest bucket (%s)" % (count, policy))
+
+
 def self_test():
   """Test the translation model."""
   with tf.Session() as sess:
@@ -299,11 +669,21 @@ def self_test():
 
 
 def main(_):
+  global _buckets
+  _buckets = bucket_config.load_buckets(_buckets_file())
   if FLAGS.self_test:
     self_test()
   elif FLAGS.decode:
     FLAGS.existing_model = True
     decode()
+  elif FLAGS.decode_file:
+    FLAGS.existing_model = True
+    decode_file()
+  elif FLAGS.evaluate:
+    FLAGS.existing_model = True
+    evaluate()
+  elif FLAGS.optimize_buckets:
+    optimize_buckets()
   else:
     train()
 
@@ -0,0 +1,74 @@
+# Early Modern English dialogue generation, by Erika Varis Doggett
+
+# Python 3
+# ==============================================================================
+
+"""Full-pass evaluation of dialogue models on the development set.
+
+Every development pair is streamed through the model in large batches and
+the full-softmax cross entropy is summed per target token, which gives the
+exact token-weighted perplexity per bucket and over the whole set (rather
+than an estimate from one random batch per bucket).
+
+See dialogue.py --evaluate for running it on every new checkpoint in a
+process separate from training.
+"""
+
+import math
+import sys
+
+from six.moves import xrange  # pylint: disable=redefined-builtin
+
+
+def evaluate(session, model, data_set, batch_size=256):
+  """Compute the summed loss and token count of every bucket of data_set.
+
+  The model must be built with forward_only=False so that the decoder is
+  fed the reference outputs; no update is run.
+
+  Args:
+    session: tensorflow session holding the model parameters.
+    model: a seq2seq_model.Seq2SeqModel.
+    data_set: a list of length len(model.buckets) of (source, target) pairs,
+      as returned by dialogue.read_data.
+    batch_size: number of pairs to run through the model at once.
+
+  Returns:
+    A pair (bucket_stats, total): bucket_stats is a list with one
+    (loss_sum, num_tokens) pair per bucket, and total is the same pair
+    summed over all buckets.
+  """
+  bucket_stats = []
+  for bucket_id in xrange(len(model.buckets)):
+    pairs = data_set[bucket_id]
+    loss_sum, num_tokens = 0.0, 0.0
+    for start in xrange(0, len(pairs), batch_size):
+      encoder_inputs, decoder_inputs, target_weights = model.prepare_batch(
+          pairs[start:start + batch_size], bucket_id)
+      batch_loss, batch_tokens = model.eval_step(
+          session, encoder_inputs, decoder_inputs, target_weights, bucket_id)
+      loss_sum += batch_loss
+      num_tokens += batch_tokens
+    bucket_stats.append((loss_sum, num_tokens))
+  total = (sum(s[0] for s in bucket_stats), sum(s[1] for s in bucket_stats))
+  return bucket_stats, total
+
+
+def perplexity(loss_sum, num_tokens):
+  """Token-weighted perplexity from a summed loss and a token count."""
+  loss = loss_sum / num_tokens
+  return math.exp(loss) if loss < 300 else float("inf")
+
+
+def print_report(bucket_stats, total):
+  """Print per-bucket and overall perplexity as computed by evaluate()."""
+  for bucket_id, (loss_sum, num_tokens) in enumerate(bucket_stats):
+    if num_tokens == 0:
+      print("  eval: empty bucket %d" % (bucket_id))
+      continue
+    print("  eval: bucket %d perplexity %.2f (%d tokens)"
+          % (bucket_id, perplexity(loss_sum, num_tokens), num_tokens))
+  if total[1]:
+    print("  eval: overall perplexity %.2f (%d tokens)"
+          % (perplexity(*total), total[1]))
+  sys.stdout.flush()
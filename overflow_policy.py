@@ -0,0 +1,99 @@
+# Early Modern English dialogue generation, by Erika Varis Doggett
+
+# Python 3
+# ==============================================================================
+
+"""What to do with inputs longer than the largest bucket.
+
+The model can only encode as many tokens as its largest bucket holds. An
+OverflowPolicy picks the bucket for an input and, when it does not fit,
+applies one of these policies:
+
+  truncate_front: drop the first tokens and keep the end of the input.
+  truncate_back: keep the beginning of the input and drop the rest.
+  split: cut the input into pieces that fit, each of which is replied to;
+    the replies are joined.
+  reject: raise InputTooLongError, whose code can be returned to clients.
+
+It is used by app_bot, dialogue.py --decode and bulk_decode, and counts how
+often each policy fires instead of logging every overflow.
+"""
+
+import collections
+
+
+POLICIES = ("truncate_front", "truncate_back", "split", "reject")
+
+
+class InputTooLongError(ValueError):
+  """An input is longer than the largest bucket under the reject policy."""
+
+  code = "input_too_long"
+
+  def __init__(self, length, limit):
+    super(InputTooLongError, self).__init__(
+        "Input has %d tokens; at most %d are supported." % (length, limit))
+    self.length = length
+    self.limit = limit
+
+
+def select_bucket(length, buckets):
+  """Return the first bucket whose encoder holds length tokens, or None."""
+  for bucket_id, (encoder_size, _) in enumerate(buckets):
+    if length <= encoder_size:
+      return bucket_id
+  return None
+
+
+class OverflowPolicy(object):
+  """Fits token-id inputs into buckets, handling the ones that overflow."""
+
+  def __init__(self, policy, buckets, on_overflow=None):
+    """Create the policy.
+
+    Args:
+      policy: one of POLICIES.
+      buckets: the model's (encoder size, decoder size) buckets.
+      on_overflow: optional function called with the policy name whenever
+        an input overflows, e.g. to increment a metrics counter.
+
+    Raises:
+      ValueError: if policy is not one of POLICIES.
+    """
+    if policy not in POLICIES:
+      raise ValueError("Unknown overflow policy %r; choose from %s."
+                       % (policy, ", ".join(POLICIES)))
+    self.policy = policy
+    self.buckets = buckets
+    self.limit = buckets[-1][0]
+    self.on_overflow = on_overflow
+    # policy name -> number of inputs it was applied to
+    self.counts = collections.Counter()
+
+  def fit(self, token_ids):
+    """Return the input as a list of (bucket_id, token_ids) pieces.
+
+    Inputs that fit are returned as a single piece in the smallest bucket
+    that holds them; longer ones are handled by the policy.
+
+    Raises:
+      InputTooLongError: if the input overflows and the policy is reject.
+    """
+    bucket_id = select_bucket(len(token_ids), self.buckets)
+    if bucket_id is not None:
+      return [(bucket_id, token_ids)]
+
+    self.counts[self.policy] += 1
+    if self.on_overflow is not None:
+      self.on_overflow(self.policy)
+    last = len(self.buckets) - 1
+    if self.policy == "truncate_front":
+      return [(last, token_ids[-self.limit:])]
+    if self.policy == "truncate_back":
+      return [(last, token_ids[:self.limit])]
+    if self.policy == "split":
+      return [(select_bucket(len(piece), self.buckets), piece)
+              for piece in (token_ids[start:start + self.limit]
+                            for start in range(0, len(token_ids),
+                                               self.limit))]
+    raise InputTooLongError(len(token_ids), self.limit)
@@ -0,0 +1,128 @@
+# Early Modern English dialogue generation, by Erika Varis Doggett
+
+# Python 3
+# ==============================================================================
+
+"""Reading and writing the dialogue pair files.
+
+The pair files (input_data.json, output_data.json and their training and
+dev splits) hold one JSON object {"text": ...} per line, line i of the
+input file and line i of the output file forming a pair. All preprocessing
+stages read and write them through this module:
+
+  - files are opened with a 1 MB buffer, and paths ending in ".gz" are read
+    and written gzip-compressed;
+  - parse_text takes the text straight out of lines written by format_text
+    when it contains no escapes, and only falls back to json.loads for the
+    other lines;
+  - writers format each line with a single json.dumps of the text.
+"""
+
+import gzip
+import io
+import json
+import os
+
+
+BUFFER_SIZE = 1 << 20
+COMPRESSED_SUFFIX = ".gz"
+
+_PREFIX = '{"text": "'
+_SUFFIX = '"}'
+
+
+def open_file(path, mode="r"):
+  """Open a text file for reading ("r") or writing ("w") with a large buffer.
+
+  Paths ending in ".gz" are gzip-compressed.
+  """
+  if path.endswith(COMPRESSED_SUFFIX):
+    raw = gzip.open(path, mode + "b")
+    buffered = (io.BufferedReader(raw, BUFFER_SIZE) if mode == "r"
+                else io.BufferedWriter(raw, BUFFER_SIZE))
+    return io.TextIOWrapper(buffered, encoding="utf-8")
+  return open(path, mode, buffering=BUFFER_SIZE, encoding="utf-8")
+
+
+def existing_path(path):
+  """Return path, or its compressed form if only that exists."""
+  if not os.path.exists(path) and os.path.exists(path + COMPRESSED_SUFFIX):
+    return path + COMPRESSED_SUFFIX
+  return path
+
+
+def format_text(text):
+  """Return the line holding text, as written by json.dump({"text": text})."""
+  return '{"text": ' + json.dumps(text) + '}\n'
+
+
+def parse_text(line):
+  """Return the "text" field of a pair file line."""
+  line = line.rstrip("\n")
+  if (line.startswith(_PREFIX) and line.endswith(_SUFFIX) and
+      "\\" not in line):
+    text = line[len(_PREFIX):-len(_SUFFIX)]
+    # Without escapes, a quote inside means the line has other fields.
+    if '"' not in text:
+      return text
+  return json.loads(line)["text"]
+
+
+def read_texts(path):
+  """Yield the text of each line of a pair file."""
+  with open_file(path) as f:
+    for line in f:
+      if line.strip():
+        yield parse_text(line)
+
+
+def read_pairs(input_path, output_path):
+  """Yield the (input text, output text) pairs of two pair files."""
+  return zip(read_texts(input_path), read_texts(output_path))
+
+
+def write_texts(path, texts):
+  """Write texts to a pair file, one per line; return how many."""
+  with open_file(path, "w") as f:
+    count = 0
+    for text in texts:
+      f.write(format_text(text))
+      count += 1
+  return count
+
+
+class PairWriter(object):
+  """Writes pairs to an input and an output pair file.
+
+  Use as a context manager; lines are buffered and written in bulk.
+  """
+
+  def __init__(self, input_path, output_path):
+    self.input_path = input_path
+    self.output_path = output_path
+    self.count = 0
+
+  def __enter__(self):
+    self._input = open_file(self.input_path, "w")
+    self._output = open_file(self.output_path, "w")
+    return self
+
+  def __exit__(self, *exc_info):
+    self._input.close()
+    self._output.close()
+
+  def write(self, input_text, output_text):
+    self._input.write(format_text(input_text))
+    self._output.write(format_text(output_text))
+    self.count += 1
+
+  def write_all(self, pairs):
+    for input_text, output_text in pairs:
+      self.write(input_text, output_text)
+
+
+def write_pairs(input_path, output_path, pairs):
+  """Write (input text, output text) pairs to two pair files; return how many."""
+  with PairWriter(input_path, output_path) as writer:
+    writer.write_all(pairs)
+  return writer.count
@@ -0,0 +1,109 @@
+# Early Modern English dialogue generation, by Erika Varis Doggett
+
+# Python 3
+# ==============================================================================
+
+"""Compact in-memory storage of the token-id pairs of a bucket.
+
+dialogue.read_data used to keep each pair as two Python lists of Python
+ints, which costs a list object per side and 8 bytes per token for the list
+slot alone (plus 28 bytes per int object above 256). A PairStore keeps all
+source tokens of a bucket in one array('i') and all target tokens in
+another, with an array('q') of offsets for each, so a pair costs 4 bytes per
+token and 16 bytes of offsets.
+
+A PairStore is a sequence of (source, target) pairs, built as lists when
+they are accessed, so code written for lists of pairs (random.choice,
+slicing, len) works on it unchanged; sample() draws a random batch and
+lengths() gives the lengths without building the pairs.
+"""
+
+from array import array
+import random
+import sys
+
+import numpy as np
+
+
+class PairStore(object):
+  """The (source, target) token-id pairs of one bucket, stored flat."""
+
+  def __init__(self):
+    self._sources = array("i")
+    self._targets = array("i")
+    self._source_offsets = array("q", [0])
+    self._target_offsets = array("q", [0])
+
+  def append(self, source, target):
+    """Add a pair of token-id lists."""
+    self._sources.extend(source)
+    self._targets.extend(target)
+    self._source_offsets.append(len(self._sources))
+    self._target_offsets.append(len(self._targets))
+
+  def __len__(self):
+    return len(self._source_offsets) - 1
+
+  def _pair(self, i):
+    return (self._sources[self._source_offsets[i]:
+                          self._source_offsets[i + 1]].tolist(),
+            self._targets[self._target_offsets[i]:
+                          self._target_offsets[i + 1]].tolist())
+
+  def __getitem__(self, index):
+    if isinstance(index, slice):
+      return [self._pair(i) for i in range(*index.indices(len(self)))]
+    if index < 0:
+      index += len(self)
+    if not 0 <= index < len(self):
+      raise IndexError("pair index out of range")
+    return self._pair(index)
+
+  def sample(self, count, rng=random):
+    """Return count pairs drawn uniformly with replacement, like random.choice.
+
+    Args:
+      count: number of pairs.
+      rng: random.Random (or the random module) to draw with.
+    """
+    size = len(self)
+    return [self._pair(int(rng.random() * size)) for _ in range(count)]
+
+  def lengths(self):
+    """Return the source and target lengths of all pairs as two arrays."""
+    return (np.diff(np.frombuffer(self._source_offsets, dtype=np.int64)),
+            np.diff(np.frombuffer(self._target_offsets, dtype=np.int64)))
+
+  @property
+  def nbytes(self):
+    """Memory held by the store's arrays."""
+    return sum(a.buffer_info()[1] * a.itemsize
+               for a in (self._sources, self._targets, self._source_offsets,
+                         self._target_offsets))
+
+  def list_nbytes(self):
+    """Estimated memory of the same pairs as lists of lists of ints."""
+    tokens = len(self._sources) + len(self._targets)
+    # ints up to 256 are shared objects; larger ones are one object each
+    large = (int(np.count_nonzero(np.frombuffer(self._sources, np.int32) > 256))
+             + int(np.count_nonzero(np.frombuffer(self._targets, np.int32)
+                                    > 256)))
+    return (len(self) * (sys.getsizeof([None, None]) +
+                         2 * sys.getsizeof([])) +
+            tokens * 8 + large * sys.getsizeof(1 << 10))
+
+
+def pair_lengths(pairs):
+  """Source and target lengths of a PairStore or a list of pairs."""
+  if isinstance(pairs, PairStore):
+    return [lengths.tolist() for lengths in pairs.lengths()]
+  return [len(p[0]) for p in pairs], [len(p[1]) for p in pairs]
+
+
+def memory_report(data_set):
+  """Return a one-line summary of the memory of a list of PairStores."""
+  pairs = sum(len(store) for store in data_set)
+  compact = sum(store.nbytes for store in data_set)
+  lists = sum(store.list_nbytes() for store in data_set)
+  return ("%d pairs in %.1f MB (%.1f MB as lists of ints)"
+          % (pairs, compact / float(1 << 20), lists / float(1 << 20)))
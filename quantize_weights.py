@@ -0,0 +1,347 @@
+# Early Modern English dialogue generation, by Erika Varis Doggett
+
+# Python 3
+# ==============================================================================
+
+"""Post-training int8 quantization of the model weights for serving.
+
+quantize_checkpoint reads a training checkpoint and writes a new one in which
+every large 2-D weight (the two embeddings, proj_w and the LSTM kernels) is
+replaced by an int8 matrix "<name>/quantized" and a float32 scale per row
+"<name>/scale", so that row i is approximately quantized[i] * scale[i]. All
+other variables are copied unchanged.
+
+For serving, a DequantizingGetter passed to Seq2SeqModel as custom_getter
+creates the int8 and scale variables in place of the float ones, so the
+session holds a quarter of the weight memory and the checkpoint restores with
+model.saver as usual. The embeddings and proj_w are returned as
+QuantizedMatrix objects, which the model only dequantizes where they are
+used: the rows looked up, and for the output projection one block of
+MATMUL_BLOCK_ROWS rows at a time, each multiplied and freed before the next
+is cast, so a float copy of the whole of proj_w is never held. The other
+matrices (the LSTM kernels) are dequantized whole, once per session.run.
+
+Quantize the latest checkpoint, then compare replies with the float model:
+python3 quantize_weights.py --train_dir=training --output_dir=training/int8
+python3 quantize_weights.py --output_dir=training/int8 --compare=prompts.jsonl
+"""
+
+import argparse
+import json
+import os
+
+import numpy as np
+import tensorflow as tf
+
+
+QUANTIZED_SUFFIX = "/quantized"
+SCALE_SUFFIX = "/scale"
+# Rows of an int8 matrix cast to float32 at a time by QuantizedMatrix.matmul;
+# 4096 rows of a 1024-wide proj_w are 16 MB.
+MATMUL_BLOCK_ROWS = 4096
+
+
+def quantize_rows(matrix):
+  """Quantize a 2-D float array to int8 with one scale per row.
+
+  Returns:
+    A pair (int8 array, float32 scales) with matrix ~ int8 * scales[:, None].
+  """
+  matrix = np.asarray(matrix, dtype=np.float32)
+  scales = np.abs(matrix).max(axis=1) / 127.0
+  # all-zero rows quantize to zeros with any scale
+  safe_scales = np.where(scales > 0, scales, 1.0)
+  quantized = np.round(matrix / safe_scales[:, None])
+  return (np.clip(quantized, -127, 127).astype(np.int8),
+          scales.astype(np.float32))
+
+
+def dequantize_rows(quantized, scales):
+  """Inverse of quantize_rows, up to rounding."""
+  return quantized.astype(np.float32) * scales[:, None]
+
+
+def quantized_variables(checkpoint_path):
+  """Return the names of the variables quantized in a checkpoint."""
+  reader = tf.train.NewCheckpointReader(checkpoint_path)
+  return [name[:-len(QUANTIZED_SUFFIX)]
+          for name in reader.get_variable_to_shape_map()
+          if name.endswith(QUANTIZED_SUFFIX)]
+
+
+def quantize_checkpoint(checkpoint_path, output_dir, min_elements=1 << 16):
+  """Write an int8 copy of a checkpoint.
+
+  Args:
+    checkpoint_path: checkpoint to quantize, e.g. training/translate.ckpt-1000.
+    output_dir: directory to write the quantized checkpoint to, under the
+      same file name.
+    min_elements: only 2-D float variables with at least this many elements
+      are quantized; smaller ones (biases, scalars) are copied as they are.
+
+  Returns:
+    A list of (name, original bytes, quantized bytes, max absolute error)
+    for each variable.
+  """
+  reader = tf.train.NewCheckpointReader(checkpoint_path)
+  values = {}
+  report = []
+  for name, shape in sorted(reader.get_variable_to_shape_map().items()):
+    value = reader.get_tensor(name)
+    if (len(shape) == 2 and value.dtype == np.float32 and
+        value.size >= min_elements):
+      quantized, scales = quantize_rows(value)
+      values[name + QUANTIZED_SUFFIX] = quantized
+      values[name + SCALE_SUFFIX] = scales
+      error = np.abs(dequantize_rows(quantized, scales) - value).max()
+      report.append((name, value.nbytes, quantized.nbytes + scales.nbytes,
+                     float(error)))
+    else:
+      values[name] = value
+      report.append((name, value.nbytes, value.nbytes, 0.0))
+
+  if not tf.gfile.Exists(output_dir):
+    tf.gfile.MakeDirs(output_dir)
+  # Feed the values through placeholders so they are not copied into the
+  # graph as constants.
+  graph = tf.Graph()
+  with graph.as_default(), tf.device("/cpu:0"):
+    placeholders = {}
+    variables = {}
+    for name, value in values.items():
+      placeholders[name] = tf.placeholder(tf.as_dtype(value.dtype),
+                                          shape=value.shape)
+      variables[name] = tf.Variable(placeholders[name], trainable=False,
+                                    collections=[])
+    saver = tf.train.Saver(variables)
+    with tf.Session(graph=graph) as sess:
+      sess.run([v.initializer for v in variables.values()],
+               dict((placeholders[name], value)
+                    for name, value in values.items()))
+      saver.save(sess, os.path.join(output_dir,
+                                    os.path.basename(checkpoint_path)),
+                 write_meta_graph=False)
+  return report
+
+
+def print_report(report):
+  """Print the size and error of each variable, and the totals."""
+  for name, original, quantized, error in report:
+    if original != quantized:
+      print("%-70s %8.1f MB -> %7.1f MB  max error %.5f"
+            % (name, original / float(1 << 20), quantized / float(1 << 20),
+               error))
+  original = sum(r[1] for r in report)
+  quantized = sum(r[2] for r in report)
+  print("total %.1f MB -> %.1f MB (%.1f%%)"
+        % (original / float(1 << 20), quantized / float(1 << 20),
+           100.0 * quantized / original))
+
+
+class QuantizedMatrix(object):
+  """An int8 matrix with one float32 scale per row, dequantized on use.
+
+  It stands in for an embedding or for proj_w: seq2seq_modified looks
+  embeddings up with lookup() and applies output projections with matmul().
+  """
+
+  def __init__(self, quantized, scales, dtype, transposed=False):
+    """Wrap quantized variables.
+
+    Args:
+      quantized: int8 [rows, columns] variable.
+      scales: float32 [rows] variable.
+      dtype: dtype of the dequantized values.
+      transposed: whether the matrix stands for the transpose of quantized.
+    """
+    self.quantized = quantized
+    self.scales = scales
+    self.dtype = dtype
+    self.transposed = transposed
+
+  def transpose(self, dtype=None):
+    """The transposed matrix, with values of dtype (default: the same)."""
+    return QuantizedMatrix(self.quantized, self.scales, dtype or self.dtype,
+                           not self.transposed)
+
+  def lookup(self, ids):
+    """Rows ids of the (untransposed) matrix; only those are dequantized."""
+    rows = tf.cast(tf.gather(self.quantized, ids), tf.float32)
+    scales = tf.expand_dims(tf.gather(self.scales, ids), 1)
+    return tf.cast(rows * scales, self.dtype)
+
+  def matmul(self, inputs, block_rows=MATMUL_BLOCK_ROWS):
+    """inputs times the matrix, dequantizing block_rows rows at a time.
+
+    Each block of the int8 matrix is cast to float32 only after the product
+    of the previous block is computed, so at most one block is held as
+    float32 at once, instead of the whole matrix.
+    """
+    inputs = tf.cast(inputs, tf.float32)
+    rows = int(self.quantized.get_shape()[0])
+    products = []
+    for start in range(0, rows, block_rows):
+      end = min(start + block_rows, rows)
+      with tf.control_dependencies(products[-1:]):
+        block = tf.cast(self.quantized[start:end], tf.float32)
+      scales = self.scales[start:end]
+      if self.transposed:
+        # Column j of the transposed matrix is row j, scaled by scales[j].
+        product = tf.matmul(inputs, block, transpose_b=True) * scales
+      else:
+        product = tf.matmul(inputs[:, start:end] * scales, block)
+      products.append(product)
+    if self.transposed:
+      product = tf.concat(products, 1)
+    else:
+      product = tf.add_n(products)
+    return tf.cast(product, self.dtype)
+
+  def dense(self):
+    """The whole dequantized matrix."""
+    matrix = (tf.cast(self.quantized, tf.float32) *
+              tf.expand_dims(self.scales, 1))
+    if self.transposed:
+      matrix = tf.transpose(matrix)
+    return tf.cast(matrix, self.dtype)
+
+
+def sampled_softmax_loss(weights, biases, labels, inputs, num_sampled,
+                         num_classes):
+  """tf.nn.sampled_softmax_loss with a QuantizedMatrix of weights.
+
+  The true and sampled classes are numbered anew by tf.unique, so that only
+  their rows are dequantized; equal classes keep equal numbers, so
+  accidental hits are still removed.
+  """
+  labels = tf.cast(labels, tf.int64)
+  sampled, true_expected_count, sampled_expected_count = (
+      tf.nn.log_uniform_candidate_sampler(
+          true_classes=labels, num_true=1, num_sampled=num_sampled,
+          unique=True, range_max=num_classes))
+  classes, index = tf.unique(tf.concat([tf.reshape(labels, [-1]), sampled],
+                                       0))
+  num_labels = tf.size(labels)
+  return tf.nn.sampled_softmax_loss(
+      weights=weights.lookup(classes),
+      biases=tf.gather(biases, classes),
+      labels=tf.reshape(index[:num_labels], [-1, 1]),
+      inputs=inputs,
+      num_sampled=num_sampled,
+      num_classes=num_classes,
+      sampled_values=(index[num_labels:], true_expected_count,
+                      sampled_expected_count))
+
+
+def _is_looked_up(name):
+  """Whether a variable is an embedding or the output projection."""
+  return name.endswith("/embedding") or name in ("proj_w", "tied_embedding")
+
+
+class DequantizingGetter(object):
+  """Custom getter holding quantized variables as int8 matrices and scales.
+
+  Variables named in quantized_names are created as "<name>/quantized"
+  (int8) and "<name>/scale" (float32). Embeddings and proj_w are returned as
+  a QuantizedMatrix, the others as a dequantized tensor of the requested
+  dtype; all other variables are created as usual. What is returned for a
+  variable is built once and returned again when the variable is reused, so
+  the graph has one set of ops per variable; the dequantized tensors are
+  still computed in every session.run that needs them.
+  """
+
+  def __init__(self, quantized_names):
+    self.quantized_names = set(quantized_names)
+    self._matrices = {}
+
+  def __call__(self, getter, name, shape=None, dtype=None, **kwargs):
+    if name not in self.quantized_names:
+      return getter(name, shape, dtype, **kwargs)
+    dtype = dtype or tf.float32
+    key = (name, dtype)
+    if key not in self._matrices:
+      kwargs.update(initializer=tf.zeros_initializer(), trainable=False)
+      quantized = getter(name + QUANTIZED_SUFFIX, shape, tf.int8, **kwargs)
+      scales = getter(name + SCALE_SUFFIX, shape[:1], tf.float32, **kwargs)
+      matrix = QuantizedMatrix(quantized, scales, dtype)
+      self._matrices[key] = matrix if _is_looked_up(name) else matrix.dense()
+    return self._matrices[key]
+
+
+def read_prompts(path):
+  """Read prompts from a JSONL file with a "text" field, or plain lines."""
+  prompts = []
+  with open(path) as f:
+    for line in f:
+      line = line.strip()
+      if line:
+        prompts.append(json.loads(line)["text"] if line.startswith("{")
+                       else line)
+  return prompts
+
+
+def compare_replies(prompts, quantized_dir):
+  """Compare the greedy replies of the float and the int8 model.
+
+  Returns:
+    A dict with the fraction of identical replies, the fraction of
+    identical tokens (position by position, over the longer reply) and the
+    prompts whose replies differ.
+  """
+  import app_bot
+  float_bot = app_bot.ShakespeareBot(quantized_dir="")
+  int8_bot = app_bot.ShakespeareBot(quantized_dir=quantized_dir)
+  same_replies = same_tokens = total_tokens = 0
+  differences = []
+  for prompt in prompts:
+    expected = float_bot.respond(prompt)
+    reply = int8_bot.respond(prompt)
+    if reply == expected:
+      same_replies += 1
+    else:
+      differences.append({"text": prompt, "float": expected, "int8": reply})
+    expected_tokens, tokens = expected.split(), reply.split()
+    same_tokens += sum(a == b for a, b in zip(expected_tokens, tokens))
+    total_tokens += max(len(expected_tokens), len(tokens))
+  return {
+      "prompts": len(prompts),
+      "same_replies": same_replies / float(len(prompts)),
+      "same_tokens": same_tokens / float(max(total_tokens, 1)),
+      "differences": differences,
+  }
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+  parser.add_argument("--train_dir", default="training",
+                      help="directory with the checkpoint to quantize")
+  parser.add_argument("--output_dir", required=True,
+                      help="directory for the quantized checkpoint")
+  parser.add_argument("--min_elements", type=int, default=1 << 16,
+                      help="quantize 2-D weights with at least this many "
+                           "elements")
+  parser.add_argument("--compare",
+                      help="prompt file (JSONL or text); compare the replies "
+                           "of the float and int8 models instead of "
+                           "quantizing")
+  parser.add_argument("--output", help="write the comparison as JSON here")
+  args = parser.parse_args()
+
+  if args.compare:
+    results = compare_replies(read_prompts(args.compare), args.output_dir)
+    print("%d prompts: %.1f%% identical replies, %.1f%% identical tokens"
+          % (results["prompts"], 100 * results["same_replies"],
+             100 * results["same_tokens"]))
+    if args.output:
+      with open(args.output, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    return
+
+  ckpt = tf.train.get_checkpoint_state(args.train_dir)
+  print("Quantizing %s" % ckpt.model_checkpoint_path)
+  print_report(quantize_checkpoint(ckpt.model_checkpoint_path,
+                                   args.output_dir, args.min_elements))
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,120 @@
+# Early Modern English dialogue generation, by Erika Varis Doggett
+
+# Python 3
+# ==============================================================================
+
+"""N-best reranking of candidate replies.
+
+Candidate replies to a prompt (e.g. several sampled ones, see
+sample_candidates) are scored together in one batch by a Seq2SeqModel built
+with rescoring=True, and the best one is kept. The score of a candidate is
+
+  log p(reply + EOS | prompt) / ((5 + length) / 6) ** length_penalty
+      - repetition_penalty * repeated n-gram fraction
+
+The length normalization (as in GNMT, arXiv:1609.08144) counters the
+preference of the raw log-likelihood for short replies; the repetition term
+counters replies that loop on the same few words.
+"""
+
+import numpy as np
+
+import data_utils
+
+
+def length_normalizer(lengths, alpha):
+  """GNMT length penalty ((5 + length) / 6) ** alpha; 1 for alpha 0."""
+  return ((5.0 + np.asarray(lengths, dtype=np.float64)) / 6.0) ** alpha
+
+
+def repeated_fraction(token_ids, n=2):
+  """Fraction of the n-grams of token_ids that occur earlier in it."""
+  ngrams = [tuple(token_ids[i:i + n])
+            for i in range(len(token_ids) - n + 1)]
+  if not ngrams:
+    return 0.0
+  return 1.0 - len(set(ngrams)) / float(len(ngrams))
+
+
+def scoring_bucket(buckets, prompt_length, reply_length):
+  """Return the first bucket holding the prompt and the reply plus EOS.
+
+  The decoder also needs room for GO, as in the training data, so the reply
+  must be at least two tokens shorter than the decoder. Returns None if no
+  bucket is large enough.
+  """
+  for bucket_id, (encoder_size, decoder_size) in enumerate(buckets):
+    if prompt_length <= encoder_size and reply_length + 2 <= decoder_size:
+      return bucket_id
+  return None
+
+
+class Reranker(object):
+  """Scores candidate replies with a model and picks the best one."""
+
+  def __init__(self, model, length_penalty=0.6, repetition_penalty=1.0,
+               repetition_ngram=2):
+    """Create the reranker.
+
+    Args:
+      model: a forward-only Seq2SeqModel built with rescoring=True.
+      length_penalty: exponent alpha of the length normalizer; 0 ranks by
+        the raw log-likelihood.
+      repetition_penalty: weight of the repeated n-gram fraction.
+      repetition_ngram: n of the n-grams counted as repeated.
+    """
+    self.model = model
+    self.length_penalty = length_penalty
+    self.repetition_penalty = repetition_penalty
+    self.repetition_ngram = repetition_ngram
+
+  def scores(self, session, prompt_ids, candidates):
+    """Score each candidate reply to a prompt, in one batch.
+
+    Prompts and candidates too long for the largest bucket are scored on
+    their beginning.
+
+    Args:
+      session: session holding the model.
+      prompt_ids: token ids of the prompt.
+      candidates: list of token-id lists (without EOS).
+
+    Returns:
+      A [len(candidates)] array of scores; higher is better.
+    """
+    buckets = self.model.buckets
+    encoder_size, decoder_size = buckets[-1]
+    prompt_ids = prompt_ids[:encoder_size]
+    replies = [list(c[:decoder_size - 2]) for c in candidates]
+    bucket_id = scoring_bucket(buckets, len(prompt_ids),
+                               max(len(r) for r in replies))
+    encoder_inputs, decoder_inputs, target_weights = self.model.prepare_batch(
+        [(prompt_ids, reply + [data_utils.EOS_ID]) for reply in replies],
+        bucket_id)
+    log_likelihoods, lengths = self.model.score_step(
+        session, encoder_inputs, decoder_inputs, target_weights, bucket_id)
+    repeated = np.array([repeated_fraction(reply, self.repetition_ngram)
+                         for reply in replies])
+    return (log_likelihoods / length_normalizer(lengths, self.length_penalty)
+            - self.repetition_penalty * repeated)
+
+  def best(self, session, prompt_ids, candidates):
+    """Return the highest scoring of candidates."""
+    if len(candidates) == 1:
+      return candidates[0]
+    return candidates[int(np.argmax(self.scores(session, prompt_ids,
+                                                candidates)))]
+
+
+def sample_candidates(session, model, token_ids, bucket_id, sampler, count):
+  """Sample count replies to one input in a single batch.
+
+  Duplicates are dropped, so fewer than count candidates may be returned.
+  The model needs incremental_decoding.
+  """
+  candidates = []
+  for reply in model.sample_outputs(session, [token_ids] * count, bucket_id,
+                                    sampler):
+    if reply not in candidates:
+      candidates.append(reply)
+  return candidates
@@ -0,0 +1,121 @@
+# Early Modern English dialogue generation, by Erika Varis Doggett
+
+# Python 3
+# ==============================================================================
+
+"""Temperature, top-k and nucleus (top-p) sampling of output tokens.
+
+A Sampler picks the next token of every row of a [batch, vocab] logits array
+at once, for the incremental decoder of Seq2SeqModel.sample_outputs. The
+candidates are selected with np.argpartition, which is linear in the
+vocabulary size, and only those are sorted, instead of sorting all 55000
+logits of every row at every step:
+
+  top_k: keep the k most likely tokens (0 keeps them all).
+  top_p: keep the most likely tokens whose probabilities sum to at least p
+    (after top_k, if both are set); without top_k, the candidates are the
+    candidate_pool most likely tokens, grown for rows where they do not
+    reach p.
+  temperature: logits are divided by it before the softmax; 0 is greedy.
+
+Each Sampler has its own seeded random state, so a decode run with the same
+seed and inputs gives the same replies.
+"""
+
+import numpy as np
+
+
+def _softmax(logits):
+  """Row-wise softmax of a 2-D array; -inf entries get probability 0."""
+  exp = np.exp(logits - logits.max(axis=1, keepdims=True))
+  return exp / exp.sum(axis=1, keepdims=True)
+
+
+def _logsumexp(logits):
+  top = logits.max(axis=1, keepdims=True)
+  return top + np.log(np.exp(logits - top).sum(axis=1, keepdims=True))
+
+
+class Sampler(object):
+  """Samples token ids from batched logits."""
+
+  def __init__(self, temperature=1.0, top_k=0, top_p=1.0, seed=None,
+               candidate_pool=256):
+    """Create the sampler.
+
+    Args:
+      temperature: softmax temperature; 0 always picks the most likely token.
+      top_k: sample among the top_k most likely tokens; 0 for no limit.
+      top_p: sample among the most likely tokens with total probability
+        top_p; 1.0 for no limit.
+      seed: seed of the random state; None seeds from the OS.
+      candidate_pool: with top_p but no top_k, the number of candidates
+        partitioned out first.
+
+    Raises:
+      ValueError: if an argument is out of range.
+    """
+    if temperature < 0:
+      raise ValueError("temperature must be >= 0, got %r." % temperature)
+    if top_k < 0:
+      raise ValueError("top_k must be >= 0, got %r." % top_k)
+    if not 0 < top_p <= 1:
+      raise ValueError("top_p must be in (0, 1], got %r." % top_p)
+    self.temperature = temperature
+    self.top_k = top_k
+    self.top_p = top_p
+    self.seed = seed
+    self.candidate_pool = candidate_pool
+    self.random = np.random.RandomState(seed)
+
+  def __call__(self, logits):
+    """Return one sampled token id per row of a [batch, vocab] array."""
+    logits = np.asarray(logits, dtype=np.float32)
+    if self.temperature == 0 or self.top_k == 1:
+      return np.argmax(logits, axis=1)
+    logits = logits / self.temperature
+    vocab_size = logits.shape[1]
+    if (self.top_k == 0 or self.top_k >= vocab_size) and self.top_p == 1:
+      return self._choose(_softmax(logits))
+
+    if 0 < self.top_k < vocab_size:
+      ids, candidates = self._top(logits, self.top_k)
+      log_total = _logsumexp(candidates)
+      pool = None
+    else:
+      pool = min(self.candidate_pool, vocab_size)
+      ids, candidates = self._top(logits, pool)
+      log_total = _logsumexp(logits)
+    if self.top_p < 1:
+      cumulative = np.cumsum(np.exp(candidates - log_total), axis=1)
+      # Grow the candidates until they cover top_p in every row.
+      while pool is not None and pool < vocab_size and (
+          cumulative[:, -1] < self.top_p).any():
+        pool = min(pool * 4, vocab_size)
+        ids, candidates = self._top(logits, pool)
+        cumulative = np.cumsum(np.exp(candidates - log_total), axis=1)
+      # Keep each candidate whose more likely predecessors are not yet at
+      # top_p, so the most likely one is always kept.
+      previous = np.concatenate(
+          [np.zeros_like(cumulative[:, :1]), cumulative[:, :-1]], axis=1)
+      candidates = np.where(previous < self.top_p, candidates, -np.inf)
+    choice = self._choose(_softmax(candidates))
+    return ids[np.arange(len(ids)), choice]
+
+  def _top(self, logits, k):
+    """Return the ids and logits of the k largest logits per row, sorted."""
+    if k < logits.shape[1]:
+      ids = np.argpartition(-logits, k - 1, axis=1)[:, :k]
+    else:
+      ids = np.tile(np.arange(logits.shape[1]), (len(logits), 1))
+    rows = np.arange(len(ids))[:, None]
+    candidates = logits[rows, ids]
+    order = np.argsort(-candidates, axis=1)
+    return ids[rows, order], candidates[rows, order]
+
+  def _choose(self, probabilities):
+    """Draw one column per row with the given row-wise probabilities."""
+    cumulative = np.cumsum(probabilities, axis=1)
+    draws = self.random.random_sample((len(probabilities), 1))
+    choice = (cumulative < draws * cumulative[:, -1:]).sum(axis=1)
+    return np.minimum(choice, probabilities.shape[1] - 1)
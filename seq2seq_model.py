@@ -7,15 +7,99 @@
 
 """Sequence-to-sequence model with an attention mechanism."""
 
+import functools
 import random
 
 import numpy as np
 from six.moves import xrange  # pylint: disable=redefined-builtin
 import tensorflow as tf
+from tensorflow.python.util import nest
 
 import seq2seq_modified
 
 import data_utils
+import pair_store
+import quantize_weights
+
+
+def _fp32_storage_getter(getter, name, shape=None, dtype=None, *args,
+                         **kwargs):
+  """Custom getter storing float16 variables as float32 master weights.
+
+  The variable itself (what is trained and checkpointed) is float32, and the
+  model computes with a float16 copy of it, so checkpoints are the same as
+  for a float32 model. The embeddings are returned as float32: casting them
+  whole would copy the full vocabulary matrix every step and make their
+  sparse gradients dense, so only the rows looked up are cast (see
+  seq2seq_modified._embedding_lookup).
+  """
+  if dtype == tf.float16:
+    variable = getter(name, shape, tf.float32, *args, **kwargs)
+    if name.endswith("/embedding"):
+      return variable
+    return tf.cast(variable, tf.float16)
+  return getter(name, shape, dtype, *args, **kwargs)
+
+
+def _tied_embedding_getter():
+  """Custom getter sharing one variable between the embeddings and proj_w.
+
+  The encoder and decoder embeddings (".../embedding") and the output
+  projection ("proj_w") all have shape [vocab_size, size]; the first of them
+  to be requested is created as "tied_embedding" and returned for all three.
+  """
+  tied = []
+  def getter(getter, name, *args, **kwargs):
+    if name != "proj_w" and not name.endswith("/embedding"):
+      return getter(name, *args, **kwargs)
+    if not tied:
+      tied.append(getter("tied_embedding", *args, **kwargs))
+    return tied[0]
+  return getter
+
+
+def _compose_getters(outer, inner):
+  """Custom getter applying inner to the variables returned by outer."""
+  if outer is None:
+    return inner
+  def getter(getter, *args, **kwargs):
+    return inner(functools.partial(outer, getter), *args, **kwargs)
+  return getter
+
+
+class _TransposedWeights(object):
+  """The output projection weights W, the transpose of proj_w.
+
+  matmul multiplies by proj_w with transpose_b instead of a transposed copy,
+  and in proj_w's own dtype, so a float16 model projects in float32 (as the
+  sampled softmax loss does) without a float16 copy of the whole matrix.
+  """
+
+  def __init__(self, w_t):
+    self.w_t = w_t
+
+  def matmul(self, inputs):
+    return tf.matmul(tf.cast(inputs, self.w_t.dtype.base_dtype), self.w_t,
+                     transpose_b=True)
+
+
+def greedy_outputs(output_logits):
+  """Greedy decoding of the output logits of a forward-only step().
+
+  Args:
+    output_logits: list (one per decoder step) of [batch, vocab] logits.
+
+  Returns:
+    For each example in the batch, the list of argmax token ids, cut before
+    the first EOS.
+  """
+  outputs = []
+  for row in np.stack([np.argmax(logits, axis=1) for logits in output_logits],
+                      axis=1).tolist():
+    if data_utils.EOS_ID in row:
+      row = row[:row.index(data_utils.EOS_ID)]
+    outputs.append(row)
+  return outputs
 
 
 class Seq2SeqModel(object):
@@ -46,7 +130,17 @@ class Seq2SeqModel(object):
                num_samples=512,
                forward_only=False,
                dtype=tf.float32,
-               dropout_keep=.5):
+               dropout_keep=.5,
+               accumulation_steps=1,
+               per_bucket_accumulators=False,
+               initial_loss_scale=2.0 ** 15,
+               loss_scale_window=2000,
+               custom_getter=None,
+               tie_embeddings=False,
+               conversation_context=False,
+               incremental_decoding=False,
+               rescoring=False,
+               checkpoints_to_keep=5):
     """Create the model.
 
     Args:
@@ -68,46 +162,109 @@ class Seq2SeqModel(object):
       use_lstm: if true, we use LSTM cells instead of GRU cells.
       num_samples: number of samples for sampled softmax.
       forward_only: if set, we do not construct the backward pass in the model.
-      dtype: the data type to use to store internal variables.
+      dtype: the data type to compute in; with tf.float16 the variables are
+        still stored (and checkpointed) as float32 master weights, losses are
+        computed in float32 and gradients use dynamic loss scaling.
+      accumulation_steps: number of batches whose gradients are accumulated
+        before a single (clipped) update is applied; 1 updates every step.
+      per_bucket_accumulators: if set, each bucket accumulates into its own
+        gradient buffers and is applied separately; otherwise all buckets
+        share one set of buffers.
+      initial_loss_scale: loss scale to start from with tf.float16.
+      loss_scale_window: with tf.float16, the loss scale is halved (and the
+        update skipped) whenever the gradients overflow, and doubled after
+        this many updates without overflow.
+      custom_getter: custom getter through which the model's variables are
+        created, e.g. a quantize_weights.DequantizingGetter to serve int8
+        weights.
+      tie_embeddings: if set, the encoder embedding, the decoder embedding
+        and the output projection are one shared variable; this only makes
+        sense if the encoder and decoder use the same vocabulary.
+      conversation_context: if set (with forward_only), also build the graphs
+        used by encode_turn and decode_context, which encode each turn of a
+        conversation once and decode attending over all of them.
+      incremental_decoding: if set (with forward_only), also build the
+        one-step decoder used by sample_outputs, which feeds back sampled
+        tokens instead of the argmax.
+      rescoring: if set (with forward_only), also build the teacher-forced
+        graphs used by score_step, which give the log-likelihood of given
+        replies, e.g. to rerank candidates.
+      checkpoints_to_keep: number of recent checkpoints self.saver keeps.
     """
     self.vocab_size = vocab_size
     self.buckets = buckets
     self.batch_size = batch_size
     self.learning_rate = tf.Variable(
-        float(learning_rate), trainable=False, dtype=dtype)
+        float(learning_rate), trainable=False, dtype=tf.float32)
     self.learning_rate_decay_op = self.learning_rate.assign(
         self.learning_rate * learning_rate_decay_factor)
     self.global_step = tf.Variable(0, trainable=False)
     self.dropout_keep = dropout_keep
     self.num_layers = num_layers
+    self.accumulation_steps = accumulation_steps
+    self.per_bucket_accumulators = per_bucket_accumulators
+    # Set to a step_profiler.StepProfiler to trace a sample of the steps.
+    self.profiler = None
+    self.mixed_precision = dtype == tf.float16
+    if self.mixed_precision:
+      # Dynamic loss scaling; local so checkpoints match float32 models.
+      self.loss_scale = tf.Variable(
+          float(initial_loss_scale), trainable=False, name="loss_scale",
+          collections=[tf.GraphKeys.LOCAL_VARIABLES])
+      self._good_steps = tf.Variable(
+          0, trainable=False, name="loss_scale_good_steps",
+          collections=[tf.GraphKeys.LOCAL_VARIABLES])
+      self.loss_scale_window = loss_scale_window
+
+    # Custom getters, applied innermost first: tied embeddings, the caller's
+    # getter, then (in seq2seq_f) float32 master weights for float16.
+    variable_getter = custom_getter
+    if tie_embeddings:
+      variable_getter = _compose_getters(variable_getter,
+                                         _tied_embedding_getter())
 
     # If we use sampled softmax, we need an output projection.
     output_projection = None
     softmax_loss_function = None
     # Sampled softmax only makes sense if we sample less than vocabulary size.
     if num_samples > 0 and num_samples < self.vocab_size:
-      w_t = tf.get_variable("proj_w", [self.vocab_size, size])
-      w = tf.transpose(w_t)
-      b = tf.get_variable("proj_b", [self.vocab_size])
-      output_projection = (w, b)
+      with tf.variable_scope(tf.get_variable_scope(),
+                             custom_getter=variable_getter):
+        w_t = tf.get_variable("proj_w", [self.vocab_size, size])
+        b = tf.get_variable("proj_b", [self.vocab_size])
+      # An int8 proj_w (see quantize_weights) is only dequantized in use;
+      # a float one is used as it is, never copied to dtype.
+      quantized = isinstance(w_t, quantize_weights.QuantizedMatrix)
+      if quantized:
+        w = w_t.transpose(dtype)
+      else:
+        w = _TransposedWeights(w_t)
+      output_projection = (w, tf.cast(b, dtype))
 
       def sampled_loss(labels, logits):
         labels = tf.reshape(labels, [-1, 1])
         # We need to compute the sampled_softmax_loss using 32bit floats to
         # avoid numerical instabilities.
-        local_w_t = tf.cast(w_t, tf.float32)
         local_b = tf.cast(b, tf.float32)
         local_inputs = tf.cast(logits, tf.float32)
-        return tf.cast(
-            tf.nn.sampled_softmax_loss(
-                weights=local_w_t,
-                biases=local_b,
-                labels=labels,
-                inputs=local_inputs,
-                num_sampled=num_samples,
-                num_classes=self.vocab_size),
-            dtype)
+        if quantized:
+          return quantize_weights.sampled_softmax_loss(
+              w_t, local_b, labels, local_inputs, num_samples,
+              self.vocab_size)
+        local_w_t = tf.cast(w_t, tf.float32)
+        return tf.nn.sampled_softmax_loss(
+            weights=local_w_t,
+            biases=local_b,
+            labels=labels,
+            inputs=local_inputs,
+            num_sampled=num_samples,
+            num_classes=self.vocab_size)
       softmax_loss_function = sampled_loss
+    elif self.mixed_precision:
+      def full_loss(labels, logits):
+        return tf.nn.sparse_softmax_cross_entropy_with_logits(
+            labels=labels, logits=tf.cast(logits, tf.float32))
+      softmax_loss_function = full_loss
 
     # Create the internal multi-layer cell for our RNN.
     def single_cell():
@@ -123,7 +280,18 @@ class Seq2SeqModel(object):
       cell_dec = tf.nn.rnn_cell.MultiRNNCell([single_cell() for _ in range(num_layers)], state_is_tuple=True)
 
     # The seq2seq function: we use embedding for the input and attention.
+    seq2seq_getter = variable_getter
+    if self.mixed_precision:
+      seq2seq_getter = _compose_getters(variable_getter, _fp32_storage_getter)
+
     def seq2seq_f(encoder_inputs, decoder_inputs, do_decode):
+      if seq2seq_getter:
+        with tf.variable_scope(tf.get_variable_scope(),
+                               custom_getter=seq2seq_getter):
+          return _seq2seq(encoder_inputs, decoder_inputs, do_decode)
+      return _seq2seq(encoder_inputs, decoder_inputs, do_decode)
+
+    def _seq2seq(encoder_inputs, decoder_inputs, do_decode):
       return seq2seq_modified.embedding_attention_seq2seq(
           encoder_inputs,
           decoder_inputs,
@@ -146,7 +314,7 @@ class Seq2SeqModel(object):
     for i in xrange(buckets[-1][1] + 1):
       self.decoder_inputs.append(tf.placeholder(tf.int32, shape=[None],
                                                 name="decoder{0}".format(i)))
-      self.target_weights.append(tf.placeholder(dtype, shape=[None],
+      self.target_weights.append(tf.placeholder(tf.float32, shape=[None],
                                                 name="weight{0}".format(i)))
 
     # Our targets are decoder inputs shifted by one.
@@ -167,9 +335,20 @@ class Seq2SeqModel(object):
       if output_projection is not None:
         for b in xrange(len(buckets)):
           self.outputs[b] = [
-              tf.matmul(output, output_projection[0]) + output_projection[1]
+              seq2seq_modified.project_output(output, output_projection)
               for output in self.outputs[b]
           ]
+      if conversation_context or incremental_decoding:
+        self._build_encoders(cell_enc, size, dtype, seq2seq_getter)
+      if conversation_context:
+        self._build_context_graphs(cell_dec, size, output_projection, dtype,
+                                   seq2seq_getter)
+      if incremental_decoding:
+        self._build_step_graphs(cell_dec, size, output_projection, dtype,
+                                seq2seq_getter)
+      if rescoring:
+        self._build_scoring_graphs(targets, output_projection,
+                                   lambda x, y: seq2seq_f(x, y, False))
     else:
       self.outputs, self.losses = tf.contrib.legacy_seq2seq.model_with_buckets(
           self.encoder_inputs, self.decoder_inputs, targets,
@@ -179,21 +358,238 @@ class Seq2SeqModel(object):
 
       #scope.reuse_variables()
 
+    # Summed full-softmax cross entropy over all target tokens of a batch, for
+    # exact token-weighted perplexity in evaluation (the losses above use the
+    # sampled softmax and are averaged per sequence).
+    self.eval_losses = []
+    for b, (_, decoder_size) in enumerate(buckets):
+      logits = self.outputs[b]
+      if output_projection is not None and not forward_only:
+        logits = [seq2seq_modified.project_output(output, output_projection)
+                  for output in logits]
+      crossent = [
+          tf.nn.sparse_softmax_cross_entropy_with_logits(
+              labels=targets[l], logits=tf.cast(logits[l], tf.float32)) *
+          tf.cast(self.target_weights[l], tf.float32)
+          for l in xrange(decoder_size)]
+      self.eval_losses.append(tf.reduce_sum(tf.add_n(crossent)))
+
     # Gradients and SGD update operation for training the model.
     params = tf.trainable_variables()
     if not forward_only:
       self.gradient_norms = []
       self.updates = []
       opt = tf.train.GradientDescentOptimizer(self.learning_rate)
-      for b in xrange(len(buckets)):
-        gradients = tf.gradients(self.losses[b], params)
-        clipped_gradients, norm = tf.clip_by_global_norm(gradients,
-                                                         max_gradient_norm)
-        self.gradient_norms.append(norm)
-        self.updates.append(opt.apply_gradients(
-            zip(clipped_gradients, params), global_step=self.global_step))
+      if accumulation_steps > 1:
+        self._build_accumulation(opt, params, max_gradient_norm)
+      else:
+        for b in xrange(len(buckets)):
+          gradients = self._gradients(self.losses[b], params)
+          update, norm = self._apply_gradients(opt, gradients, params,
+                                               max_gradient_norm)
+          self.gradient_norms.append(norm)
+          self.updates.append(update)
+
+    self.saver = tf.train.Saver(tf.global_variables(),
+                                max_to_keep=checkpoints_to_keep)
+
+  def _build_encoders(self, cell_enc, size, dtype, variable_getter):
+    """Build an encoder per bucket, sharing the bucketed model's variables.
+
+    self.encoders[b] evaluates to the attention states of bucket b's encoder
+    inputs followed by the flattened final encoder state.
+    """
+    self.encoders = []
+    with tf.variable_scope(tf.get_variable_scope(), reuse=True,
+                           custom_getter=variable_getter):
+      for encoder_size, _ in self.buckets:
+        attention_states, state = (
+            seq2seq_modified.embedding_attention_encoder(
+                self.encoder_inputs[:encoder_size], cell_enc,
+                self.vocab_size, size, dtype=dtype))
+        self.encoders.append([attention_states] + nest.flatten(state))
+
+  def _build_context_graphs(self, cell_dec, size, output_projection, dtype,
+                            variable_getter):
+    """Build the decoder graphs for conversations.
+
+    They share the variables of the bucketed model: per bucket, a greedy
+    decoder attending over states fed through self.context_states (of any
+    length) from the initial state fed through self.context_initial_state.
+    Turns are encoded with self.encoders.
+    """
+    self.context_states = tf.placeholder(
+        dtype, shape=[None, None, size], name="context_states")
+    self.context_initial_state = [
+        tf.placeholder(dtype, shape=[None, state_size],
+                       name="context_state{0}".format(i))
+        for i, state_size in enumerate(nest.flatten(cell_dec.state_size))]
+    initial_state = nest.pack_sequence_as(cell_dec.state_size,
+                                          self.context_initial_state)
+    self.context_outputs = []
+    with tf.variable_scope(tf.get_variable_scope(), reuse=True,
+                           custom_getter=variable_getter):
+      for _, decoder_size in self.buckets:
+        outputs, _ = seq2seq_modified.embedding_attention_decoder_from_states(
+            self.decoder_inputs[:decoder_size], initial_state,
+            self.context_states, cell_dec, self.vocab_size, size,
+            output_projection=output_projection, feed_previous=True,
+            dtype=dtype)
+        if output_projection is not None:
+          outputs = [seq2seq_modified.project_output(output, output_projection)
+                     for output in outputs]
+        self.context_outputs.append(outputs)
+
+  def _build_step_graphs(self, cell_dec, size, output_projection, dtype,
+                         variable_getter):
+    """Build the one-step decoders used by sample_outputs.
+
+    Each runs a single decoder step on the token fed through self.step_token,
+    attending over self.step_states from the state fed through
+    self.step_state, and evaluates to the step's logits followed by the
+    flattened new state. self.step_decoders[0] is the first step (zero
+    initial attention, as in the bucketed decoder); self.step_decoders[1]
+    is every later step: it recomputes the previous step's attention from
+    the fed state, so that chaining the steps gives the same outputs as the
+    bucketed decoder would for the same inputs.
+    """
+    self.step_token = tf.placeholder(tf.int32, shape=[None], name="step_token")
+    self.step_states = tf.placeholder(
+        dtype, shape=[None, None, size], name="step_states")
+    self.step_state = [
+        tf.placeholder(dtype, shape=[None, state_size],
+                       name="step_state{0}".format(i))
+        for i, state_size in enumerate(nest.flatten(cell_dec.state_size))]
+    state = nest.pack_sequence_as(cell_dec.state_size, self.step_state)
+    self.step_decoders = []
+    with tf.variable_scope(tf.get_variable_scope(), reuse=True,
+                           custom_getter=variable_getter):
+      for initial_state_attention in (False, True):
+        outputs, new_state = (
+            seq2seq_modified.embedding_attention_decoder_from_states(
+                [self.step_token], state, self.step_states, cell_dec,
+                self.vocab_size, size, output_projection=output_projection,
+                dtype=dtype, initial_state_attention=initial_state_attention))
+        logits = outputs[0]
+        if output_projection is not None:
+          logits = seq2seq_modified.project_output(logits,
+                                                   output_projection)
+        self.step_decoders.append([logits] + nest.flatten(new_state))
+
+  def _build_scoring_graphs(self, targets, output_projection, seq2seq):
+    """Build the per-example losses used by score_step.
+
+    self.example_losses[b] is, for each example of a batch in bucket b, the
+    mean full-softmax cross entropy of its target tokens, with the decoder
+    fed the targets rather than its own outputs.
+    """
+    def full_loss(labels, logits):
+      if output_projection is not None:
+        logits = seq2seq_modified.project_output(logits, output_projection)
+      return tf.nn.sparse_softmax_cross_entropy_with_logits(
+          labels=labels, logits=tf.cast(logits, tf.float32))
+    with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+      _, self.example_losses = seq2seq_modified.model_with_buckets(
+          self.encoder_inputs, self.decoder_inputs, targets,
+          self.target_weights, self.buckets, seq2seq,
+          softmax_loss_function=full_loss, per_example_loss=True,
+          name="rescoring")
+
+  def _gradients(self, loss, params):
+    """Gradients of loss, computed on the scaled loss with mixed precision."""
+    if not self.mixed_precision:
+      return tf.gradients(loss, params)
+    gradients = []
+    for gradient in tf.gradients(loss * self.loss_scale, params):
+      if isinstance(gradient, tf.IndexedSlices):
+        gradient = tf.IndexedSlices(gradient.values / self.loss_scale,
+                                    gradient.indices, gradient.dense_shape)
+      elif gradient is not None:
+        gradient = gradient / self.loss_scale
+      gradients.append(gradient)
+    return gradients
+
+  def _apply_gradients(self, opt, gradients, params, max_gradient_norm):
+    """Clip gradients by their global norm and apply them.
+
+    With mixed precision, the update is skipped when the gradients are not
+    finite, and the loss scale is halved on overflow or doubled after
+    loss_scale_window finite updates.
 
-    self.saver = tf.train.Saver(tf.global_variables())
+    Returns:
+      A pair (update op, global gradient norm before clipping).
+    """
+    clipped_gradients, norm = tf.clip_by_global_norm(gradients,
+                                                     max_gradient_norm)
+    if not self.mixed_precision:
+      return opt.apply_gradients(zip(clipped_gradients, params),
+                                 global_step=self.global_step), norm
+
+    finite = tf.is_finite(norm)
+    update = tf.cond(
+        finite,
+        lambda: opt.apply_gradients(zip(clipped_gradients, params),
+                                    global_step=self.global_step),
+        tf.no_op)
+    with tf.control_dependencies([update]):
+      good_steps = tf.where(finite, self._good_steps + 1,
+                            tf.zeros_like(self._good_steps))
+      grow = good_steps >= self.loss_scale_window
+      loss_scale = tf.where(
+          finite,
+          tf.where(grow, self.loss_scale * 2.0, self.loss_scale),
+          tf.maximum(self.loss_scale / 2.0, 1.0))
+      adjust = tf.group(
+          self.loss_scale.assign(loss_scale),
+          self._good_steps.assign(
+              tf.where(grow, tf.zeros_like(good_steps), good_steps)))
+    return adjust, norm
+
+  def _build_accumulation(self, opt, params, max_gradient_norm):
+    """Build the ops for accumulate-then-apply training.
+
+    For each bucket, self.accumulate_ops adds the gradients of a batch to the
+    accumulators, and self.updates clips the averaged accumulated gradients
+    by max_gradient_norm, applies them (incrementing global_step once) and
+    zeroes the accumulators. The accumulators are local variables, so they
+    are neither saved nor restored with the model.
+    """
+    num_groups = len(self.buckets) if self.per_bucket_accumulators else 1
+    groups = []
+    for g in xrange(num_groups):
+      with tf.variable_scope("gradient_accumulators_%d" % g):
+        accumulators = [
+            tf.Variable(tf.zeros(p.get_shape(), dtype=p.dtype.base_dtype),
+                        trainable=False, name="accumulator",
+                        collections=[tf.GraphKeys.LOCAL_VARIABLES])
+            for p in params]
+      averaged = [acc / self.accumulation_steps for acc in accumulators]
+      update, norm = self._apply_gradients(opt, averaged, params,
+                                           max_gradient_norm)
+      with tf.control_dependencies([update]):
+        reset = tf.group(*[acc.assign(tf.zeros_like(acc))
+                           for acc in accumulators])
+      groups.append((accumulators, norm, reset))
+
+    self.accumulate_ops = []
+    self._accumulated = [0] * num_groups
+    for b in xrange(len(self.buckets)):
+      accumulators, norm, reset = groups[b if self.per_bucket_accumulators
+                                         else 0]
+      gradients = self._gradients(self.losses[b], params)
+      accumulate = []
+      for acc, gradient in zip(accumulators, gradients):
+        if gradient is None:
+          continue
+        if isinstance(gradient, tf.IndexedSlices):
+          # Embedding gradients are sparse; avoid densifying them.
+          accumulate.append(tf.scatter_add(acc, gradient.indices,
+                                           gradient.values))
+        else:
+          accumulate.append(acc.assign_add(gradient))
+      self.accumulate_ops.append(tf.group(*accumulate))
+      self.gradient_norms.append(norm)
+      self.updates.append(reset)
 
   def step(self, session, encoder_inputs, decoder_inputs, target_weights,
            bucket_id, forward_only):
@@ -208,13 +604,228 @@ class Seq2SeqModel(object):
       forward_only: whether to do the backward step or only forward.
 
     Returns:
-      A triple consisting of gradient norm (or None if we did not do backward),
-      average perplexity, and the outputs.
+      A triple consisting of gradient norm (or None if we did not do backward,
+      or only accumulated the gradients of this batch), average perplexity,
+      and the outputs.
 
     Raises:
       ValueError: if length of encoder_inputs, decoder_inputs, or
         target_weights disagrees with bucket size for the specified bucket_id.
     """
+    _, decoder_size = self.buckets[bucket_id]
+    input_feed = self._input_feed(encoder_inputs, decoder_inputs,
+                                  target_weights, bucket_id)
+
+    if not forward_only and self.accumulation_steps > 1:
+      return self._accumulate_step(session, input_feed, bucket_id)
+
+    # Output feed: depends on whether we do a backward step or not.
+    if not forward_only:
+      output_feed = [self.updates[bucket_id],  # Update Op that does SGD.
+                     self.gradient_norms[bucket_id],  # Gradient norm.
+                     self.losses[bucket_id]]  # Loss for this batch.
+    else:
+      output_feed = [self.losses[bucket_id]]  # Loss for this batch.
+      for l in xrange(decoder_size):  # Output logits.
+        output_feed.append(self.outputs[bucket_id][l])
+
+    outputs = self._run(session, output_feed, input_feed, bucket_id,
+                        "forward" if forward_only else "train")
+    if not forward_only:
+      return outputs[1], outputs[2], None  # Gradient norm, loss, no outputs.
+    else:
+      return None, outputs[0], outputs[1:]  # No gradient norm, loss, outputs.
+
+  def _accumulate_step(self, session, input_feed, bucket_id):
+    """Accumulate the gradients of a batch, applying every N-th time."""
+    group = bucket_id if self.per_bucket_accumulators else 0
+    _, loss = self._run(session, [self.accumulate_ops[bucket_id],
+                                  self.losses[bucket_id]], input_feed,
+                        bucket_id, "accumulate")
+    self._accumulated[group] += 1
+    if self._accumulated[group] < self.accumulation_steps:
+      return None, loss, None
+    self._accumulated[group] = 0
+    _, norm = session.run([self.updates[bucket_id],
+                           self.gradient_norms[bucket_id]])
+    return norm, loss, None
+
+  def _run(self, session, fetches, feed_dict, bucket_id, kind):
+    """session.run, traced by the profiler if one is set and samples it."""
+    options, run_metadata = None, None
+    if self.profiler is not None:
+      options, run_metadata = self.profiler.run_options()
+    results = session.run(fetches, feed_dict, options=options,
+                          run_metadata=run_metadata)
+    if run_metadata is not None:
+      self.profiler.record(run_metadata, bucket_id, kind)
+    return results
+
+  def encode_turn(self, session, token_ids, bucket_id):
+    """Encode one turn of a conversation (needs conversation_context).
+
+    Args:
+      session: tensorflow session to use.
+      token_ids: the token ids of the turn, fitting the bucket.
+      bucket_id: which bucket's encoder to use.
+
+    Returns:
+      A pair (states, final_state): the encoder outputs of the turn's tokens
+      as a [len(token_ids), size] array (without the padding), and the final
+      encoder state as a list of [1, state size] arrays.
+    """
+    encoder_size, _ = self.buckets[bucket_id]
+    input_feed = {}
+    encoder_inputs, _, _ = self.prepare_batch([(token_ids, [])], bucket_id)
+    for l in xrange(encoder_size):
+      input_feed[self.encoder_inputs[l].name] = encoder_inputs[l]
+    results = self._run(session, self.encoders[bucket_id], input_feed,
+                        bucket_id, "encode_turn")
+    # Encoder inputs are padded and then reversed, so the padding comes first;
+    # an empty turn keeps one (padding) state.
+    return (results[0][0, encoder_size - max(len(token_ids), 1):],
+            results[1:])
+
+  def decode_context(self, session, context_states, initial_state, bucket_id):
+    """Greedily decode attending over the states of several turns.
+
+    Args:
+      session: tensorflow session to use.
+      context_states: [length, size] array, e.g. the states returned by
+        encode_turn for the turns of a conversation, concatenated.
+      initial_state: initial decoder state, e.g. the final_state of the last
+        turn from encode_turn.
+      bucket_id: which bucket's decoder size to use.
+
+    Returns:
+      The output logits, as the third result of a forward-only step().
+    """
+    _, decoder_size = self.buckets[bucket_id]
+    input_feed = {self.context_states: context_states[np.newaxis]}
+    for placeholder, value in zip(self.context_initial_state, initial_state):
+      input_feed[placeholder] = value
+    for l in xrange(decoder_size):
+      input_feed[self.decoder_inputs[l].name] = np.array(
+          [data_utils.GO_ID if l == 0 else data_utils.PAD_ID], dtype=np.int32)
+    return self._run(session, self.context_outputs[bucket_id], input_feed,
+                     bucket_id, "decode_context")
+
+  def sample_outputs(self, session, token_ids, bucket_id, sampler):
+    """Decode a batch of inputs, sampling each token (needs
+    incremental_decoding).
+
+    Args:
+      session: tensorflow session to use.
+      token_ids: list of token-id lists that fit the bucket.
+      bucket_id: which bucket's encoder and decoder size to use.
+      sampler: sampling.Sampler, or any function picking one token id per
+        row of a [batch, vocab] logits array.
+
+    Returns:
+      For each input, the sampled token ids cut before the first EOS.
+    """
+    encoder_size, _ = self.buckets[bucket_id]
+    encoder_inputs, _, _ = self.prepare_batch(
+        [(ids, []) for ids in token_ids], bucket_id)
+    input_feed = {}
+    for l in xrange(encoder_size):
+      input_feed[self.encoder_inputs[l].name] = encoder_inputs[l]
+    results = self._run(session, self.encoders[bucket_id], input_feed,
+                        bucket_id, "encode")
+    return self.sample_from_states(session, results[0], results[1:],
+                                   bucket_id, sampler)
+
+  def sample_from_states(self, session, attention_states, initial_state,
+                         bucket_id, sampler):
+    """Run the one-step decoder, feeding back sampled tokens.
+
+    Rows that have produced EOS are dropped from the batch, so later steps
+    only run the unfinished ones.
+
+    Args:
+      session: tensorflow session to use.
+      attention_states: [batch, length, size] encoder outputs, e.g. from
+        self.encoders or the concatenated turns of a conversation.
+      initial_state: initial decoder state as a list of [batch, state size]
+        arrays.
+      bucket_id: at most the bucket's decoder size tokens are decoded.
+      sampler: function picking one token id per row of a logits array.
+
+    Returns:
+      For each row, the sampled token ids cut before the first EOS.
+    """
+    _, decoder_size = self.buckets[bucket_id]
+    batch_size = len(attention_states)
+    outputs = [[] for _ in xrange(batch_size)]
+    rows = np.arange(batch_size)
+    tokens = np.full(batch_size, data_utils.GO_ID, dtype=np.int32)
+    state = initial_state
+    for l in xrange(decoder_size):
+      input_feed = {self.step_token: tokens,
+                    self.step_states: attention_states}
+      for placeholder, value in zip(self.step_state, state):
+        input_feed[placeholder] = value
+      results = self._run(session, self.step_decoders[min(l, 1)], input_feed,
+                          bucket_id, "sample")
+      tokens = np.asarray(sampler(results[0]), dtype=np.int32)
+      state = results[1:]
+      for row, token in zip(rows, tokens.tolist()):
+        if token != data_utils.EOS_ID:
+          outputs[row].append(token)
+      unfinished = tokens != data_utils.EOS_ID
+      if not unfinished.all():
+        if not unfinished.any():
+          break
+        rows, tokens = rows[unfinished], tokens[unfinished]
+        attention_states = attention_states[unfinished]
+        state = [value[unfinished] for value in state]
+    return outputs
+
+  def eval_step(self, session, encoder_inputs, decoder_inputs, target_weights,
+                bucket_id):
+    """Run a forward step returning the summed cross entropy of the batch.
+
+    Args:
+      session: tensorflow session to use.
+      encoder_inputs: list of numpy int vectors to feed as encoder inputs.
+      decoder_inputs: list of numpy int vectors to feed as decoder inputs.
+      target_weights: list of numpy float vectors to feed as target weights.
+      bucket_id: which bucket of the model to use.
+
+    Returns:
+      A pair (loss_sum, num_tokens): the full-softmax cross entropy summed
+      over all non-padding target tokens, and the number of such tokens.
+    """
+    input_feed = self._input_feed(encoder_inputs, decoder_inputs,
+                                  target_weights, bucket_id)
+    loss_sum = session.run(self.eval_losses[bucket_id], input_feed)
+    return float(loss_sum), float(np.sum(target_weights))
+
+  def score_step(self, session, encoder_inputs, decoder_inputs,
+                 target_weights, bucket_id):
+    """Return the log-likelihood of each target in a batch (needs rescoring).
+
+    Args:
+      session: tensorflow session to use.
+      encoder_inputs: list of numpy int vectors to feed as encoder inputs.
+      decoder_inputs: list of numpy int vectors to feed as decoder inputs.
+      target_weights: list of numpy float vectors to feed as target weights.
+      bucket_id: which bucket of the model to use.
+
+    Returns:
+      A pair of [batch] arrays: the summed log-probabilities of the
+      non-padding target tokens, and the number of such tokens.
+    """
+    input_feed = self._input_feed(encoder_inputs, decoder_inputs,
+                                  target_weights, bucket_id)
+    mean_losses = self._run(session, self.example_losses[bucket_id],
+                            input_feed, bucket_id, "score")
+    lengths = np.sum(target_weights, axis=0)
+    return -mean_losses * lengths, lengths
+
+  def _input_feed(self, encoder_inputs, decoder_inputs, target_weights,
+                  bucket_id):
+    """Check the batch against the bucket sizes and build the feed dict."""
     # Check if the sizes match.
     encoder_size, decoder_size = self.buckets[bucket_id]
     if len(encoder_inputs) != encoder_size:
@@ -237,47 +848,54 @@ class Seq2SeqModel(object):
 
     # Since our targets are decoder inputs shifted by one, we need one more.
     last_target = self.decoder_inputs[decoder_size].name
-    input_feed[last_target] = np.zeros([self.batch_size], dtype=np.int32)
+    input_feed[last_target] = np.zeros([len(encoder_inputs[0])],
+                                       dtype=np.int32)
+    return input_feed
 
-    # Output feed: depends on whether we do a backward step or not.
-    if not forward_only:
-      output_feed = [self.updates[bucket_id],  # Update Op that does SGD.
-                     self.gradient_norms[bucket_id],  # Gradient norm.
-                     self.losses[bucket_id]]  # Loss for this batch.
-    else:
-      output_feed = [self.losses[bucket_id]]  # Loss for this batch.
-      for l in xrange(decoder_size):  # Output logits.
-        output_feed.append(self.outputs[bucket_id][l])
+  def get_batch(self, data, bucket_id, rng=random):
+    """Get a random batch of data from the specified bucket, prepare for step.
 
-    outputs = session.run(output_feed, input_feed)
-    if not forward_only:
-      return outputs[1], outputs[2], None  # Gradient norm, loss, no outputs.
+    Args:
+      data: a tuple of size len(self.buckets) in which each element contains
+        pairs of input and output data that we use to create a batch, as a
+        pair_store.PairStore or a list.
+      bucket_id: integer, which bucket to get the batch for.
+      rng: random.Random to draw the pairs with; defaults to the random
+        module.
+
+    Returns:
+      The triple (encoder_inputs, decoder_inputs, target_weights) for
+      the constructed batch that has the proper format to call step(...) later.
+    """
+    if isinstance(data[bucket_id], pair_store.PairStore):
+      pairs = data[bucket_id].sample(self.batch_size, rng)
     else:
-      return None, outputs[0], outputs[1:]  # No gradient norm, loss, outputs.
+      pairs = [rng.choice(data[bucket_id]) for _ in xrange(self.batch_size)]
+    return self.prepare_batch(pairs, bucket_id)
 
-  def get_batch(self, data, bucket_id):
-    """Get a random batch of data from the specified bucket, prepare for step.
+  def prepare_batch(self, pairs, bucket_id):
+    """Pad and re-index the given pairs into a batch for step(...).
 
     To feed data in step(..) it must be a list of batch-major vectors, while
     data here contains single length-major cases. So the main logic of this
     function is to re-index data cases to be in the proper format for feeding.
 
     Args:
-      data: a tuple of size len(self.buckets) in which each element contains
-        lists of pairs of input and output data that we use to create a batch.
-      bucket_id: integer, which bucket to get the batch for.
+      pairs: a list of (input, output) token-id lists that fit the bucket;
+        the batch size is len(pairs).
+      bucket_id: integer, which bucket to prepare the batch for.
 
     Returns:
       The triple (encoder_inputs, decoder_inputs, target_weights) for
       the constructed batch that has the proper format to call step(...) later.
     """
     encoder_size, decoder_size = self.buckets[bucket_id]
+    batch_size = len(pairs)
     encoder_inputs, decoder_inputs = [], []
 
-    # Get a random batch of encoder and decoder inputs from data,
-    # pad them if needed, reverse encoder inputs and add GO to decoder.
-    for _ in xrange(self.batch_size):
-      encoder_input, decoder_input = random.choice(data[bucket_id])
+    # Pad the encoder and decoder inputs if needed, reverse encoder inputs
+    # and add GO to decoder.
+    for encoder_input, decoder_input in pairs:
 
       # Encoder inputs are padded and then reversed.
       encoder_pad = [data_utils.PAD_ID] * (encoder_size - len(encoder_input))
@@ -295,17 +913,17 @@ class Seq2SeqModel(object):
     for length_idx in xrange(encoder_size):
       batch_encoder_inputs.append(
           np.array([encoder_inputs[batch_idx][length_idx]
-                    for batch_idx in xrange(self.batch_size)], dtype=np.int32))
+                    for batch_idx in xrange(batch_size)], dtype=np.int32))
 
     # Batch decoder inputs are re-indexed decoder_inputs, we create weights.
     for length_idx in xrange(decoder_size):
       batch_decoder_inputs.append(
           np.array([decoder_inputs[batch_idx][length_idx]
-                    for batch_idx in xrange(self.batch_size)], dtype=np.int32))
+                    for batch_idx in xrange(batch_size)], dtype=np.int32))
 
       # Create target_weights to be 0 for targets that are padding.
-      batch_weight = np.ones(self.batch_size, dtype=np.float32)
-      for batch_idx in xrange(self.batch_size):
+      batch_weight = np.ones(batch_size, dtype=np.float32)
+      for batch_idx in xrange(batch_size):
         # We set weight to 0 if the corresponding target is a PAD symbol.
         # The corresponding target is decoder_input shifted by 1 forward.
         if length_idx < decoder_size - 1:
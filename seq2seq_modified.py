@@ -35,6 +35,8 @@ one of them, others should be easy to substitute.
   - embedding_tied_rnn_seq2seq: The tied model with input embedding.
   - embedding_attention_seq2seq: Advanced model with input embedding and
       the neural attention mechanism; recommended for complex tasks.
+  - embedding_attention_encoder, embedding_attention_decoder_from_states:
+      the two halves of embedding_attention_seq2seq, to run them separately.
 
 * Multi-task sequence-to-sequence models.
   - one2many_rnn_seq2seq: The embedding model with multiple decoders.
@@ -57,6 +59,7 @@ from __future__ import division
 from __future__ import print_function
 
 import copy
+import math
 
 # We disable pylint because we need python3 compatibility.
 from six.moves import xrange  # pylint: disable=redefined-builtin
@@ -68,6 +71,7 @@ from tensorflow.python.framework import ops
 from tensorflow.python.ops import array_ops
 from tensorflow.python.ops import control_flow_ops
 from tensorflow.python.ops import embedding_ops
+from tensorflow.python.ops import init_ops
 from tensorflow.python.ops import math_ops
 from tensorflow.python.ops import nn_ops
 from tensorflow.python.ops import rnn
@@ -79,6 +83,71 @@ from tensorflow.python.util import nest
 linear = rnn_cell_impl._linear  # pylint: disable=protected-access
 
 
+def _embedding_lookup(embedding, ids, dtype=None):
+  """Look ids up in an embedding, and cast the rows to dtype if given.
+
+  The embedding is a variable or tensor, or an object with its own
+  lookup(ids), such as a quantize_weights.QuantizedMatrix, which dequantizes
+  only the rows looked up. Embeddings of float16 models are float32 master
+  weights (see seq2seq_model._fp32_storage_getter); only their rows are cast.
+  """
+  if hasattr(embedding, "lookup"):
+    rows = embedding.lookup(ids)
+  else:
+    rows = embedding_ops.embedding_lookup(embedding, ids)
+  if dtype is not None and rows.dtype.base_dtype != dtype:
+    rows = math_ops.cast(rows, dtype)
+  return rows
+
+
+def project_output(output, output_projection):
+  """Return output * W + B for an output projection pair (W, B).
+
+  W is a matrix, or an object with its own matmul(inputs), such as a
+  transposed quantize_weights.QuantizedMatrix, whose product is cast to the
+  dtype of output.
+  """
+  weights, biases = output_projection
+  with ops.name_scope("output_projection"):
+    if hasattr(weights, "matmul"):
+      return math_ops.cast(weights.matmul(output), output.dtype) + biases
+    return nn_ops.xw_plus_b(output, weights, biases)
+
+
+class EmbeddingWrapper(core_rnn_cell.EmbeddingWrapper):
+  """EmbeddingWrapper that looks its inputs up with _embedding_lookup.
+
+  The class keeps its parent's name, from which the cell's variable scope
+  is named, so the variables and checkpoints are the same as with it.
+  """
+
+  def call(self, inputs, state):
+    """Run the cell on embedded inputs."""
+    with ops.device("/cpu:0"):
+      if self._initializer:
+        initializer = self._initializer
+      elif variable_scope.get_variable_scope().initializer:
+        initializer = variable_scope.get_variable_scope().initializer
+      else:
+        # Default initializer for embeddings should have variance=1.
+        sqrt3 = math.sqrt(3)  # Uniform(-sqrt(3), sqrt(3)) has variance=1.
+        initializer = init_ops.random_uniform_initializer(-sqrt3, sqrt3)
+
+      if isinstance(state, tuple):
+        data_type = state[0].dtype
+      else:
+        data_type = state.dtype
+
+      embedding = variable_scope.get_variable(
+          "embedding", [self._embedding_classes, self._embedding_size],
+          initializer=initializer,
+          dtype=data_type)
+      embedded = _embedding_lookup(embedding, array_ops.reshape(inputs, [-1]),
+                                   data_type)
+
+      return self._cell(embedded, state)
+
+
 def _extract_argmax_and_embed(embedding,
                               output_projection=None,
                               update_embedding=True):
@@ -97,11 +166,11 @@ def _extract_argmax_and_embed(embedding,
 
   def loop_function(prev, _):
     if output_projection is not None:
-      prev = nn_ops.xw_plus_b(prev, output_projection[0], output_projection[1])
+      prev = project_output(prev, output_projection)
     prev_symbol = math_ops.argmax(prev, 1)
     # Note that gradients will not propagate through the second parameter of
     # embedding_lookup.
-    emb_prev = embedding_ops.embedding_lookup(embedding, prev_symbol)
+    emb_prev = _embedding_lookup(embedding, prev_symbol, prev.dtype)
     if not update_embedding:
       emb_prev = array_ops.stop_gradient(emb_prev)
     return emb_prev
@@ -292,7 +361,7 @@ def embedding_rnn_decoder(decoder_inputs,
     loop_function = _extract_argmax_and_embed(
         embedding, output_projection,
         update_embedding_for_previous) if feed_previous else None
-    emb_inp = (embedding_ops.embedding_lookup(embedding, i)
+    emb_inp = (_embedding_lookup(embedding, i, scope.dtype)
                for i in decoder_inputs)
     return rnn_decoder(
         emb_inp, initial_state, cell, loop_function=loop_function)
@@ -356,7 +425,7 @@ def embedding_rnn_seq2seq(encoder_inputs,
 
     # Encoder.
     encoder_cell = copy.deepcopy(cell)
-    encoder_cell = core_rnn_cell.EmbeddingWrapper(
+    encoder_cell = EmbeddingWrapper(
         encoder_cell,
         embedding_classes=num_encoder_symbols,
         embedding_size=embedding_size)
@@ -476,10 +545,10 @@ def embedding_tied_rnn_seq2seq(encoder_inputs,
         "embedding", [num_symbols, embedding_size], dtype=dtype)
 
     emb_encoder_inputs = [
-        embedding_ops.embedding_lookup(embedding, x) for x in encoder_inputs
+        _embedding_lookup(embedding, x, dtype) for x in encoder_inputs
     ]
     emb_decoder_inputs = [
-        embedding_ops.embedding_lookup(embedding, x) for x in decoder_inputs
+        _embedding_lookup(embedding, x, dtype) for x in decoder_inputs
     ]
 
     output_symbols = num_symbols
@@ -772,7 +841,7 @@ def embedding_attention_decoder(decoder_inputs,
         embedding, output_projection,
         update_embedding_for_previous) if feed_previous else None
     emb_inp = [
-        embedding_ops.embedding_lookup(embedding, i) for i in decoder_inputs
+        _embedding_lookup(embedding, i, scope.dtype) for i in decoder_inputs
     ]
     return attention_decoder(
         emb_inp,
@@ -848,7 +917,7 @@ def embedding_attention_seq2seq(encoder_inputs,
     dtype = scope.dtype
     # Encoder.
     encoder_cell = cell_enc
-    encoder_cell = core_rnn_cell.EmbeddingWrapper(
+    encoder_cell = EmbeddingWrapper(
         encoder_cell,
         embedding_classes=num_encoder_symbols,
         embedding_size=embedding_size)
@@ -916,6 +985,109 @@ def embedding_attention_seq2seq(encoder_inputs,
     return outputs_and_state[:outputs_len], state
 
 
+def embedding_attention_encoder(encoder_inputs,
+                                cell_enc,
+                                num_encoder_symbols,
+                                embedding_size,
+                                dtype=None,
+                                scope=None):
+  """Encoder half of embedding_attention_seq2seq.
+
+  Builds the same ops, with the same variable names, as the encoder of
+  embedding_attention_seq2seq in the same scope; call it with reuse to share
+  the variables of an existing model, e.g. to encode inputs separately and
+  cache the results.
+
+  Args:
+    encoder_inputs: A list of 1D int32 Tensors of shape [batch_size].
+    cell_enc: tf.nn.rnn_cell.RNNCell defining the encoder cell function and size.
+    num_encoder_symbols: Integer; number of symbols on the encoder side.
+    embedding_size: Integer, the length of the embedding vector for each symbol.
+    dtype: The dtype of the initial RNN state (default: tf.float32).
+    scope: VariableScope for the created subgraph; defaults to
+      "embedding_attention_seq2seq".
+
+  Returns:
+    A tuple (attention_states, encoder_state), where:
+      attention_states: 3D Tensor [batch_size x len(encoder_inputs) x
+        cell_enc.output_size] of the encoder outputs.
+      encoder_state: The state of the encoder cell at the final time-step.
+  """
+  with variable_scope.variable_scope(
+      scope or "embedding_attention_seq2seq", dtype=dtype) as scope:
+    dtype = scope.dtype
+    encoder_cell = EmbeddingWrapper(
+        cell_enc,
+        embedding_classes=num_encoder_symbols,
+        embedding_size=embedding_size)
+    encoder_outputs, encoder_state = rnn.static_rnn(
+        encoder_cell, encoder_inputs, dtype=dtype)
+    top_states = [
+        array_ops.reshape(e, [-1, 1, cell_enc.output_size]) for e in encoder_outputs
+    ]
+    return array_ops.concat(top_states, 1), encoder_state
+
+
+def embedding_attention_decoder_from_states(decoder_inputs,
+                                            encoder_state,
+                                            attention_states,
+                                            cell_dec,
+                                            num_decoder_symbols,
+                                            embedding_size,
+                                            num_heads=1,
+                                            output_projection=None,
+                                            feed_previous=False,
+                                            dtype=None,
+                                            scope=None,
+                                            initial_state_attention=False):
+  """Decoder half of embedding_attention_seq2seq.
+
+  The counterpart of embedding_attention_encoder: runs the attention decoder
+  of embedding_attention_seq2seq, with the same variable names, on given
+  encoder results. attention_states may have a length only known at run
+  time, e.g. the cached encoder outputs of several inputs concatenated.
+
+  Args:
+    decoder_inputs: A list of 1D int32 Tensors of shape [batch_size].
+    encoder_state: The initial state of the decoder cell.
+    attention_states: 3D Tensor [batch_size x attn_length x attn_size].
+    cell_dec: tf.nn.rnn_cell.RNNCell defining the decoder cell function and size.
+    num_decoder_symbols: Integer; number of symbols on the decoder side.
+    embedding_size: Integer, the length of the embedding vector for each symbol.
+    num_heads: Number of attention heads that read from attention_states.
+    output_projection: None or a pair (W, B), as for
+      embedding_attention_seq2seq.
+    feed_previous: Boolean; if True, only the first of decoder_inputs will be
+      used (the "GO" symbol), and all other decoder inputs will be taken from
+      previous outputs.
+    dtype: The dtype of the initial RNN state (default: tf.float32).
+    scope: VariableScope for the created subgraph; defaults to
+      "embedding_attention_seq2seq".
+    initial_state_attention: If False (default), initial attentions are zero.
+
+  Returns:
+    A tuple (outputs, state) as for embedding_attention_seq2seq.
+  """
+  with variable_scope.variable_scope(
+      scope or "embedding_attention_seq2seq", dtype=dtype):
+    output_size = None
+    if output_projection is None:
+      cell_dec = core_rnn_cell.OutputProjectionWrapper(cell_dec, num_decoder_symbols)
+      output_size = num_decoder_symbols
+    return embedding_attention_decoder(
+        decoder_inputs,
+        encoder_state,
+        attention_states,
+        cell_dec,
+        num_decoder_symbols,
+        embedding_size,
+        num_heads=num_heads,
+        output_size=output_size,
+        output_projection=output_projection,
+        feed_previous=feed_previous,
+        initial_state_attention=initial_state_attention)
+
+
 def one2many_rnn_seq2seq(encoder_inputs,
                          decoder_inputs_dict,
                          enc_cell,
@@ -986,7 +1158,7 @@ def one2many_rnn_seq2seq(encoder_inputs,
     dtype = scope.dtype
 
     # Encoder.
-    enc_cell = core_rnn_cell.EmbeddingWrapper(
+    enc_cell = EmbeddingWrapper(
         enc_cell,
         embedding_classes=num_encoder_symbols,
         embedding_size=embedding_size)
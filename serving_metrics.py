@@ -0,0 +1,144 @@
+"""Latency histograms and counters for the serving path, in Prometheus format.
+
+ShakespeareBot.respond times each stage of a reply with a StageTimer and
+counts bucket usage and overflowing inputs; app.py exposes everything on
+/metrics in the Prometheus text exposition format. Metrics are only
+collected when Configuration.METRICS is set: otherwise stage_timer()
+returns a timer that does nothing and the counters return immediately.
+"""
+import threading
+import time
+
+from app_config import Configuration
+
+ENABLED = bool(Configuration.METRICS)
+
+LATENCY_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5,
+                   1.0, 2.5, 5.0, 10.0)
+
+_registry = []
+_lock = threading.Lock()
+
+
+def _labels(label, value):
+    return '{%s="%s"}' % (label, value) if label else ''
+
+
+class Counter(object):
+    """A counter, optionally split by the values of one label."""
+
+    def __init__(self, name, description, label=None):
+        self.name = name
+        self.description = description
+        self.label = label
+        self.values = {}
+        _registry.append(self)
+
+    def inc(self, label_value=None, amount=1):
+        if not ENABLED:
+            return
+        with _lock:
+            self.values[label_value] = self.values.get(label_value, 0) + amount
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.description),
+                 '# TYPE %s counter' % self.name]
+        for value, count in sorted(self.values.items()):
+            lines.append('%s%s %s' % (self.name, _labels(self.label, value), count))
+        return lines
+
+
+class Histogram(object):
+    """A histogram with fixed buckets, optionally split by one label."""
+
+    def __init__(self, name, description, label=None, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.label = label
+        self.buckets = buckets
+        # label value -> [counts per bucket (+Inf last), sum]
+        self.values = {}
+        _registry.append(self)
+
+    def observe(self, amount, label_value=None):
+        if not ENABLED:
+            return
+        with _lock:
+            counts = self.values.get(label_value)
+            if counts is None:
+                counts = self.values[label_value] = [[0] * (len(self.buckets) + 1), 0.0]
+            for i, bound in enumerate(self.buckets):
+                if amount <= bound:
+                    counts[0][i] += 1
+                    break
+            else:
+                counts[0][-1] += 1
+            counts[1] += amount
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.description),
+                 '# TYPE %s histogram' % self.name]
+        for value, (counts, total) in sorted(self.values.items()):
+            prefix = '%s="%s",' % (self.label, value) if self.label else ''
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append('%s_bucket{%sle="%s"} %d'
+                             % (self.name, prefix, bound, cumulative))
+            lines.append('%s_sum%s %f' % (self.name, _labels(self.label, value), total))
+            lines.append('%s_count%s %d' % (self.name, _labels(self.label, value),
+                                            cumulative))
+        return lines
+
+
+def render():
+    """Return all metrics in the Prometheus text exposition format."""
+    with _lock:
+        lines = []
+        for metric in _registry:
+            lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+STAGE_SECONDS = Histogram('respond_stage_seconds',
+                          'Time spent in each stage of respond().', 'stage')
+RESPOND_SECONDS = Histogram('respond_seconds', 'Total time of respond().')
+BUCKET_REQUESTS = Counter('respond_bucket_requests_total',
+                          'Replies generated per bucket.', 'bucket')
+OVERFLOW_INPUTS = Counter('respond_overflow_inputs_total',
+                          'Inputs longer than the largest bucket, by the '
+                          'overflow policy applied.', 'policy')
+CONVERSATION_EVICTIONS = Counter('conversation_evictions_total',
+                                 'Conversations dropped from memory, by reason '
+                                 '(ttl or memory).', 'reason')
+
+
+class StageTimer(object):
+    """Records the time since the previous mark under each stage name."""
+
+    def __init__(self):
+        self.start = self.last = time.time()
+
+    def mark(self, stage):
+        now = time.time()
+        STAGE_SECONDS.observe(now - self.last, stage)
+        self.last = now
+
+    def finish(self):
+        RESPOND_SECONDS.observe(time.time() - self.start)
+
+
+class _NullTimer(object):
+
+    def mark(self, stage):
+        pass
+
+    def finish(self):
+        pass
+
+_NULL_TIMER = _NullTimer()
+
+
+def stage_timer():
+    """Return a StageTimer, or a no-op timer if metrics are disabled."""
+    return StageTimer() if ENABLED else _NULL_TIMER
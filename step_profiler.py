@@ -0,0 +1,166 @@
+# Early Modern English dialogue generation, by Erika Varis Doggett
+
+# Python 3
+# ==============================================================================
+
+"""Sampled op-level tracing of Seq2SeqModel steps.
+
+When a StepProfiler is attached to a model (model.profiler), a random
+fraction of step() calls run with a full trace. The latest traced steps are
+kept as Chrome traces (open them in chrome://tracing), and the op times and
+memory of every traced step are added to totals per kind of step ("train",
+"sample", ...) and bucket, both by op type and by name scope. Op types say
+which kernels dominate, but a MatMul may belong to any part of the model;
+the scopes tell the parts apart: the LSTM cells ("multi_rnn_cell"), the
+attention ("Attention"), the embeddings ("embedding_lookup"), the sampled
+softmax ("sampled_softmax_loss") and the output projection
+("output_projection"), with their gradients under "gradients/".
+"""
+
+import collections
+import os
+import random
+import re
+
+import tensorflow as tf
+from tensorflow.python.client import timeline
+
+
+# Name scope components that name a part of the model; an op's scope is cut
+# after the last of these in its name.
+_PART_SCOPES = ("multi_rnn_cell", "Attention", "AttnOutputProjection",
+                "embedding_lookup", "sampled_softmax_loss",
+                "output_projection")
+
+
+def _scope(node_name, depth):
+  """The name scope an op's statistics are added to.
+
+  Numbered copies of a scope (per bucket, decoder step or attention head)
+  are merged by dropping their "_<n>" suffixes. The scope ends after the last
+  part of the model it names, or else after depth components.
+  """
+  parts = [re.sub(r"_\d+$", "", part) for part in node_name.split("/")[:-1]]
+  end = min(len(parts), depth)
+  for i, part in enumerate(parts):
+    if part in _PART_SCOPES:
+      end = i + 1
+  return "/".join(parts[:end]) or "(root)"
+
+
+class StepProfiler(object):
+  """Traces a sampled fraction of steps and aggregates op statistics."""
+
+  def __init__(self, output_dir, fraction, top_k=15, summary_every=10,
+               rng=None, max_traces=20, scope_depth=3):
+    """Create the profiler.
+
+    Args:
+      output_dir: directory to write the Chrome traces and summary to.
+      fraction: fraction of steps to trace, between 0 and 1.
+      top_k: number of op types and scopes listed per bucket in the summary.
+      summary_every: rewrite summary.txt after this many traced steps.
+      rng: random.Random used to sample steps.
+      max_traces: number of the latest Chrome traces kept; older ones are
+        deleted. 0 writes none.
+      scope_depth: name scope components kept for ops outside the parts of
+        the model listed in _PART_SCOPES.
+    """
+    self.output_dir = output_dir
+    self.fraction = fraction
+    self.top_k = top_k
+    self.summary_every = summary_every
+    self.rng = rng or random.Random()
+    self.max_traces = max_traces
+    self.scope_depth = scope_depth
+    self.traced = 0
+    # (kind, bucket_id) -> op type or scope -> [count, microseconds, bytes]
+    self.op_stats = collections.defaultdict(
+        lambda: collections.defaultdict(lambda: [0, 0, 0]))
+    self.scope_stats = collections.defaultdict(
+        lambda: collections.defaultdict(lambda: [0, 0, 0]))
+    self.traced_steps = collections.Counter()
+    self._trace_paths = collections.deque()
+    if not tf.gfile.Exists(output_dir):
+      tf.gfile.MakeDirs(output_dir)
+
+  def run_options(self):
+    """Return (options, run_metadata) for session.run, or (None, None)."""
+    if self.rng.random() >= self.fraction:
+      return None, None
+    options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+    return options, tf.RunMetadata()
+
+  def record(self, run_metadata, bucket_id, kind):
+    """Write the trace of a step and add its op statistics to the totals.
+
+    Args:
+      run_metadata: the tf.RunMetadata filled in by session.run.
+      bucket_id: bucket the step ran on.
+      kind: short description of the step, e.g. "train" or "forward".
+    """
+    self.traced += 1
+    key = (kind, bucket_id)
+    self.traced_steps[key] += 1
+    if self.max_traces > 0:
+      self._write_trace(run_metadata, kind, bucket_id)
+
+    op_stats = self.op_stats[key]
+    scope_stats = self.scope_stats[key]
+    for device in run_metadata.step_stats.dev_stats:
+      for node in device.node_stats:
+        # timeline_label looks like "name = OpType(input, ...)".
+        label = node.timeline_label
+        op_type = (label.split(" = ", 1)[1].split("(", 1)[0]
+                   if " = " in label else node.node_name)
+        allocated = sum(memory.total_bytes for memory in node.memory)
+        for op in (op_stats[op_type],
+                   scope_stats[_scope(node.node_name, self.scope_depth)]):
+          op[0] += 1
+          op[1] += node.all_end_rel_micros
+          op[2] += allocated
+    if self.traced % self.summary_every == 0:
+      self.write_summary()
+
+  def _write_trace(self, run_metadata, kind, bucket_id):
+    """Write a step's Chrome trace, deleting all but the latest max_traces."""
+    trace = timeline.Timeline(run_metadata.step_stats)
+    path = os.path.join(self.output_dir, "timeline_%s_bucket%d_%05d.json"
+                        % (kind, bucket_id, self.traced))
+    with tf.gfile.GFile(path, mode="w") as f:
+      f.write(trace.generate_chrome_trace_format(show_memory=True))
+    self._trace_paths.append(path)
+    while len(self._trace_paths) > self.max_traces:
+      tf.gfile.Remove(self._trace_paths.popleft())
+
+  def summary(self):
+    """Return the top op types and scopes by time and memory.
+
+    Each kind of step and bucket is listed separately.
+    """
+    lines = []
+    for key in sorted(self.op_stats):
+      kind, bucket_id = key
+      steps = float(self.traced_steps[key])
+      lines.append("%s, bucket %d: %d traced steps" % (kind, bucket_id, steps))
+      for title, stats in (("op type", self.op_stats[key]),
+                           ("scope", self.scope_stats[key])):
+        total = sum(op[1] for op in stats.values()) or 1
+        lines.append("  by time, per %s:" % title)
+        for name, (count, micros, _) in sorted(
+            stats.items(), key=lambda item: -item[1][1])[:self.top_k]:
+          lines.append("    %10.2f ms/step %5.1f%% %7d ops/step  %s"
+                       % (micros / steps / 1000.0, 100.0 * micros / total,
+                          count / steps, name))
+        lines.append("  by memory, per %s:" % title)
+        for name, (_, _, allocated) in sorted(
+            stats.items(), key=lambda item: -item[1][2])[:self.top_k]:
+          lines.append("    %10.1f MB/step  %s"
+                       % (allocated / steps / float(1 << 20), name))
+    return "\n".join(lines)
+
+  def write_summary(self):
+    """Write summary() to summary.txt in the output directory."""
+    with tf.gfile.GFile(os.path.join(self.output_dir, "summary.txt"),
+                        mode="w") as f:
+      f.write(self.summary() + "\n")
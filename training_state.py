@@ -0,0 +1,65 @@
+# Early Modern English dialogue generation, by Erika Varis Doggett
+
+# Python 3
+# ==============================================================================
+
+"""Training loop state saved alongside each TF checkpoint.
+
+A TF checkpoint holds the model variables (including the global step and
+the learning rate) but not the state of the training loop: the losses of
+earlier checkpoint intervals that drive the learning rate decay, the step
+counters and the position of the data stream. save() writes these as JSON
+next to the checkpoint they belong to, as <checkpoint path>.state.json, by
+writing a temporary file and renaming it, so a preempted job leaves either
+the complete new file or none. load() reads the state of the checkpoint
+being restored; a checkpoint whose state was never written (or an older
+checkpoint without one) has none, and training continues from a fresh loop
+state as before.
+"""
+
+import glob
+import json
+import os
+import re
+
+
+STATE_SUFFIX = ".state.json"
+
+
+def state_path(checkpoint_path):
+  """Path of the state file of a checkpoint, e.g. translate.ckpt-200."""
+  return checkpoint_path + STATE_SUFFIX
+
+
+def save(checkpoint_path, state):
+  """Atomically write state, a JSON-serializable dict, for a checkpoint."""
+  path = state_path(checkpoint_path)
+  temp_path = path + ".tmp"
+  with open(temp_path, "w") as f:
+    json.dump(state, f)
+    f.flush()
+    os.fsync(f.fileno())
+  os.replace(temp_path, path)
+  return path
+
+
+def load(checkpoint_path):
+  """Return the state saved for a checkpoint, or None if there is none."""
+  path = state_path(checkpoint_path)
+  if not os.path.exists(path):
+    return None
+  with open(path) as f:
+    return json.load(f)
+
+
+def prune(checkpoint_prefix, keep):
+  """Delete all but the state files of the keep latest checkpoints."""
+  step_re = re.compile(re.escape(checkpoint_prefix) + r"-(\d+)" +
+                       re.escape(STATE_SUFFIX) + "$")
+  paths = []
+  for path in glob.glob(checkpoint_prefix + "-*" + STATE_SUFFIX):
+    match = step_re.match(path)
+    if match:
+      paths.append((int(match.group(1)), path))
+  for _, path in sorted(paths)[:-keep]:
+    os.remove(path)
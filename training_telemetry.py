@@ -0,0 +1,139 @@
+# Early Modern English dialogue generation, by Erika Varis Doggett
+
+# Python 3
+# ==============================================================================
+
+"""Per-step training telemetry written to TensorBoard and a JSONL file.
+
+The training loop hands each step's numbers to TelemetryWriter.log_step,
+which only puts them on a queue; a background thread turns them into
+TensorBoard summaries and JSON lines. If the writer falls behind, records
+are dropped (and counted) rather than blocking training. If writing fails,
+the thread stops, later records are dropped, and close() raises the error.
+"""
+
+import json
+import os
+import threading
+import time
+
+from six.moves import queue
+import tensorflow as tf
+
+
+_STOP = object()
+
+
+class TelemetryWriter(object):
+  """Writes per-step training metrics in the background."""
+
+  def __init__(self, log_dir, max_pending=10000, flush_every=100):
+    """Create the writer and start its background thread.
+
+    Args:
+      log_dir: directory for the TensorBoard event files and telemetry.jsonl.
+      max_pending: records that may wait to be written before new ones are
+        dropped.
+      flush_every: flush the JSONL file after this many records.
+    """
+    if not tf.gfile.Exists(log_dir):
+      tf.gfile.MakeDirs(log_dir)
+    self.dropped = 0
+    self._flush_every = flush_every
+    self._summary_writer = tf.summary.FileWriter(log_dir)
+    self._jsonl = open(os.path.join(log_dir, "telemetry.jsonl"), "a")
+    self._queue = queue.Queue(maxsize=max_pending)
+    self._error = None
+    self._thread = threading.Thread(target=self._run,
+                                    name="telemetry-writer")
+    self._thread.daemon = True
+    self._thread.start()
+
+  def log_step(self, step, bucket_id, loss, gradient_norm, batch_time,
+               step_time, batch_size):
+    """Queue the metrics of one training step; never blocks.
+
+    Args:
+      step: training step number.
+      bucket_id: bucket the batch came from.
+      loss: loss of the batch.
+      gradient_norm: global gradient norm before clipping, or None if no
+        update was applied (e.g. while accumulating gradients).
+      batch_time: seconds spent preparing the batch.
+      step_time: seconds spent in model.step.
+      batch_size: examples in the batch.
+    """
+    record = {
+        "time": time.time(),
+        "step": step,
+        "bucket": bucket_id,
+        "loss": float(loss),
+        "gradient_norm": (float(gradient_norm) if gradient_norm is not None
+                          else None),
+        "batch_time": batch_time,
+        "step_time": step_time,
+        "examples_per_sec": batch_size / (batch_time + step_time),
+    }
+    if self._error is not None:
+      self.dropped += 1
+      return
+    try:
+      self._queue.put_nowait(record)
+    except queue.Full:
+      self.dropped += 1
+
+  def close(self, timeout=60):
+    """Write out all queued records and close the files.
+
+    Args:
+      timeout: seconds to wait for the background thread to take the last
+        records and to finish.
+
+    Raises:
+      RuntimeError: if the background writer failed or did not finish.
+    """
+    if self._thread.is_alive():
+      try:
+        self._queue.put(_STOP, timeout=timeout)
+        self._thread.join(timeout)
+      except queue.Full:
+        pass
+      if self._thread.is_alive() and self._error is None:
+        self._error = "writer did not finish within %ds" % timeout
+    if not self._thread.is_alive():
+      self._summary_writer.close()
+      self._jsonl.close()
+    self._raise_if_failed()
+
+  def _raise_if_failed(self):
+    if self._error is not None:
+      raise RuntimeError("Background telemetry write failed: %s"
+                         % self._error)
+
+  def _run(self):
+    written = 0
+    while True:
+      record = self._queue.get()
+      if record is _STOP:
+        return
+      try:
+        self._write(record)
+        written += 1
+        if written % self._flush_every == 0:
+          self._jsonl.flush()
+      except Exception as e:  # pylint: disable=broad-except
+        self._error = e
+        return
+
+  def _write(self, record):
+    self._jsonl.write(json.dumps(record) + "\n")
+    values = [tf.Summary.Value(tag="train/%s" % key,
+                               simple_value=record[key])
+              for key in ("loss", "gradient_norm", "batch_time",
+                          "step_time", "examples_per_sec")
+              if record[key] is not None]
+    values.append(tf.Summary.Value(
+        tag="train/loss_bucket%d" % record["bucket"],
+        simple_value=record["loss"]))
+    self._summary_writer.add_summary(tf.Summary(value=values),
+                                     record["step"])
@@ -0,0 +1,176 @@
+# Early Modern English dialogue generation, by Erika Varis Doggett
+
+# Python 3
+# ==============================================================================
+
+"""Compact, memory-mappable vocabulary for tokenizing and detokenizing.
+
+data_utils.initialize_vocabulary builds both a dict of bytes to ids and a
+list of bytes for every vocabulary file. CompactVocabulary instead keeps all
+words in one contiguous buffer, with an array of offsets for id-to-word and
+an open-addressing hash table (crc32, linear probing) for word-to-id. The
+three arrays are stored in a binary file next to the text vocabulary
+("vocab55000.from.bin") and memory-mapped, so loading is instant and
+processes serving the same model share the pages.
+
+The object supports the parts of the dict and list interfaces the rest of
+the code uses (get, in, [id], len), so it can be passed to
+data_utils.sentence_to_token_ids as is, and decode() turns a whole list of
+ids (or a batch of them) into text in one call.
+"""
+
+import mmap
+import os
+import struct
+import zlib
+
+import numpy as np
+from tensorflow.python.platform import gfile
+
+import data_utils
+
+
+BINARY_SUFFIX = ".bin"
+
+_MAGIC = b"EMDVOCB1"
+# magic, number of words, hash table size, buffer size in bytes
+_HEADER = struct.Struct("<8sIII")
+
+
+def _table_size(count):
+  """Smallest power of two with a load factor of at most one half."""
+  size = 1
+  while size < 2 * count:
+    size *= 2
+  return size
+
+
+class CompactVocabulary(object):
+  """Vocabulary held as a word buffer, offsets and a hash table."""
+
+  def __init__(self, buffer, offsets, table):
+    """Wrap existing arrays; use from_words or load to build one.
+
+    Args:
+      buffer: bytes-like object holding all words back to back.
+      offsets: uint32 array; word i is buffer[offsets[i]:offsets[i + 1]].
+      table: int32 array whose size is a power of two, holding word ids at
+        their crc32 slot (or the next free one) and -1 in empty slots.
+    """
+    self._buffer = memoryview(buffer)
+    self._offsets = offsets
+    self._table = table
+    self._mask = len(table) - 1
+
+  @classmethod
+  def from_words(cls, words):
+    """Build a vocabulary from a list of words (bytes), ids in list order."""
+    lengths = np.array([len(w) for w in words], dtype=np.uint32)
+    offsets = np.zeros(len(words) + 1, dtype=np.uint32)
+    np.cumsum(lengths, out=offsets[1:])
+    table = np.full(_table_size(len(words)), -1, dtype=np.int32)
+    mask = len(table) - 1
+    for i, word in enumerate(words):
+      slot = zlib.crc32(word) & mask
+      while table[slot] >= 0:
+        slot = (slot + 1) & mask
+      table[slot] = i
+    return cls(b"".join(words), offsets, table)
+
+  @classmethod
+  def load(cls, path):
+    """Memory-map a vocabulary written by write()."""
+    with open(path, "rb") as f:
+      mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, count, table_size, buffer_size = _HEADER.unpack_from(mapped)
+    if magic != _MAGIC:
+      raise ValueError("%s is not a compact vocabulary file." % path)
+    position = _HEADER.size
+    offsets = np.frombuffer(mapped, dtype="<u4", count=count + 1,
+                            offset=position)
+    position += offsets.nbytes
+    table = np.frombuffer(mapped, dtype="<i4", count=table_size,
+                          offset=position)
+    position += table.nbytes
+    return cls(memoryview(mapped)[position:position + buffer_size],
+               offsets, table)
+
+  def write(self, path):
+    """Write the vocabulary to a binary file that load() can map.
+
+    The file is written under a temporary name and renamed, so that a
+    process mapping path never sees it half-written.
+    """
+    temp_path = "%s.tmp%d" % (path, os.getpid())
+    with gfile.GFile(temp_path, mode="wb") as f:
+      f.write(_HEADER.pack(_MAGIC, len(self), len(self._table),
+                           len(self._buffer)))
+      f.write(self._offsets.astype("<u4").tobytes())
+      f.write(self._table.astype("<i4").tobytes())
+      f.write(self._buffer.tobytes())
+    gfile.Rename(temp_path, path, overwrite=True)
+
+  def __len__(self):
+    return len(self._offsets) - 1
+
+  def __getitem__(self, word_id):
+    return self._buffer[self._offsets[word_id]:
+                        self._offsets[word_id + 1]].tobytes()
+
+  def get(self, word, default=None):
+    """Return the id of word (bytes), or default if it is not in the vocab."""
+    slot = zlib.crc32(word) & self._mask
+    while True:
+      word_id = self._table[slot]
+      if word_id < 0:
+        return default
+      if self._buffer[self._offsets[word_id]:
+                      self._offsets[word_id + 1]] == word:
+        return int(word_id)
+      slot = (slot + 1) & self._mask
+
+  def __contains__(self, word):
+    return self.get(word) is not None
+
+  def decode(self, ids):
+    """Return the words of a list of ids as one space-separated string."""
+    ids = np.asarray(ids, dtype=np.int64)
+    starts, ends = self._offsets[ids], self._offsets[ids + 1]
+    return b" ".join([self._buffer[start:end]
+                      for start, end in zip(starts, ends)]).decode("utf-8")
+
+  def decode_batch(self, batch):
+    """Decode a list of id lists into a list of strings."""
+    return [self.decode(ids) for ids in batch]
+
+
+def write_binary_vocabulary(vocabulary_path):
+  """Write the binary form of a text vocabulary file next to it.
+
+  Returns:
+    The path of the binary file.
+  """
+  binary_path = vocabulary_path + BINARY_SUFFIX
+  _, rev_vocab = data_utils.initialize_vocabulary(vocabulary_path)
+  CompactVocabulary.from_words(rev_vocab).write(binary_path)
+  return binary_path
+
+
+def load_vocabulary(vocabulary_path):
+  """Load the compact form of a text vocabulary file.
+
+  The binary file next to it is memory-mapped; if it is missing or older
+  than the text file, it is written first (or, if that fails, the
+  vocabulary is built in memory).
+  """
+  binary_path = vocabulary_path + BINARY_SUFFIX
+  if (not os.path.exists(binary_path) or
+      os.path.getmtime(binary_path) < os.path.getmtime(vocabulary_path)):
+    try:
+      write_binary_vocabulary(vocabulary_path)
+    except (IOError, OSError) as e:
+      print("Could not write %s (%s); building the vocabulary in memory."
+            % (binary_path, e))
+      _, rev_vocab = data_utils.initialize_vocabulary(vocabulary_path)
+      return CompactVocabulary.from_words(rev_vocab)
+  return CompactVocabulary.load(binary_path)